@@ -1,23 +1,47 @@
+import asyncio
 import io
 import json
-import os
-import shutil
-from tempfile import NamedTemporaryFile
-from typing import List, Dict
-from collections import defaultdict
-from groq import Groq
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import re
+import time
+from datetime import datetime
+from typing import List, Dict, AsyncIterator, Optional, Tuple
+from groq import AsyncGroq
 from app.config import settings
-from app.db import search_ncert, insert_documents, get_teacher_profile
+from app.db import asearch_ncert, get_teacher_profile, embed_query, is_indexed_term
+from app.answer_cache import SemanticAnswerCache, context_fingerprint
 from app.schemas import AIResponse
+from app.concurrency import run_blocking, get_semaphore
+from app.session_state import get_session_state
+from app.database import get_session_messages
+from app.chat_log import to_micros
+from app.prompt_builder import (
+    PromptStats, estimate_tokens, count_message_tokens, fit_context, fit_history, roll_summary
+)
+from app.routing import SMALL, LARGE, RouteStats, choose_route
 
-client = Groq(api_key=settings.GROQ_API_KEY)
+client = AsyncGroq(api_key=settings.GROQ_API_KEY)
 
-# Buffer Memory - stores conversation history per chat session
-# Key: session_id, Value: list of {"role": "user"|"assistant", "content": str}
-conversation_memory: Dict[str, List[dict]] = defaultdict(list)
+# Buffer Memory - stores conversation history per chat session in the
+# session-state backend, so every worker sees the same history
+# Key: session_id, Value: {"messages": [{"role": "user"|"assistant", "content": str}],
+#                          "message_ids": [chat_history ids of the exchanges held],
+#                          "summary": rolling summary of the turns older than "messages",
+#                          "cleared_at": set by clear_memory; saved turns before it are never restored}
+MEMORY_NAMESPACE = "conversation"
 MAX_MEMORY_MESSAGES = 10 
+SUMMARY_REBUILD_EXCHANGES = 10  # Older saved exchanges folded into the summary when memory is rebuilt
+
+prompt_stats = PromptStats()
+route_stats = RouteStats()
+
+answer_cache: Optional[SemanticAnswerCache] = None
+if settings.ANSWER_CACHE_ENABLED:
+    answer_cache = SemanticAnswerCache(
+        path=settings.ANSWER_CACHE_PATH,
+        threshold=settings.ANSWER_CACHE_SIMILARITY,
+        ttl_seconds=settings.ANSWER_CACHE_TTL_SECONDS,
+        max_entries=settings.ANSWER_CACHE_MAX_ENTRIES
+    )
 
 ANALYTICS_PROMPT = """
 You are Shiksha Mitra, an AI mentor for teachers.
@@ -26,7 +50,7 @@ Your role is to help with both NCERT curriculum content AND general teaching/cla
 CONTEXT FROM NCERT (if available):
 {context}
 
-CONVERSATION HISTORY (for context):
+EARLIER CONVERSATION (summary; the latest messages follow separately):
 {conversation_summary}
 
 INSTRUCTIONS:
@@ -66,28 +90,47 @@ INSTRUCTIONS:
    - Skip unnecessary examples unless specifically asked
    - NO lengthy explanations - be brief and to the point
 
-7. **ANALYTICS:** Classify the query topic and sentiment.
+{response_format}"""
+
+# Answer plus analytics in one reply (small route, or routing disabled)
+FULL_RESPONSE_FORMAT = """7. **ANALYTICS:** Classify the query topic and sentiment.
 
 FORMAT YOUR RESPONSE AS A VALID JSON OBJECT:
-{{
+{
   "answer": "Brief, formatted answer (2-3 short paragraphs max, 80-120 words) with bullet points and bold text...",
   "topic": "Classroom Management" or "Pedagogy" or "Subject Knowledge" or "Student Engagement" or "Curriculum",
   "sentiment": "Curious" or "Frustrated" or "Urgent" or "Neutral" or "Seeking Help",
   "language": "Hindi" or "English",
   "actions": ["Action 1", "Action 2"]
-}}
+}
+"""
+
+# Large route: the small model classifies the query in parallel (see classify_query)
+ANSWER_RESPONSE_FORMAT = """FORMAT YOUR RESPONSE AS A VALID JSON OBJECT:
+{
+  "answer": "Brief, formatted answer (2-3 short paragraphs max, 80-120 words) with bullet points and bold text...",
+  "actions": ["Action 1", "Action 2"]
+}
 """
 
+CLASSIFY_PROMPT = """Classify a teacher's query for analytics. Reply with a JSON object only:
+{
+  "topic": "Classroom Management" or "Pedagogy" or "Subject Knowledge" or "Student Engagement" or "Curriculum",
+  "sentiment": "Curious" or "Frustrated" or "Urgent" or "Neutral" or "Seeking Help",
+  "language": "Hindi" or "English"
+}"""
+
 async def transcribe_audio(file_bytes: bytes, filename: str) -> str:
     try:
         audio_file = io.BytesIO(file_bytes)
         audio_file.name = filename
         
-        transcription = client.audio.transcriptions.create(
-            file=(filename, audio_file.read()),
-            model=settings.STT_MODEL,
-            temperature=0.0
-        )
+        async with get_semaphore("llm", settings.LLM_MAX_CONCURRENCY):
+            transcription = await client.audio.transcriptions.create(
+                file=(filename, audio_file.read()),
+                model=settings.STT_MODEL,
+                temperature=0.0
+            )
         transcribed_text = transcription.text.strip()
         
         # Debug logging
@@ -98,80 +141,396 @@ async def transcribe_audio(file_bytes: bytes, filename: str) -> str:
         print(f"Whisper Error: {e}")
         return ""
 
+def _memory_messages(entry) -> List[dict]:
+    if entry is None:
+        return []
+    # Entries written before delta sync were a bare message list
+    return entry if isinstance(entry, list) else entry["messages"]
+
+def _memory_ids(entry) -> List[str]:
+    return entry.get("message_ids", []) if isinstance(entry, dict) else []
+
+def _memory_summary(entry) -> str:
+    return entry.get("summary", "") if isinstance(entry, dict) else ""
+
+def _memory_cleared_at(entry) -> Optional[int]:
+    return entry.get("cleared_at") if isinstance(entry, dict) else None
+
+def _memory_entry(
+    summary: str, messages: List[dict], message_ids: List[str], cleared_at: Optional[int] = None
+) -> dict:
+    """Keep the last MAX_MEMORY_MESSAGES verbatim; older ones are folded into the summary."""
+    dropped = messages[:-MAX_MEMORY_MESSAGES]
+    if dropped:
+        summary = roll_summary(summary, dropped, settings.PROMPT_SUMMARY_TOKENS)
+    entry = {
+        "messages": messages[-MAX_MEMORY_MESSAGES:],
+        "message_ids": message_ids[-(MAX_MEMORY_MESSAGES // 2):],
+        "summary": summary,
+    }
+    if cleared_at is not None:
+        entry["cleared_at"] = cleared_at
+    return entry
+
 def get_conversation_history(session_id: str) -> List[dict]:
     """Get recent conversation history for a chat session."""
-    return conversation_memory[session_id][-MAX_MEMORY_MESSAGES:]
+    return _memory_messages(get_session_state().get(MEMORY_NAMESPACE, session_id))[-MAX_MEMORY_MESSAGES:]
+
+def add_turns(session_id: str, turns: List[Tuple[str, str]], message_id: Optional[str] = None):
+    """
+    Atomically append (role, content) messages, keeping only the last
+    MAX_MEMORY_MESSAGES. `message_id` is the chat_history id the exchange will
+    be saved under; clients echo the latest one back as `last_message_id`.
+    """
+    new_messages = [{"role": role, "content": content} for role, content in turns]
+    
+    def append(entry):
+        return _memory_entry(
+            _memory_summary(entry),
+            _memory_messages(entry) + new_messages,
+            _memory_ids(entry) + ([message_id] if message_id else []),
+            _memory_cleared_at(entry)
+        )
+    
+    get_session_state().update(MEMORY_NAMESPACE, session_id, append)
 
 def add_to_memory(session_id: str, role: str, content: str):
     """Add a message to the conversation memory for a specific chat session."""
-    conversation_memory[session_id].append({"role": role, "content": content})
-    # Trim to keep only last MAX_MEMORY_MESSAGES
-    if len(conversation_memory[session_id]) > MAX_MEMORY_MESSAGES:
-        conversation_memory[session_id] = conversation_memory[session_id][-MAX_MEMORY_MESSAGES:]
+    add_turns(session_id, [(role, content)])
+
+def replace_memory(
+    session_id: str,
+    turns: List[Tuple[str, str]],
+    message_ids: Optional[List[str]] = None,
+    cleared_at: Optional[int] = None
+):
+    """Replace a session's memory in one update."""
+    messages = [{"role": role, "content": content} for role, content in turns]
+    if messages:
+        get_session_state().set(
+            MEMORY_NAMESPACE, session_id, _memory_entry("", messages, message_ids or [], cleared_at)
+        )
+    else:
+        clear_memory(session_id)
 
 def clear_memory(session_id: str):
-    """Clear conversation memory for a chat session."""
-    conversation_memory[session_id] = []
+    """
+    Clear conversation memory for a chat session. An empty entry marked
+    `cleared_at` is kept rather than deleting the key, so the next query is a
+    hit and sync_memory never restores the cleared turns from chat_history.
+    """
+    get_session_state().update(MEMORY_NAMESPACE, session_id, lambda entry: _memory_entry(
+        "", [], _memory_ids(entry), to_micros(datetime.now())
+    ))
+
+async def sync_memory(
+    session_id: str,
+    teacher_id: str,
+    last_message_id: Optional[str] = None,
+    client_history: Optional[List[Tuple[str, str]]] = None
+) -> str:
+    """
+    Make sure the server-side memory for a session is current before answering.
 
-def build_conversation_summary(session_id: str) -> str:
-    """Build a text summary of recent conversation for context."""
-    history = get_conversation_history(session_id)
-    if not history:
-        return "No previous conversation."
+    The session store is the source of truth: clients send only the id of the
+    last exchange they saw. Memory is rebuilt from saved chat history only on a
+    miss - nothing stored (evicted, expired, restarted) or the client has seen
+    an exchange this memory does not hold. `client_history` is the deprecated
+    full upload, used only when the session has no saved history at all.
+    Returns "hit", "rebuilt", "client" or "empty".
+    """
+    entry = await run_blocking(get_session_state().get, MEMORY_NAMESPACE, session_id)
+    if entry is not None and (last_message_id is None or last_message_id in _memory_ids(entry)):
+        return "hit"
     
-    summary_parts = []
-    for msg in history:
-        role = "Teacher" if msg["role"] == "user" else "Assistant"
-        # Truncate long messages for summary
-        content = msg["content"][:200] + "..." if len(msg["content"]) > 200 else msg["content"]
-        summary_parts.append(f"{role}: {content}")
+    messages = await run_blocking(
+        get_session_messages, teacher_id, session_id, MAX_MEMORY_MESSAGES // 2 + SUMMARY_REBUILD_EXCHANGES
+    )
+    cleared_at = _memory_cleared_at(entry)
+    if cleared_at is not None:
+        messages = [msg for msg in messages if to_micros(msg.timestamp) > cleared_at]
+    if messages:
+        turns = []
+        for msg in messages:
+            turns += [("user", msg.query_text), ("assistant", msg.answer_text)]
+        await run_blocking(replace_memory, session_id, turns, [msg.id for msg in messages], cleared_at)
+        print(f"[Memory] Rebuilt session {session_id} from {len(messages)} saved messages")
+        return "rebuilt"
     
-    return "\n".join(summary_parts)
+    if client_history and entry is None:
+        await run_blocking(replace_memory, session_id, client_history)
+        return "client"
+    return "hit" if entry is not None else "empty"
 
-async def generate_smart_answer(query: str, context: str, session_id: str) -> dict:
-    # Build conversation summary for context
-    conversation_summary = build_conversation_summary(session_id)
-    formatted_prompt = ANALYTICS_PROMPT.format(context=context, conversation_summary=conversation_summary)
-    
-    # Build messages with conversation history
-    messages = [{"role": "system", "content": formatted_prompt}]
+NO_CONTEXT = "[No specific NCERT content found for this topic. Providing general teaching guidance.]"
+
+ERROR_RESULT = {
+    "answer": "Sorry, I encountered an error. Please try again.",
+    "topic": "Error",
+    "sentiment": "Neutral",
+    "language": "Unknown",
+    "actions": []
+}
+
+_JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+class AnswerStreamParser:
+    """Incrementally extracts the "answer" string from a JSON object streamed token by token."""
+
+    def __init__(self):
+        self.buffer = ""
+        self.done = False
+        self._pos = None  # Index of the next unread char inside the answer string
+
+    def feed(self, chunk: str) -> str:
+        """Add raw model output and return any newly decoded answer text."""
+        self.buffer += chunk
+        if self.done:
+            return ""
+        if self._pos is None:
+            match = re.search(r'"answer"\s*:\s*"', self.buffer)
+            if not match:
+                return ""
+            self._pos = match.end()
+
+        buf = self.buffer
+        i = self._pos
+        out = []
+        while i < len(buf):
+            ch = buf[i]
+            if ch == '"':
+                self.done = True
+                i += 1
+                break
+            if ch != '\\':
+                out.append(ch)
+                i += 1
+                continue
+            # Escape sequence - wait for the rest of it if it is split across chunks
+            if i + 1 >= len(buf):
+                break
+            esc = buf[i + 1]
+            if esc != 'u':
+                out.append(_JSON_ESCAPES.get(esc, esc))
+                i += 2
+                continue
+            if i + 6 > len(buf):
+                break
+            width = 6
+            if 0xD800 <= int(buf[i + 2:i + 6], 16) <= 0xDBFF:
+                # Surrogate pair (emoji) - decode both halves together
+                if i + 12 > len(buf):
+                    break
+                width = 12
+            out.append(json.loads('"' + buf[i:i + width] + '"'))
+            i += width
+        self._pos = i
+        return "".join(out)
+
+def _parse_model_json(content: str) -> dict:
+    """Parse the model's JSON reply, tolerating stray text around the object."""
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError:
+        start, end = content.find("{"), content.rfind("}")
+        if start != -1 and end > start:
+            return json.loads(content[start:end + 1])
+        raise
+
+def build_messages(
+    query: str, context: str, session_id: str, response_format: str = FULL_RESPONSE_FORMAT
+) -> Tuple[List[dict], int]:
+    """
+    Assemble the prompt within the per-section token budgets: recent turns
+    verbatim, older ones only as the rolling summary (never both). `context`
+    is already deduped and fitted by retrieve_context.
+    Returns the messages and their estimated token count.
+    """
+    entry = get_session_state().get(MEMORY_NAMESPACE, session_id)
+    history = _memory_messages(entry)[-MAX_MEMORY_MESSAGES:]
+    recent, older = fit_history(history, settings.PROMPT_HISTORY_TOKENS, settings.PROMPT_MESSAGE_MAX_TOKENS)
+    # Turns the history budget could not take join the summary for this prompt only
+    summary = roll_summary(_memory_summary(entry), older, settings.PROMPT_SUMMARY_TOKENS)
+    if not summary:
+        summary = "None - see the messages below." if recent else "No previous conversation."
     
-    # Add conversation history for context
-    history = get_conversation_history(session_id)
-    messages.extend(history)
+    formatted_prompt = ANALYTICS_PROMPT.format(
+        context=context, conversation_summary=summary, response_format=response_format
+    )
+    query_message = {"role": "user", "content": query}
+    messages = [{"role": "system", "content": formatted_prompt}, *recent, query_message]
     
-    # Add current query
-    messages.append({"role": "user", "content": query})
+    context_tokens = estimate_tokens(context)
+    summary_tokens = estimate_tokens(summary)
+    sections = {
+        "instructions": estimate_tokens(formatted_prompt) - context_tokens - summary_tokens,
+        "context": context_tokens,
+        "summary": summary_tokens,
+        "history": count_message_tokens(recent),
+        "query": count_message_tokens([query_message]),
+    }
+    sections["total"] = sum(sections.values())
+    prompt_stats.record(sections, turns_summarized=len(older))
+    print(f"[Prompt] ~{sections['total']} tokens (instructions {sections['instructions']}, "
+          f"context {sections['context']}, summary {sections['summary']}, history {sections['history']}, "
+          f"query {sections['query']}); {len(recent)} recent messages, {len(older)} summarized")
+    return messages, sections["total"]
+
+def _route_model(route: str) -> str:
+    return settings.LLM_SMALL_MODEL if settings.LLM_ROUTING and route == SMALL else settings.LLM_MODEL
+
+def _classifies_separately(route: str) -> bool:
+    return settings.LLM_ROUTING and route == LARGE
+
+async def classify_query(query: str) -> dict:
+    """Topic/sentiment/language from the small model; {} if it fails (the caller keeps its defaults)."""
+    try:
+        async with get_semaphore("llm", settings.LLM_MAX_CONCURRENCY):
+            chat = await client.chat.completions.create(
+                messages=[{"role": "system", "content": CLASSIFY_PROMPT}, {"role": "user", "content": query}],
+                model=settings.LLM_SMALL_MODEL,
+                temperature=0,
+                max_tokens=60,
+                response_format={"type": "json_object"}
+            )
+        result = json.loads(chat.choices[0].message.content)
+        return {key: result[key] for key in ("topic", "sentiment", "language") if result.get(key)}
+    except Exception as e:
+        print(f"[Router] Classification failed: {e}")
+        return {}
+
+async def generate_smart_answer(
+    query: str, context: str, session_id: str, message_id: Optional[str] = None, route: str = LARGE
+) -> dict:
+    separate = _classifies_separately(route)
+    messages, estimated_tokens = await run_blocking(
+        build_messages, query, context, session_id, ANSWER_RESPONSE_FORMAT if separate else FULL_RESPONSE_FORMAT
+    )
+    classification = asyncio.create_task(classify_query(query)) if separate else None
     
     try:
-        chat = client.chat.completions.create(
-            messages=messages,
-            model=settings.LLM_MODEL,
-            temperature=0.5,
-            response_format={"type": "json_object"}
-        )
+        async with get_semaphore("llm", settings.LLM_MAX_CONCURRENCY):
+            chat = await client.chat.completions.create(
+                messages=messages,
+                model=_route_model(route),
+                temperature=0.5,
+                response_format={"type": "json_object"}
+            )
+        usage = getattr(chat, "usage", None)
+        prompt_stats.record_reported(estimated_tokens, getattr(usage, "prompt_tokens", None))
         response_content = chat.choices[0].message.content
         result = json.loads(response_content)
+        if classification is not None:
+            result.update(await classification)
         
         # Add to memory
-        add_to_memory(session_id, "user", query)
-        add_to_memory(session_id, "assistant", result.get("answer", ""))
+        await run_blocking(
+            add_turns, session_id, [("user", query), ("assistant", result.get("answer", ""))], message_id
+        )
         
         return result
     except Exception as e:
+        if classification is not None:
+            classification.cancel()
         print(f"LLM Error: {e}")
-        return {
-            "answer": "Sorry, I encountered an error. Please try again.",
-            "topic": "Error",
-            "sentiment": "Neutral",
-            "language": "Unknown",
-            "actions": []
-        }
-
-async def run_ai_pipeline(query_text: str, session_id: str) -> AIResponse:
+        return dict(ERROR_RESULT)
+
+async def _pump_stream(messages: List[dict], model: str, estimated_tokens: int, queue: asyncio.Queue):
+    """
+    Read the whole Groq stream into `queue` while holding an LLM slot, so a slow
+    SSE client never keeps the slot. Puts each text delta, then None when the
+    stream ends (or the exception that ended it).
+    """
+    try:
+        async with get_semaphore("llm", settings.LLM_MAX_CONCURRENCY):
+            # Groq JSON mode does not support streaming, so rely on the prompt's JSON instructions
+            stream = await client.chat.completions.create(
+                messages=messages,
+                model=model,
+                temperature=0.5,
+                stream=True
+            )
+            async for chunk in stream:
+                # Groq reports usage on the final chunk under x_groq
+                usage = getattr(getattr(chunk, "x_groq", None), "usage", None)
+                if usage is not None:
+                    prompt_stats.record_reported(estimated_tokens, getattr(usage, "prompt_tokens", None))
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    queue.put_nowait(delta)
+        queue.put_nowait(None)
+    except Exception as e:
+        queue.put_nowait(e)
+
+async def stream_smart_answer(
+    query: str, context: str, session_id: str, message_id: Optional[str] = None, route: str = LARGE
+) -> AsyncIterator[Tuple[str, object]]:
+    """
+    Streaming variant of generate_smart_answer.
+    Yields ("token", text) for each piece of the answer, then ("result", dict) with the parsed JSON.
+    If the stream breaks after tokens went out, the result keeps the partial
+    answer and is marked "incomplete" instead of replacing it with the error text.
+    """
+    separate = _classifies_separately(route)
+    messages, estimated_tokens = await run_blocking(
+        build_messages, query, context, session_id, ANSWER_RESPONSE_FORMAT if separate else FULL_RESPONSE_FORMAT
+    )
+    parser = AnswerStreamParser()
+    streamed = []
+    classification = asyncio.create_task(classify_query(query)) if separate else None
+    queue: asyncio.Queue = asyncio.Queue()
+    pump = asyncio.create_task(_pump_stream(messages, _route_model(route), estimated_tokens, queue))
+    
+    try:
+        while True:
+            delta = await queue.get()
+            if delta is None:
+                break
+            if isinstance(delta, Exception):
+                raise delta
+            text = parser.feed(delta)
+            if text:
+                streamed.append(text)
+                yield "token", text
+        
+        try:
+            result = _parse_model_json(parser.buffer)
+        except json.JSONDecodeError:
+            # Model ignored the JSON format - treat the whole reply as the answer
+            result = {"answer": parser.buffer.strip()}
+        if classification is not None:
+            result.update(await classification)
+        
+        await run_blocking(
+            add_turns, session_id, [("user", query), ("assistant", result.get("answer", ""))], message_id
+        )
+        
+        yield "result", result
+    except Exception as e:
+        if classification is not None:
+            classification.cancel()
+        print(f"LLM Stream Error: {e}")
+        if not streamed:
+            yield "result", dict(ERROR_RESULT)
+            return
+        # The client already shows part of the answer: keep it, flagged as cut off
+        result = {**ERROR_RESULT, "answer": "".join(streamed), "incomplete": True}
+        await run_blocking(
+            add_turns, session_id, [("user", query), ("assistant", result["answer"])], message_id
+        )
+        yield "result", result
+    finally:
+        # Client went away mid-stream: stop reading from Groq and free the slot
+        pump.cancel()
+
+async def retrieve_context(query_text: str, session_id: str, search: bool = True) -> Tuple[List[str], str]:
+    if not search:
+        # Small talk: nothing to look up
+        return [], NO_CONTEXT
+    
     # For short/referential queries, include previous query context in RAG search
     search_query = query_text
-    history = get_conversation_history(session_id)
+    history = await run_blocking(get_conversation_history, session_id)
     
     # If query is short and there's history, combine with previous user query for better RAG
     if len(query_text.split()) <= 5 and history:
@@ -183,50 +542,128 @@ async def run_ai_pipeline(query_text: str, session_id: str) -> AIResponse:
             print(f"[RAG] Short query detected. Extended search query: {search_query}")
     
     # Try to search NCERT for relevant context
-    docs = search_ncert(search_query)
-    context_str = "\n\n".join(docs) if docs else ""
+    docs = await asearch_ncert(search_query)
+    # Overlapping chunks are merged and the rest is cut to the context budget
+    context_str, left_out = fit_context(docs, settings.PROMPT_CONTEXT_TOKENS)
+    prompt_stats.record_context(left_out)
     
     # If no NCERT context found, provide guidance without context
     if not context_str:
         print(f"[Pipeline] No NCERT context found for query: {query_text}")
-        context_str = "[No specific NCERT content found for this topic. Providing general teaching guidance.]"
+        context_str = NO_CONTEXT
     else:
-        print(f"[Pipeline] Found {len(docs)} NCERT documents")
-    
-    ai_data = await generate_smart_answer(query_text, context_str, session_id)
+        print(f"[Pipeline] Found {len(docs)} NCERT documents ({left_out} left out as duplicate or over budget)")
     
+    return docs, context_str
+
+def _to_ai_response(ai_data: dict, docs: List[str]) -> AIResponse:
     return AIResponse(
-        answer_text=ai_data.get("answer"),
+        answer_text=ai_data.get("answer") or "",
         source_documents=docs,
         suggested_actions=ai_data.get("actions", []),
         detected_topic=ai_data.get("topic", "General"),
         query_sentiment=ai_data.get("sentiment", "Neutral"),
-        detected_language=ai_data.get("language", "Unknown")
+        detected_language=ai_data.get("language", "Unknown"),
+        incomplete=bool(ai_data.get("incomplete"))
     )
 
-async def ingest_pdf_pipeline(file_upload):
-    with NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-        shutil.copyfileobj(file_upload.file, tmp)
-        tmp_path = tmp.name
+async def _answer_cache_key(query_text: str, session_id: str, docs: List[str]) -> Optional[tuple]:
+    """
+    Cache key for standalone questions only - follow-ups depend on the
+    conversation, so sessions with history always go to the LLM.
+    """
+    if answer_cache is None or await run_blocking(get_conversation_history, session_id):
+        return None
+    embedding = await run_blocking(embed_query, query_text)
+    return embedding, context_fingerprint(docs)
 
-    try:
-        loader = PyPDFLoader(tmp_path)
-        docs = loader.load()
-        
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            separators=["\n\n", "\n", ".", " "]
+async def _cached_answer(
+    query_text: str, session_id: str, cache_key: Optional[tuple], message_id: Optional[str] = None
+) -> Optional[dict]:
+    if cache_key is None:
+        return None
+    result = await run_blocking(answer_cache.get, *cache_key)
+    if result is not None:
+        await run_blocking(
+            add_turns, session_id, [("user", query_text), ("assistant", result.get("answer", ""))], message_id
         )
-        chunks = text_splitter.split_documents(docs)
+    return result
 
-        texts = [c.page_content for c in chunks]
-        metadatas = [{"source": file_upload.filename, "page": c.metadata.get("page", 0)} for c in chunks]
+async def _store_answer(cache_key: Optional[tuple], result: dict, llm_started: float):
+    """`llm_started` is taken just before the LLM call: a hit still pays for retrieval and embedding."""
+    if cache_key is None or result.get("topic") == "Error":
+        return
+    latency_ms = (time.perf_counter() - llm_started) * 1000
+    await run_blocking(answer_cache.put, cache_key[0], cache_key[1], result, latency_ms)
 
-        count = insert_documents(texts, metadatas)
-        
-        return {"status": "success", "chunks_added": count, "filename": file_upload.filename}
-        
-    finally:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
\ No newline at end of file
+def route_query(query_text: str, session_id: str) -> Tuple[str, str]:
+    """(route, reason) for a query; see app/routing.py."""
+    if not settings.LLM_ROUTING:
+        return LARGE, "routing_disabled"
+    route, reason = choose_route(
+        query_text,
+        bool(get_conversation_history(session_id)),
+        settings.ROUTE_SHORT_QUERY_WORDS,
+        settings.ROUTE_SMALLTALK_MAX_WORDS,
+        is_indexed_term
+    )
+    print(f"[Router] {route} model ({reason})")
+    return route, reason
+
+async def run_ai_pipeline(query_text: str, session_id: str, message_id: Optional[str] = None) -> AIResponse:
+    started = time.perf_counter()
+    route, reason = await run_blocking(route_query, query_text, session_id)
+    docs, context_str = await retrieve_context(query_text, session_id, search=reason != "smalltalk")
+    
+    cache_key = await _answer_cache_key(query_text, session_id, docs)
+    ai_data = await _cached_answer(query_text, session_id, cache_key, message_id)
+    if ai_data is None:
+        llm_started = time.perf_counter()
+        ai_data = await generate_smart_answer(query_text, context_str, session_id, message_id, route)
+        await _store_answer(cache_key, ai_data, llm_started)
+    else:
+        route = "cache"
+    
+    route_stats.record(route, reason, (time.perf_counter() - started) * 1000)
+    return _to_ai_response(ai_data, docs)
+
+async def stream_ai_pipeline(
+    query_text: str, session_id: str, message_id: Optional[str] = None
+) -> AsyncIterator[Tuple[str, object]]:
+    """Yields ("token", text) events while the answer streams, then ("final", AIResponse)."""
+    started = time.perf_counter()
+    route, reason = await run_blocking(route_query, query_text, session_id)
+    docs, context_str = await retrieve_context(query_text, session_id, search=reason != "smalltalk")
+    
+    cache_key = await _answer_cache_key(query_text, session_id, docs)
+    cached = await _cached_answer(query_text, session_id, cache_key, message_id)
+    if cached is not None:
+        route_stats.record("cache", reason, (time.perf_counter() - started) * 1000)
+        yield "token", cached.get("answer", "")
+        yield "final", _to_ai_response(cached, docs)
+        return
+    
+    llm_started = time.perf_counter()
+    async for kind, payload in stream_smart_answer(query_text, context_str, session_id, message_id, route):
+        if kind == "token":
+            yield "token", payload
+        else:
+            await _store_answer(cache_key, payload, llm_started)
+            route_stats.record(route, reason, (time.perf_counter() - started) * 1000)
+            yield "final", _to_ai_response(payload, docs)
+
+def get_prompt_stats() -> dict:
+    return prompt_stats.stats()
+
+def get_routing_stats() -> dict:
+    return {
+        "enabled": settings.LLM_ROUTING,
+        "small_model": settings.LLM_SMALL_MODEL,
+        "large_model": settings.LLM_MODEL,
+        **route_stats.stats(),
+    }
+
+def get_answer_cache_stats() -> dict:
+    if answer_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **answer_cache.stats()}
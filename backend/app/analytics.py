@@ -0,0 +1,168 @@
+from dataclasses import dataclass
+from datetime import datetime, time as dtime
+from typing import Dict, Iterable, List, Optional
+import numpy as np
+from app.chat_log import to_micros
+
+DIMENSIONS = ("detected_topic", "query_sentiment", "detected_language")
+
+@dataclass
+class AnalyticsFrame:
+    """
+    Column snapshot of the chat log for analytics: one integer code array per
+    categorical field (with its category values) plus int64 microsecond timestamps.
+    """
+    teacher: np.ndarray
+    timestamps: np.ndarray
+    codes: Dict[str, np.ndarray]
+    teacher_values: List[str]
+    values: Dict[str, List[str]]
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[dict]) -> "AnalyticsFrame":
+        """Build a frame from row dicts (e.g. a Supabase select of just the needed columns)."""
+        interned = {name: {} for name in ("teacher_id",) + DIMENSIONS}
+        columns = {name: [] for name in interned}
+        timestamps = []
+        for row in rows:
+            for name, table in interned.items():
+                value = row.get(name) or "Unknown"
+                columns[name].append(table.setdefault(value, len(table)))
+            ts = row["timestamp"]
+            timestamps.append(to_micros(datetime.fromisoformat(ts) if isinstance(ts, str) else ts))
+        return cls(
+            teacher=np.asarray(columns["teacher_id"], dtype=np.uint32),
+            timestamps=np.asarray(timestamps, dtype=np.int64),
+            codes={name: np.asarray(columns[name], dtype=np.uint32) for name in DIMENSIONS},
+            teacher_values=list(interned["teacher_id"]),
+            values={name: list(interned[name]) for name in DIMENSIONS},
+        )
+
+def _day_bounds(day) -> tuple:
+    start = datetime.combine(day, dtime.min)
+    return to_micros(start), to_micros(start) + 24 * 3600 * 1_000_000
+
+def compute_crp_analytics(
+    frame: AnalyticsFrame,
+    teacher_ids: Iterable[str],
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    per_teacher: bool = False,
+    top_n: int = 5,
+) -> dict:
+    """
+    Grouped counts over the frame for the given teachers.
+
+    Distributions cover [start, end) (all time by default); the "today"
+    counters always cover the current day. Each dimension is a single
+    np.bincount over (teacher, category) pairs, which yields the per-teacher
+    breakdown and the overall totals from the same pass.
+    """
+    lookup = {value: code for code, value in enumerate(frame.teacher_values)}
+    wanted = np.zeros(len(frame.teacher_values) + 1, dtype=bool)
+    wanted[[lookup[t] for t in teacher_ids if t in lookup]] = True
+
+    selected = wanted[frame.teacher]
+    if start is not None:
+        selected &= frame.timestamps >= to_micros(start)
+    if end is not None:
+        selected &= frame.timestamps < to_micros(end)
+
+    today_start, today_end = _day_bounds(datetime.now().date())
+    in_teachers = wanted[frame.teacher]
+    today = in_teachers & (frame.timestamps >= today_start) & (frame.timestamps < today_end)
+    active_today = int(np.count_nonzero(np.bincount(frame.teacher[today], minlength=len(frame.teacher_values))))
+
+    teachers = frame.teacher[selected].astype(np.int64)
+    n_teachers = len(frame.teacher_values)
+    result = {
+        "total_queries": int(teachers.size),
+        "active_teachers_today": active_today,
+        "total_queries_today": int(np.count_nonzero(today)),
+    }
+
+    breakdown = {}
+    for name in DIMENSIONS:
+        n_values = len(frame.values[name])
+        grouped = np.bincount(
+            teachers * n_values + frame.codes[name][selected],
+            minlength=n_teachers * n_values
+        ).reshape(n_teachers, n_values) if n_values else np.zeros((n_teachers, 0), dtype=np.int64)
+        totals = grouped.sum(axis=0)
+        order = np.argsort(-totals, kind="stable")
+        result[name] = {frame.values[name][i]: int(totals[i]) for i in order if totals[i]}
+        if per_teacher:
+            breakdown[name] = grouped
+
+    result["top_topics"] = [
+        {"topic": topic, "count": count}
+        for topic, count in list(result["detected_topic"].items())[:top_n]
+    ]
+
+    if per_teacher:
+        per_teacher_counts = np.bincount(teachers, minlength=n_teachers)
+        rows = []
+        for code in np.flatnonzero(per_teacher_counts):
+            rows.append({
+                "teacher_id": frame.teacher_values[code],
+                "total_queries": int(per_teacher_counts[code]),
+                **{
+                    name: {
+                        frame.values[name][i]: int(count)
+                        for i, count in enumerate(breakdown[name][code]) if count
+                    }
+                    for name in DIMENSIONS
+                },
+            })
+        result["teacher_breakdown"] = sorted(rows, key=lambda r: -r["total_queries"])
+    return result
+
+def aggregate_grouped_counts(rows: Iterable[dict], per_teacher: bool = False, top_n: int = 5) -> dict:
+    """
+    Fold pre-grouped (teacher_id, dimension, value, queries) rows - the output of the
+    crp_analytics_counts RPC - into the same shape as compute_crp_analytics.
+    Rows grouped across teachers carry teacher_id None and only feed the totals.
+    """
+    totals = {name: {} for name in DIMENSIONS}
+    teachers: Dict[str, dict] = {}
+    today = {}
+    active_today = None
+    for row in rows:
+        teacher_id, dimension, count = row["teacher_id"], row["dimension"], int(row["queries"])
+        if dimension == "today":
+            today[teacher_id] = today.get(teacher_id, 0) + count
+            continue
+        if dimension == "active_today":
+            active_today = count
+            continue
+        if dimension not in totals:
+            continue
+        value = row.get("value") or "Unknown"
+        totals[dimension][value] = totals[dimension].get(value, 0) + count
+        if teacher_id is None:
+            continue
+        counts = teachers.setdefault(teacher_id, {name: {} for name in DIMENSIONS})
+        counts[dimension][value] = counts[dimension].get(value, 0) + count
+
+    if active_today is None:
+        active_today = sum(1 for teacher_id, count in today.items() if teacher_id is not None and count)
+    result = {
+        "total_queries": sum(totals["detected_topic"].values()),
+        "active_teachers_today": active_today,
+        "total_queries_today": sum(today.values()),
+    }
+    for name in DIMENSIONS:
+        result[name] = dict(sorted(totals[name].items(), key=lambda item: -item[1]))
+    result["top_topics"] = [
+        {"topic": topic, "count": count}
+        for topic, count in list(result["detected_topic"].items())[:top_n]
+    ]
+    if per_teacher:
+        result["teacher_breakdown"] = sorted(
+            (
+                {"teacher_id": teacher_id, "total_queries": sum(counts["detected_topic"].values()), **counts}
+                for teacher_id, counts in teachers.items()
+            ),
+            key=lambda r: -r["total_queries"]
+        )
+    return result
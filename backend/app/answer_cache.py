@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+import numpy as np
+
+def context_fingerprint(docs: List[str]) -> str:
+    """Stable fingerprint of the retrieved NCERT chunks an answer was grounded on."""
+    digest = hashlib.sha1()
+    for doc in docs:
+        digest.update(doc.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+class SemanticAnswerCache:
+    """
+    Answer cache keyed on (query embedding, context fingerprint).
+
+    A lookup hits when a stored entry has the same fingerprint and a cosine
+    similarity >= threshold. Entries expire after ttl_seconds and the least
+    recently used ones are evicted past max_entries. Everything is mirrored
+    to a SQLite file so the cache survives restarts, and an in-memory miss
+    reads the file for entries other workers have added since. Lookups never
+    write: last-access times and expiry deletes are batched into the next
+    put, or flushed every FLUSH_INTERVAL_S.
+    """
+
+    FLUSH_INTERVAL_S = 30
+    FLUSH_MAX_PENDING = 100
+
+    def __init__(self, path: str, threshold: float, ttl_seconds: int, max_entries: int):
+        self.path = path
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, dict]" = OrderedDict()  # LRU order: oldest first
+        self._by_fingerprint: Dict[str, Set[int]] = {}
+        # Mirror writes owed by get(): entry id -> last access, and ids to delete
+        self._pending_access: Dict[int, float] = {}
+        self._pending_deletes: Set[int] = set()
+        self._next_flush = time.monotonic() + self.FLUSH_INTERVAL_S
+
+        self.hits = 0
+        self.misses = 0
+        self.latency_saved_ms = 0.0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS answer_cache (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                fingerprint TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                result TEXT NOT NULL,
+                latency_ms REAL NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_answer_cache_fingerprint ON answer_cache(fingerprint)")
+        self._conn.commit()
+        self._load()
+
+    def _load(self):
+        cutoff = time.time() - self.ttl_seconds
+        self._conn.execute("DELETE FROM answer_cache WHERE created_at < ?", (cutoff,))
+        self._conn.commit()
+        rows = self._conn.execute(
+            "SELECT id, fingerprint, embedding, result, latency_ms, created_at "
+            "FROM answer_cache ORDER BY last_access ASC"
+        ).fetchall()
+        for entry_id, fingerprint, embedding, result, latency_ms, created_at in rows:
+            self._add_entry(entry_id, fingerprint, np.frombuffer(embedding, dtype=np.float32),
+                            json.loads(result), latency_ms, created_at)
+        self._evict_overflow()
+        self._flush_pending()
+        print(f"[Cache] Loaded {len(self._entries)} cached answers from {self.path}")
+
+    def _add_entry(self, entry_id: int, fingerprint: str, vector: np.ndarray,
+                   result: dict, latency_ms: float, created_at: float):
+        self._entries[entry_id] = {
+            "fingerprint": fingerprint,
+            "vector": vector,
+            "result": result,
+            "latency_ms": latency_ms,
+            "created_at": created_at,
+        }
+        self._by_fingerprint.setdefault(fingerprint, set()).add(entry_id)
+
+    def _remove_entry(self, entry_id: int):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        bucket = self._by_fingerprint.get(entry["fingerprint"])
+        if bucket is not None:
+            bucket.discard(entry_id)
+            if not bucket:
+                del self._by_fingerprint[entry["fingerprint"]]
+        self._pending_access.pop(entry_id, None)
+        self._pending_deletes.add(entry_id)
+
+    def _evict_overflow(self):
+        while len(self._entries) > self.max_entries:
+            oldest_id = next(iter(self._entries))
+            self._remove_entry(oldest_id)
+
+    def _flush_pending(self):
+        """Write batched access times and deletes to the mirror (caller holds the lock)."""
+        if self._pending_access:
+            self._conn.executemany(
+                "UPDATE answer_cache SET last_access = ? WHERE id = ?",
+                [(accessed, entry_id) for entry_id, accessed in self._pending_access.items()]
+            )
+        if self._pending_deletes:
+            self._conn.executemany("DELETE FROM answer_cache WHERE id = ?", [(i,) for i in self._pending_deletes])
+        self._conn.commit()
+        self._pending_access.clear()
+        self._pending_deletes.clear()
+        self._next_flush = time.monotonic() + self.FLUSH_INTERVAL_S
+
+    def _flush_if_due(self):
+        pending = len(self._pending_access) + len(self._pending_deletes)
+        if pending and (pending >= self.FLUSH_MAX_PENDING or time.monotonic() >= self._next_flush):
+            self._flush_pending()
+
+    def _load_fingerprint(self, fingerprint: str, now: float) -> bool:
+        """Pull in entries for `fingerprint` that other workers stored. Returns True if any were new."""
+        rows = self._conn.execute(
+            "SELECT id, embedding, result, latency_ms, created_at FROM answer_cache "
+            "WHERE fingerprint = ? AND created_at >= ?",
+            (fingerprint, now - self.ttl_seconds)
+        ).fetchall()
+        added = False
+        for entry_id, embedding, result, latency_ms, created_at in rows:
+            if entry_id in self._entries or entry_id in self._pending_deletes:
+                continue
+            self._add_entry(entry_id, fingerprint, np.frombuffer(embedding, dtype=np.float32),
+                            json.loads(result), latency_ms, created_at)
+            added = True
+        if added:
+            self._evict_overflow()
+        return added
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _best_match(self, query: np.ndarray, fingerprint: str, now: float):
+        best_id, best_score = None, self.threshold
+        for entry_id in list(self._by_fingerprint.get(fingerprint, ())):
+            entry = self._entries[entry_id]
+            if now - entry["created_at"] > self.ttl_seconds:
+                self._remove_entry(entry_id)
+                continue
+            score = float(np.dot(query, entry["vector"]))
+            if score >= best_score:
+                best_id, best_score = entry_id, score
+        return best_id, best_score
+
+    def get(self, embedding: List[float], fingerprint: str) -> Optional[dict]:
+        query = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            best_id, best_score = self._best_match(query, fingerprint, now)
+            if best_id is None and self._load_fingerprint(fingerprint, now):
+                best_id, best_score = self._best_match(query, fingerprint, now)
+
+            if best_id is None:
+                self.misses += 1
+                self._flush_if_due()
+                return None
+
+            self._entries.move_to_end(best_id)
+            self._pending_access[best_id] = now
+            self._flush_if_due()
+            entry = self._entries[best_id]
+            self.hits += 1
+            self.latency_saved_ms += entry["latency_ms"]
+            print(f"[Cache] Hit (similarity {best_score:.3f}), saved ~{entry['latency_ms']:.0f}ms")
+            return dict(entry["result"])
+
+    def put(self, embedding: List[float], fingerprint: str, result: dict, latency_ms: float):
+        vector = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO answer_cache (fingerprint, embedding, result, latency_ms, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (fingerprint, vector.tobytes(), json.dumps(result, ensure_ascii=False), latency_ms, now, now)
+            )
+            self._add_entry(cursor.lastrowid, fingerprint, vector, result, latency_ms, now)
+            self._evict_overflow()
+            self._flush_pending()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_fingerprint.clear()
+            self._pending_access.clear()
+            self._pending_deletes.clear()
+            self._conn.execute("DELETE FROM answer_cache")
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "latency_saved_ms": round(self.latency_saved_ms, 1),
+        }
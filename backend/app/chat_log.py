@@ -0,0 +1,164 @@
+from array import array
+from datetime import datetime, timedelta
+from typing import Dict, List
+import numpy as np
+from app.models import ChatMessage
+
+_EPOCH = datetime(1970, 1, 1)
+
+def to_micros(ts: datetime) -> int:
+    """Naive local datetime -> microseconds since epoch (aware values are converted to local time)."""
+    if ts.tzinfo is not None:
+        ts = ts.astimezone().replace(tzinfo=None)
+    return (ts - _EPOCH) // timedelta(microseconds=1)
+
+def from_micros(micros: int) -> datetime:
+    return _EPOCH + timedelta(microseconds=micros)
+
+class Interner:
+    """Maps repeated strings (topics, languages, teacher ids...) to small integer codes."""
+
+    def __init__(self):
+        self.codes: Dict[str, int] = {}
+        self.values: List[str] = []
+
+    def code(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+class TextBuffer:
+    """Append-only UTF-8 buffer with an offsets array; one bytearray instead of a str object per row."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array("Q", [0])
+
+    def append(self, text: str):
+        self.data += text.encode("utf-8")
+        self.offsets.append(len(self.data))
+
+    def __getitem__(self, i: int) -> str:
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
+
+    def nbytes(self) -> int:
+        return len(self.data) + self.offsets.itemsize * len(self.offsets)
+
+class ChatLog:
+    """
+    Columnar, append-only chat history.
+
+    Categorical fields are interned into uint32 code arrays, timestamps are an
+    int64 microsecond array and free text lives in append-only buffers, so a
+    row costs a few dozen bytes plus its text. Rows are addressed by position
+    and only turned into ChatMessage objects at the API boundary.
+    """
+
+    CATEGORICAL = ("session_id", "teacher_id", "detected_topic", "query_sentiment", "detected_language", "source_type")
+
+    def __init__(self):
+        self.interners: Dict[str, Interner] = {name: Interner() for name in self.CATEGORICAL}
+        self.codes: Dict[str, array] = {name: array("I") for name in self.CATEGORICAL}
+        self.timestamps = array("q")
+        self.ids = TextBuffer()
+        self.query_text = TextBuffer()
+        self.answer_text = TextBuffer()
+        self._snapshot: Dict[str, np.ndarray] = {}
+        self._snapshot_rows = 0
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def append(self, message: ChatMessage) -> int:
+        row = len(self.timestamps)
+        for name in self.CATEGORICAL:
+            self.codes[name].append(self.interners[name].code(getattr(message, name)))
+        self.timestamps.append(to_micros(message.timestamp))
+        self.ids.append(message.id)
+        self.query_text.append(message.query_text)
+        self.answer_text.append(message.answer_text)
+        return row
+
+    def value(self, name: str, row: int) -> str:
+        return self.interners[name].values[self.codes[name][row]]
+
+    def materialize(self, row: int) -> ChatMessage:
+        return ChatMessage(
+            id=self.ids[row],
+            query_text=self.query_text[row],
+            answer_text=self.answer_text[row],
+            timestamp=from_micros(self.timestamps[row]),
+            **{name: self.value(name, row) for name in self.CATEGORICAL}
+        )
+
+    def column_snapshot(self) -> Dict[str, np.ndarray]:
+        """
+        NumPy copies of the categorical and timestamp columns for analytics.
+        The log is append-only, so only rows added since the last call are copied.
+        Callers must hold the owning store's lock.
+        """
+        n = len(self.timestamps)
+        sources = [(name, self.codes[name], np.uint32) for name in self.CATEGORICAL]
+        sources.append(("timestamps", self.timestamps, np.int64))
+        if n > self._snapshot_rows or not self._snapshot:
+            done = self._snapshot_rows
+            for name, source, dtype in sources:
+                buf = self._snapshot.get(name)
+                if buf is None or len(buf) < n:
+                    grown = np.empty(max(n, 1024, 2 * len(buf) if buf is not None else 0), dtype=dtype)
+                    if buf is not None:
+                        grown[:done] = buf[:done]
+                    # Earlier snapshots keep referencing the old buffer, so they stay valid
+                    buf = self._snapshot[name] = grown
+                buf[done:n] = np.frombuffer(source[done:n].tobytes(), dtype=dtype)
+            self._snapshot_rows = n
+        return {name: buf[:n] for name, buf in self._snapshot.items()}
+
+    def nbytes(self) -> int:
+        column_bytes = sum(codes.itemsize * len(codes) for codes in self.codes.values())
+        column_bytes += self.timestamps.itemsize * len(self.timestamps)
+        return column_bytes + self.ids.nbytes() + self.query_text.nbytes() + self.answer_text.nbytes()
+
+    TEXT_COLUMNS = ("ids", "query_text", "answer_text")
+
+    def export(self, rows: int) -> dict:
+        """
+        Raw column bytes of the first `rows` rows, for a snapshot. The log is
+        append-only and every copy below is a single slice, so this needs no
+        lock as long as `rows` was read under the owning store's lock.
+        """
+        text = {}
+        for name in self.TEXT_COLUMNS:
+            buffer = getattr(self, name)
+            offsets = buffer.offsets[:rows + 1]
+            text[name] = (bytes(buffer.data[:offsets[-1]]), offsets.tobytes())
+        return {
+            "rows": rows,
+            "interners": {name: list(self.interners[name].values) for name in self.CATEGORICAL},
+            "codes": {name: self.codes[name][:rows].tobytes() for name in self.CATEGORICAL},
+            "timestamps": self.timestamps[:rows].tobytes(),
+            "text": text,
+        }
+
+    @classmethod
+    def restore(cls, state: dict) -> "ChatLog":
+        log = cls()
+        for name in cls.CATEGORICAL:
+            interner = log.interners[name]
+            for value in state["interners"][name]:
+                interner.code(value)
+            log.codes[name].frombytes(state["codes"][name])
+        log.timestamps.frombytes(state["timestamps"])
+        for name in cls.TEXT_COLUMNS:
+            data, offsets = state["text"][name]
+            buffer = getattr(log, name)
+            buffer.data = bytearray(data)
+            buffer.offsets = array("Q")
+            buffer.offsets.frombytes(offsets)
+        return log
@@ -0,0 +1,42 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
+from app.config import settings
+
+T = TypeVar("T")
+
+# Shared bounded pool for blocking client libraries (Supabase, Chroma, bcrypt).
+# Created lazily so importing this module never spawns threads.
+_executor: Optional[ThreadPoolExecutor] = None
+
+# Semaphores are created per event loop on first use.
+_semaphores: dict = {}
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.BLOCKING_IO_WORKERS,
+            thread_name_prefix="blocking-io"
+        )
+    return _executor
+
+def get_semaphore(name: str, limit: int) -> asyncio.Semaphore:
+    """Get a named semaphore bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    key = (id(loop), name)
+    if key not in _semaphores:
+        _semaphores[key] = asyncio.Semaphore(limit)
+    return _semaphores[key]
+
+async def run_blocking(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run a synchronous call on the shared pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
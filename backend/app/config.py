@@ -9,9 +9,79 @@ class Settings(BaseSettings):
 
     # Models
     LLM_MODEL: str = "llama-3.3-70b-versatile"
+    LLM_SMALL_MODEL: str = "llama-3.1-8b-instant"  # Small talk, short follow-ups and query classification
     STT_MODEL: str = "whisper-large-v3-turbo"
     EMBEDDING_MODEL: str = "all-MiniLM-L6-v2"
 
+    # Embedding backend: "huggingface" (torch, fp32) or "onnx" (onnxruntime, int8 quantized)
+    EMBEDDING_BACKEND: str = "huggingface"
+    ONNX_EMBEDDING_REPO: str = "Xenova/all-MiniLM-L6-v2"
+    ONNX_EMBEDDING_FILE: str = "onnx/model_quantized.onnx"
+    EMBEDDING_THREADS: int = 0  # onnxruntime intra-op threads (0 = library default)
+    EMBEDDING_BATCH_SIZE: int = 32  # Max concurrent queries per forward pass (1 disables batching)
+    EMBEDDING_BATCH_WAIT_MS: float = 2.0  # How long a query waits for others to join its batch
+
+    # Persistent BM25 index (memory-mapped segments under CHROMA_DB_DIR)
+    BM25_INDEX_DIRNAME: str = "bm25_index"
+    BM25_MERGE_FACTOR: int = 4  # Merge once this many segments of about the same size exist
+    RETRIEVER_INIT_RETRY_SECONDS: int = 30  # Empty corpus: how often a worker re-checks Chroma for chunks
+
+    # Query embedding / retrieval result caches
+    QUERY_CACHE_MAX_ENTRIES: int = 2048
+    QUERY_CACHE_TTL_SECONDS: int = 3600
+
+    # Concurrency limits (per worker process)
+    LLM_MAX_CONCURRENCY: int = 16  # In-flight Groq chat/STT requests
+    RETRIEVAL_MAX_CONCURRENCY: int = 4  # Concurrent embedding + hybrid searches
+    BLOCKING_IO_WORKERS: int = 32  # Thread pool for Supabase/Chroma/bcrypt calls
+
+    # Background PDF ingestion
+    INGEST_PROCESSES: int = 0  # Parser processes (0 = one per CPU)
+    INGEST_PAGES_PER_TASK: int = 8
+    INGEST_BATCH_SIZE: int = 128  # Chunks embedded + written per batch
+    INGEST_MAX_JOBS: int = 1  # Jobs running at once per worker; the rest wait queued
+    NEAR_DUPLICATE_MAX_DISTANCE: int = 3  # SimHash bits (of 64); chunks this close to a stored one are skipped and logged (-1 disables)
+
+    # Semantic answer cache (skips retrieval + LLM for near-identical questions)
+    ANSWER_CACHE_ENABLED: bool = True
+    ANSWER_CACHE_PATH: str = "./data/answer_cache.sqlite3"
+    ANSWER_CACHE_SIMILARITY: float = 0.95  # Cosine similarity needed for a hit
+    ANSWER_CACHE_TTL_SECONDS: int = 7 * 24 * 3600
+    ANSWER_CACHE_MAX_ENTRIES: int = 5000
+
+    # Model routing (see app/routing.py)
+    LLM_ROUTING: bool = True  # False sends every query to LLM_MODEL
+    ROUTE_SHORT_QUERY_WORDS: int = 6  # Follow-ups up to this many words with no topic of their own go to LLM_SMALL_MODEL
+    ROUTE_SMALLTALK_MAX_WORDS: int = 6  # Longest greeting/thanks that skips retrieval
+
+    # Prompt token budgets (estimated tokens per section of each LLM request)
+    PROMPT_CONTEXT_TOKENS: int = 900  # Retrieved NCERT chunks, after dedupe
+    PROMPT_HISTORY_TOKENS: int = 600  # Most recent turns, sent verbatim
+    PROMPT_MESSAGE_MAX_TOKENS: int = 250  # Cap per history message (long answers are clipped)
+    PROMPT_SUMMARY_TOKENS: int = 200  # Rolling summary of older turns
+
+    # Per-session state (conversation memory, WhatsApp login) shared by all workers
+    SESSION_STATE_BACKEND: str = "memory"  # "memory" (single worker) or "sqlite" (any number of workers on one host)
+    SESSION_STATE_PATH: str = "./data/session_state.sqlite3"
+    SESSION_STATE_TTL_SECONDS: int = 6 * 3600  # Idle time before a chat's memory is dropped
+    WHATSAPP_SESSION_TTL_SECONDS: int = 30 * 24 * 3600  # Idle time before a WhatsApp login expires
+    SESSION_STATE_MAX_ENTRIES: int = 10000  # In-process backend: LRU cap on sessions held
+    SESSION_STATE_MAX_BYTES: int = 64 * 1024 * 1024  # In-process backend: cap on serialized state
+    SESSION_STATE_SPILL_PATH: str = ""  # In-process backend: SQLite file for LRU-evicted sessions ("" drops them)
+
+    # Durability for the in-memory backend (used when Supabase is not configured)
+    MEMORY_DB_DIR: str = "./data/memory_db"  # WAL + snapshots; "" keeps everything in RAM only
+    MEMORY_DB_FSYNC_MS: int = 50  # Group-commit interval for the write-ahead log
+    MEMORY_DB_SNAPSHOT_EVERY: int = 10000  # WAL records between snapshots (bounds replay on restart)
+
+    # Write-behind chat persistence (answers are returned before the row is written)
+    CHAT_WRITE_BEHIND: bool = True
+    CHAT_WRITE_BATCH_SIZE: int = 50  # Rows per bulk insert
+    CHAT_WRITE_FLUSH_MS: int = 200  # Max time a row waits for its batch to fill
+    CHAT_WRITE_MAX_PENDING: int = 10000  # Queue bound; beyond it callers write inline
+    CHAT_DEAD_LETTER_PATH: str = "./data/chat_dead_letter.jsonl"  # Rows that failed every retry; re-tried while idle ("" drops them)
+    CHAT_DEAD_LETTER_MAX_ATTEMPTS: int = 5  # Dead-letter retries before a row moves to <path>.quarantine for manual replay
+
     # Supabase (Postgres)
     SUPABASE_URL: str = ""
     SUPABASE_SERVICE_ROLE_KEY: str = ""
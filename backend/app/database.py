@@ -1,10 +1,16 @@
-from typing import List, Optional, Dict
-from datetime import datetime
-from collections import Counter
+from typing import List, Optional, Dict, Tuple
+from datetime import datetime, timedelta
 from uuid import uuid4
 from app.config import settings
 from app.models import User, Teacher, ChatMessage, CRPAnalytics, UserRole
 from app.auth import get_password_hash
+from app.memory_store import InMemoryStore
+from app.store_journal import StoreJournal
+from app.chat_log import to_micros
+from app.pagination import Cursor
+from app.write_behind import WriteBehindQueue, DeadLetterFile
+from app.concurrency import run_blocking
+from app.analytics import AnalyticsFrame, aggregate_grouped_counts, compute_crp_analytics
 
 try:
     from supabase import create_client, Client
@@ -13,9 +19,8 @@ except Exception:
     Client = None
 
 # In-memory database (fallback when Supabase is not configured)
-users_db: Dict[str, User] = {}
-teachers_db: Dict[str, Teacher] = {}
-chat_history_db: List[ChatMessage] = []
+memory_store = InMemoryStore()
+store_journal: Optional[StoreJournal] = None
 
 supabase: Optional[Client] = None
 
@@ -31,28 +36,46 @@ def _get_supabase_client() -> Optional[Client]:
     return supabase
 
 # Initialize demo data
-def initialize_demo_data():
-    global users_db, teachers_db
+def open_memory_store():
+    """Recover the in-memory database from its WAL/snapshot and keep journaling it."""
+    global store_journal
+    if _supabase_enabled() or not settings.MEMORY_DB_DIR or store_journal is not None:
+        return
+    journal = StoreJournal(
+        settings.MEMORY_DB_DIR,
+        fsync_ms=settings.MEMORY_DB_FSYNC_MS,
+        snapshot_every=settings.MEMORY_DB_SNAPSHOT_EVERY
+    )
+    try:
+        journal.open(memory_store)
+    except RuntimeError as e:
+        # Multiple workers need Supabase; session state alone can be shared (SESSION_STATE_BACKEND)
+        print(f"[DB] In-memory database not persisted in this worker: {e}")
+        return
+    store_journal = journal
 
+def initialize_demo_data():
     if _supabase_enabled():
         return
+    if memory_store.users:
+        return  # Recovered from disk; re-seeding would reset the demo teachers' stats
     
     # Create CRP users
-    users_db["crp1"] = User(
+    memory_store.put_user(User(
         id="crp1",
         email="crp1@shiksha.com",
         name="Rajesh Kumar",
         role=UserRole.CRP,
         password_hash=get_password_hash("password123")
-    )
+    ))
     
-    users_db["crp2"] = User(
+    memory_store.put_user(User(
         id="crp2",
         email="crp2@shiksha.com",
         name="Priya Sharma",
         role=UserRole.CRP,
         password_hash=get_password_hash("password123")
-    )
+    ))
     
     # Create Teacher users and profiles
     teachers_data = [
@@ -64,17 +87,17 @@ def initialize_demo_data():
     
     for t in teachers_data:
         # Create user account
-        users_db[t["id"]] = User(
+        memory_store.put_user(User(
             id=t["id"],
             email=t["email"],
             name=t["name"],
             role=UserRole.TEACHER,
             password_hash=get_password_hash("teacher123"),
             crp_id=t["crp_id"]
-        )
+        ))
         
         # Create teacher profile
-        teachers_db[t["id"]] = Teacher(
+        memory_store.put_teacher(Teacher(
             id=t["id"],
             name=t["name"],
             email=t["email"],
@@ -82,7 +105,7 @@ def initialize_demo_data():
             subject=t["subject"],
             location=t["location"],
             crp_id=t["crp_id"]
-        )
+        ))
 
 # User operations
 def get_user_by_email(email: str) -> Optional[User]:
@@ -93,10 +116,7 @@ def get_user_by_email(email: str) -> Optional[User]:
             return User(**resp.data[0])
         return None
 
-    for user in users_db.values():
-        if user.email == email:
-            return user
-    return None
+    return memory_store.get_user_by_email(email)
 
 def get_user_by_id(user_id: str) -> Optional[User]:
     sb = _get_supabase_client()
@@ -106,7 +126,7 @@ def get_user_by_id(user_id: str) -> Optional[User]:
             return User(**resp.data[0])
         return None
 
-    return users_db.get(user_id)
+    return memory_store.users.get(user_id)
 
 # Teacher operations
 def get_teacher_by_id(teacher_id: str) -> Optional[Teacher]:
@@ -117,7 +137,7 @@ def get_teacher_by_id(teacher_id: str) -> Optional[Teacher]:
             return Teacher(**resp.data[0])
         return None
 
-    return teachers_db.get(teacher_id)
+    return memory_store.teachers.get(teacher_id)
 
 def create_user(email: str, password: str, name: str, role: str, **kwargs) -> User:
     """Create a new user in the database"""
@@ -165,11 +185,11 @@ def create_user(email: str, password: str, name: str, role: str, **kwargs) -> Us
             sb.table("teachers").insert(teacher_data).execute()
     else:
         # Store in memory
-        users_db[user_id] = user
+        memory_store.put_user(user)
         
         # If teacher, create teacher profile
         if role == "teacher":
-            teachers_db[user_id] = Teacher(
+            memory_store.put_teacher(Teacher(
                 id=user_id,
                 name=name,
                 email=email,
@@ -179,7 +199,7 @@ def create_user(email: str, password: str, name: str, role: str, **kwargs) -> Us
                 location=kwargs.get("location") or "",
                 crp_id=kwargs.get("crp_id") or "",
                 total_queries=0
-            )
+            ))
     
     return user
 
@@ -189,7 +209,7 @@ def get_teachers_by_crp(crp_id: str) -> List[Teacher]:
         resp = sb.table("teachers").select("*").eq("crp_id", crp_id).execute()
         return [Teacher(**t) for t in (resp.data or [])]
 
-    return [t for t in teachers_db.values() if t.crp_id == crp_id]
+    return memory_store.teachers_for_crp(crp_id)
 
 def get_all_crps() -> List[User]:
     """Get all CRP users for dropdown selection"""
@@ -198,139 +218,291 @@ def get_all_crps() -> List[User]:
         resp = sb.table("users").select("id, name, email").eq("role", "crp").execute()
         return [User(**u, password_hash="", role=UserRole.CRP) for u in (resp.data or [])]
     
-    return [u for u in users_db.values() if u.role == UserRole.CRP]
+    return memory_store.users_with_role(UserRole.CRP)
 
 # Chat operations
+# Flipped off if save_chat_message_migration.sql has not been applied yet
+_save_rpc_available = True
+
 def save_chat_message(message: ChatMessage):
+    global _save_rpc_available
     sb = _get_supabase_client()
     if sb:
         payload = message.dict()
         payload["timestamp"] = message.timestamp.isoformat()
-        sb.table("chat_history").insert(payload).execute()
+        if _save_rpc_available:
+            # Insert + atomic teacher counter increment in a single round trip
+            try:
+                sb.rpc("save_chat_message", {"p_message": payload}).execute()
+                return
+            except Exception as e:
+                if "PGRST202" not in str(e):  # Anything but "function not found" is a real failure
+                    raise
+                _save_rpc_available = False
+                print("[DB] save_chat_message RPC missing; falling back to insert + update (non-atomic)")
+
+        # Idempotent: a retried write must neither fail on the existing row nor count it twice
+        resp = sb.table("chat_history").upsert(payload, on_conflict="id", ignore_duplicates=True).execute()
+        if not resp.data:
+            return  # Saved by an earlier attempt
 
         # Update teacher stats
-        teacher_resp = sb.table("teachers").select("total_queries").eq("id", message.teacher_id).limit(1).execute()
+        teacher_resp = sb.table("teachers").select("total_queries, last_active").eq(
+            "id", message.teacher_id
+        ).limit(1).execute()
         current_total = 0
+        last_active = message.timestamp
         if teacher_resp.data:
             current_total = teacher_resp.data[0].get("total_queries") or 0
+            stored = teacher_resp.data[0].get("last_active")
+            # Keep the later time: a delayed or replayed write is not new activity
+            if stored and datetime.fromisoformat(stored).replace(tzinfo=None) > last_active:
+                last_active = datetime.fromisoformat(stored).replace(tzinfo=None)
         sb.table("teachers").update({
             "total_queries": current_total + 1,
-            "last_active": datetime.now().isoformat()
+            "last_active": last_active.isoformat()
         }).eq("id", message.teacher_id).execute()
         return
 
-    chat_history_db.append(message)
-    
-    # Update teacher stats
-    teacher = teachers_db.get(message.teacher_id)
-    if teacher:
-        teacher.total_queries += 1
-        teacher.last_active = datetime.now()
+    # Updates the teacher's total_queries / last_active under the store lock
+    memory_store.add_message(message)
+
+_save_batch_rpc_available = True
+
+def save_chat_messages(messages: List[ChatMessage]):
+    """Bulk save used by the write-behind queue: one round trip per batch with the batch RPC."""
+    global _save_batch_rpc_available
+    sb = _get_supabase_client()
+    if sb and _save_batch_rpc_available:
+        payload = []
+        for message in messages:
+            row = message.dict()
+            row["timestamp"] = message.timestamp.isoformat()
+            payload.append(row)
+        try:
+            sb.rpc("save_chat_messages", {"p_messages": payload}).execute()
+            return
+        except Exception as e:
+            if "PGRST202" not in str(e):
+                raise
+            _save_batch_rpc_available = False
+            print("[DB] save_chat_messages RPC missing (chat_write_batch_migration.sql); saving rows one by one")
+
+    for message in messages:
+        save_chat_message(message)
+
+# Chat rows are persisted off the response path, in batches
+chat_writer = WriteBehindQueue(
+    save_chat_messages,
+    batch_size=settings.CHAT_WRITE_BATCH_SIZE,
+    flush_ms=settings.CHAT_WRITE_FLUSH_MS,
+    max_pending=settings.CHAT_WRITE_MAX_PENDING,
+    name="chat-writer",
+    dead_letter=DeadLetterFile(
+        settings.CHAT_DEAD_LETTER_PATH,
+        encode=lambda message: message.dict(),
+        decode=lambda row: ChatMessage(**row),
+        max_attempts=settings.CHAT_DEAD_LETTER_MAX_ATTEMPTS
+    ) if settings.CHAT_DEAD_LETTER_PATH else None
+)
+
+async def persist_chat_message(message: ChatMessage):
+    """Queue a chat row for write-behind; writes inline when disabled or the queue is full."""
+    if settings.CHAT_WRITE_BEHIND and chat_writer.submit(message):
+        return
+    await run_blocking(save_chat_message, message)
+
+def get_chat_write_stats() -> dict:
+    return chat_writer.stats()
+
+def get_store_journal_stats() -> Optional[dict]:
+    return store_journal.stats() if store_journal is not None else None
+
+def close_database():
+    """Flush queued chat rows, then checkpoint the in-memory database."""
+    chat_writer.close()
+    if store_journal is not None:
+        store_journal.close()
+
+def _keyset(query, before: Optional[Cursor], ts_column: str = "timestamp", key_column: str = "id"):
+    """Newest-first ordering on (timestamp, id), resuming strictly after the `before` position."""
+    if before is not None:
+        ts, key = before[0].isoformat(), before[1]
+        query = query.or_(
+            f'{ts_column}.lt."{ts}",and({ts_column}.eq."{ts}",{key_column}.lt."{key}")'
+        )
+    return query.order(ts_column, desc=True).order(key_column, desc=True)
 
-def get_teacher_chat_history(teacher_id: str, limit: int = 50) -> List[ChatMessage]:
+def get_teacher_chat_history(teacher_id: str, limit: int = 50, before: Optional[Cursor] = None) -> List[ChatMessage]:
+    """Newest first; pass the last row's (timestamp, id) as `before` for the next page."""
     sb = _get_supabase_client()
     if sb:
-        resp = sb.table("chat_history").select("*").eq("teacher_id", teacher_id).order("timestamp", desc=True).limit(limit).execute()
+        query = sb.table("chat_history").select("*").eq("teacher_id", teacher_id)
+        resp = _keyset(query, before).limit(limit).execute()
         return [ChatMessage(**row) for row in (resp.data or [])]
 
-    teacher_chats = [msg for msg in chat_history_db if msg.teacher_id == teacher_id]
-def get_teacher_sessions(teacher_id: str):
-    """Get all chat sessions grouped by session_id"""
+    return memory_store.teacher_messages(teacher_id, limit, before)
+
+def get_teacher_session_summaries(teacher_id: str, limit: int = 50, before: Optional[Cursor] = None) -> List[dict]:
+    """
+    Lightweight session list (first query, time span, message count), most
+    recently active first and keyset-paginated on (last_timestamp, session_id).
+    """
+    sb = _get_supabase_client()
+    if sb:
+        # Grouped in Postgres by the chat_sessions view (see chat_sessions_migration.sql)
+        query = sb.table("chat_sessions").select(
+            "session_id, first_query, started_at, last_timestamp, message_count"
+        ).eq("teacher_id", teacher_id)
+        resp = _keyset(query, before, ts_column="last_timestamp", key_column="session_id").limit(limit).execute()
+        return resp.data or []
+
+    summaries = memory_store.session_summaries(teacher_id)
+    summaries.sort(key=lambda s: (s["last_timestamp"], s["session_id"]), reverse=True)
+    if before is not None:
+        position = (to_micros(before[0]), before[1])
+        summaries = [s for s in summaries if (to_micros(s["last_timestamp"]), s["session_id"]) < position]
+    return summaries[:limit]
+
+def get_session_messages(teacher_id: str, session_id: str, limit: Optional[int] = None) -> List[ChatMessage]:
+    """
+    One session's messages in conversation order (empty if it is not this teacher's).
+    With `limit`, only the newest `limit` messages (still oldest first). Rows
+    still waiting in the write-behind queue are included, so an exchange is
+    visible as soon as it has been answered.
+    """
     sb = _get_supabase_client()
-    
     if sb:
-        # Get all messages for this teacher
-        resp = sb.table("chat_history").select("*").eq("teacher_id", teacher_id).order("timestamp", desc=False).execute()
-        messages = resp.data or []
+        query = sb.table("chat_history").select("*").eq("teacher_id", teacher_id).eq("session_id", session_id)
+        if limit is not None:
+            resp = query.order("timestamp", desc=True).order("id", desc=True).limit(limit).execute()
+            messages = [ChatMessage(**row) for row in reversed(resp.data or [])]
+        else:
+            resp = query.order("timestamp", desc=False).order("id", desc=False).execute()
+            messages = [ChatMessage(**row) for row in (resp.data or [])]
     else:
-        messages = [msg.dict() for msg in chat_history_db if msg.teacher_id == teacher_id]
-    
-    # Group by session_id
-    sessions = {}
-    for msg in messages:
-        session_id = msg.get("session_id", msg.get("id"))  # fallback to id for old messages
-        if session_id not in sessions:
-            sessions[session_id] = {
-                "session_id": session_id,
-                "messages": [],
-                "first_query": msg.get("query_text", ""),
-                "timestamp": msg.get("timestamp")
-            }
-        sessions[session_id]["messages"].append(msg)
-    
-    # Convert to list and sort by most recent
-    session_list = list(sessions.values())
-    session_list.sort(key=lambda x: x["timestamp"], reverse=True)
-    
-    return session_list
-
-def get_crp_chat_history(crp_id: str, limit: int = 100) -> List[ChatMessage]:
+        messages = [msg for msg in memory_store.session_messages(session_id, limit) if msg.teacher_id == teacher_id]
+
+    pending = chat_writer.pending(lambda msg: msg.session_id == session_id and msg.teacher_id == teacher_id)
+    if pending:
+        saved = {msg.id for msg in messages}
+        messages = sorted(messages + [msg for msg in pending if msg.id not in saved], key=lambda msg: (msg.timestamp, msg.id))
+        if limit is not None:
+            messages = messages[-limit:]
+    return messages
+
+def get_crp_chat_history(crp_id: str, limit: int = 100, before: Optional[Cursor] = None) -> List[ChatMessage]:
+    return [msg for msg, _ in get_crp_chat_history_with_names(crp_id, limit, before)]
+
+def get_crp_chat_history_with_names(
+    crp_id: str, limit: int = 100, before: Optional[Cursor] = None
+) -> List[Tuple[ChatMessage, str]]:
+    """CRP chat history joined with teacher names: two queries total, however many messages."""
     sb = _get_supabase_client()
     if sb:
-        teachers_resp = sb.table("teachers").select("id").eq("crp_id", crp_id).execute()
-        teacher_ids = [t["id"] for t in (teachers_resp.data or [])]
-        if not teacher_ids:
+        teachers_resp = sb.table("teachers").select("id, name").eq("crp_id", crp_id).execute()
+        names = {t["id"]: t["name"] for t in (teachers_resp.data or [])}
+        if not names:
             return []
-        resp = sb.table("chat_history").select("*").in_("teacher_id", teacher_ids).order("timestamp", desc=True).limit(limit).execute()
-        return [ChatMessage(**row) for row in (resp.data or [])]
-
-    # Get all teachers under this CRP
-    teacher_ids = [t.id for t in teachers_db.values() if t.crp_id == crp_id]
-    
-    # Get chats for these teachers
-    crp_chats = [msg for msg in chat_history_db if msg.teacher_id in teacher_ids]
-    return sorted(crp_chats, key=lambda x: x.timestamp, reverse=True)[:limit]
-
-def get_crp_analytics(crp_id: str) -> CRPAnalytics:
+        query = sb.table("chat_history").select("*").in_("teacher_id", list(names))
+        resp = _keyset(query, before).limit(limit).execute()
+        return [(ChatMessage(**row), names.get(row["teacher_id"], "Unknown")) for row in (resp.data or [])]
+
+    names = {t.id: t.name for t in memory_store.teachers_for_crp(crp_id)}
+    return [(msg, names.get(msg.teacher_id, "Unknown")) for msg in memory_store.crp_messages(crp_id, limit, before)]
+
+_analytics_rpc_available = True
+
+def _supabase_crp_analytics(sb, teacher_ids: List[str], start, end, per_teacher: bool) -> dict:
+    global _analytics_rpc_available
+    today_start = datetime.combine(datetime.now().date(), datetime.min.time())
+    # Grouped counts are computed in Postgres (see crp_analytics_migration.sql)
+    if _analytics_rpc_available:
+        params = {
+            "p_teacher_ids": teacher_ids,
+            "p_start": start.isoformat() if start else None,
+            "p_end": end.isoformat() if end else None,
+            "p_today_start": today_start.isoformat(),
+            "p_per_teacher": per_teacher,
+        }
+        try:
+            # PostgREST caps a response at max-rows (1000 by default); page until a short page
+            rows, page_size = [], 1000
+            while True:
+                page = sb.rpc("crp_analytics_counts", params).range(len(rows), len(rows) + page_size - 1).execute()
+                rows.extend(page.data or [])
+                if len(page.data or []) < page_size:
+                    break
+            return aggregate_grouped_counts(rows, per_teacher=per_teacher)
+        except Exception as e:
+            if "PGRST202" not in str(e):  # Anything but "function not found" is a real failure
+                raise
+            _analytics_rpc_available = False
+            print("[Analytics] crp_analytics_counts RPC missing (crp_analytics_migration.sql); aggregating in Python")
+
+    # Only the columns the counts need - never the answer text
+    query = sb.table("chat_history").select(
+        "teacher_id, detected_topic, query_sentiment, detected_language, timestamp"
+    ).in_("teacher_id", teacher_ids)
+    # The window still has to include today for the "today" counters
+    if start is not None:
+        query = query.gte("timestamp", min(start, today_start).isoformat())
+    if end is not None:
+        query = query.lt("timestamp", max(end, today_start + timedelta(days=1)).isoformat())
+    frame = AnalyticsFrame.from_rows(query.execute().data or [])
+    return compute_crp_analytics(frame, teacher_ids, start=start, end=end, per_teacher=per_teacher)
+
+def get_crp_analytics(
+    crp_id: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    per_teacher: bool = False
+) -> CRPAnalytics:
     teachers = get_teachers_by_crp(crp_id)
     teacher_ids = [t.id for t in teachers]
 
+    if not teacher_ids:
+        return CRPAnalytics(
+            crp_id=crp_id,
+            total_teachers=0,
+            active_teachers_today=0,
+            total_queries_today=0,
+            top_topics=[],
+            sentiment_distribution={},
+            language_distribution={}
+        )
+
     sb = _get_supabase_client()
     if sb:
-        if not teacher_ids:
-            return CRPAnalytics(
-                crp_id=crp_id,
-                total_teachers=0,
-                active_teachers_today=0,
-                total_queries_today=0,
-                top_topics=[],
-                sentiment_distribution={},
-                language_distribution={}
-            )
-
-        chats_resp = sb.table("chat_history").select("*").in_("teacher_id", teacher_ids).execute()
-        all_chats = [ChatMessage(**row) for row in (chats_resp.data or [])]
+        stats = _supabase_crp_analytics(sb, teacher_ids, start, end, per_teacher)
+    elif start is None and end is None:
+        # Default dashboard: read the incrementally maintained rollups
+        stats = memory_store.rollups.read(crp_id, per_teacher=per_teacher)
     else:
-        all_chats = [msg for msg in chat_history_db if msg.teacher_id in teacher_ids]
-
-    # Get today's chats
-    today = datetime.now().date()
-    today_chats = [msg for msg in all_chats if msg.timestamp.date() == today]
-
-    # Active teachers today
-    active_teacher_ids = set(msg.teacher_id for msg in today_chats)
-
-    # Topic distribution
-    topics = Counter(msg.detected_topic for msg in all_chats)
-    top_topics = [{"topic": topic, "count": count} for topic, count in topics.most_common(5)]
-
-    # Sentiment distribution
-    sentiments = Counter(msg.query_sentiment for msg in all_chats)
-    sentiment_dist = dict(sentiments)
-
-    # Language distribution
-    languages = Counter(msg.detected_language for msg in all_chats)
-    language_dist = dict(languages)
+        stats = compute_crp_analytics(
+            memory_store.analytics_frame(), teacher_ids, start=start, end=end, per_teacher=per_teacher
+        )
 
     return CRPAnalytics(
         crp_id=crp_id,
         total_teachers=len(teachers),
-        active_teachers_today=len(active_teacher_ids),
-        total_queries_today=len(today_chats),
-        top_topics=top_topics,
-        sentiment_distribution=sentiment_dist,
-        language_distribution=language_dist
+        active_teachers_today=stats["active_teachers_today"],
+        total_queries_today=stats["total_queries_today"],
+        top_topics=stats["top_topics"],
+        sentiment_distribution=stats["query_sentiment"],
+        language_distribution=stats["detected_language"],
+        total_queries=stats["total_queries"],
+        start=start,
+        end=end,
+        teacher_breakdown=stats.get("teacher_breakdown")
     )
 
+def rebuild_analytics_rollups() -> dict:
+    """Recompute analytics rollups from chat history (in-memory backend) as a consistency check."""
+    if _get_supabase_client():
+        return {"consistent": True, "messages": None, "detail": "Supabase analytics are aggregated in the database"}
+    return memory_store.rebuild_rollups()
+
 # Initialize on import
+open_memory_store()
 initialize_demo_data()
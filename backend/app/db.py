@@ -1,15 +1,25 @@
 from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.retrievers import BM25Retriever
 from langchain_classic.retrievers import EnsembleRetriever
 from langchain_core.documents import Document
 from app.config import settings
-from difflib import SequenceMatcher
-import re
+from app.concurrency import run_blocking, get_semaphore
+from app.sparse_index import BM25Index, BM25IndexRetriever, TrigramVocabulary, tokenize
+from app.embeddings import CachedEmbeddings, MicroBatchingEmbeddings, create_embeddings, normalize_query
+from app.lru_cache import LRUCache
+from app.dedup import NearDuplicateIndex, content_id, simhash
+import os
+import threading
+import time
 
 ensemble_retriever = None
 
-embedding_function = HuggingFaceEmbeddings(model_name=settings.EMBEDDING_MODEL)
+embedding_cache = LRUCache(settings.QUERY_CACHE_MAX_ENTRIES, settings.QUERY_CACHE_TTL_SECONDS)
+base_embeddings = create_embeddings()
+embedding_function = CachedEmbeddings(base_embeddings, embedding_cache)
+
+# Normalized query -> ranked chunks; cleared whenever the indexed corpus changes
+retrieval_cache = LRUCache(settings.QUERY_CACHE_MAX_ENTRIES, settings.QUERY_CACHE_TTL_SECONDS)
+_retrieval_cache_version = None
 
 
 vector_db = Chroma(
@@ -18,71 +28,231 @@ vector_db = Chroma(
     collection_name="ncert_pedagogy"
 )
 
-def initialize_retriever():
+# Sparse side of the hybrid search: memory-mapped segments shared by all workers
+bm25_index = BM25Index(
+    os.path.join(settings.CHROMA_DB_DIR, settings.BM25_INDEX_DIRNAME),
+    merge_factor=settings.BM25_MERGE_FACTOR
+)
+
+def _build_ensemble():
     global ensemble_retriever
-    
-    existing_docs = vector_db.get() 
-    
-    doc_objects = []
-    if existing_docs['documents']:
-        for i, text in enumerate(existing_docs['documents']):
+    bm25_retriever = BM25IndexRetriever(index=bm25_index, k=3, rewrite=_correct_for_bm25)
+    chroma_retriever = vector_db.as_retriever(search_kwargs={"k": 3})
+    ensemble_retriever = EnsembleRetriever(
+        retrievers=[bm25_retriever, chroma_retriever],
+        weights=[0.5, 0.5]
+    )
 
-            meta = existing_docs['metadatas'][i] if existing_docs['metadatas'] else {}
-            doc_objects.append(Document(page_content=text, metadata=meta))
+def _load_all_chunks():
+    existing_docs = vector_db.get()
+    metadatas = existing_docs['metadatas'] or [{} for _ in existing_docs['documents']]
+    return existing_docs['ids'], existing_docs['documents'], metadatas
 
-    if not doc_objects:
+def initialize_retriever():
+    chunk_count = len(vector_db.get(include=[])['ids'])
+    
+    if not chunk_count:
         print("Warning: Database is empty. Hybrid search will return nothing until data is ingested.")
-        ensemble_retriever = None
         return
 
-    bm25_retriever = BM25Retriever.from_documents(doc_objects)
-    bm25_retriever.k = 3
+    # Normally just maps the persisted index; rebuilds only if it is missing or out of sync with Chroma
+    if bm25_index.sync(chunk_count, _load_all_chunks):
+        print(f"[BM25] Rebuilt persisted index from Chroma ({chunk_count} chunks)")
 
-    chroma_retriever = vector_db.as_retriever(search_kwargs={"k": 3})
-    ensemble_retriever = EnsembleRetriever(
-        retrievers=[bm25_retriever, chroma_retriever],
-        weights=[0.5, 0.5]
-    )
+    _build_ensemble()
     print("Hybrid Retriever Initialized!")
 
-def search_ncert(query_text: str):
-    if not ensemble_retriever:
+_retriever_lock = threading.Lock()
+_retriever_retry_at = 0.0
+
+def _ensure_retriever() -> bool:
+    """
+    Build the ensemble once there is something to search. A worker that
+    started on an empty corpus picks up chunks ingested by another process:
+    the shared BM25 index is checked on every call, and Chroma is re-synced
+    at most every RETRIEVER_INIT_RETRY_SECONDS.
+    """
+    global _retriever_retry_at
+    if ensemble_retriever is not None:
+        return True
+    with _retriever_lock:
+        if ensemble_retriever is not None:
+            return True
+        if len(bm25_index):
+            _build_ensemble()
+            print("Hybrid Retriever Initialized (corpus ingested by another worker)")
+            return True
+        now = time.monotonic()
+        if now < _retriever_retry_at:
+            return False
+        _retriever_retry_at = now + settings.RETRIEVER_INIT_RETRY_SECONDS
         initialize_retriever()
-        if not ensemble_retriever: return []
+        return ensemble_retriever is not None
+
+_vocabulary = None
+_vocabulary_version = None
+
+def get_vocabulary() -> TrigramVocabulary:
+    """Trigram index over the BM25 vocabulary, rebuilt lazily when the corpus changes."""
+    global _vocabulary, _vocabulary_version
+    bm25_index.refresh()
+    if _vocabulary is None or _vocabulary_version != bm25_index.version:
+        _vocabulary_version = bm25_index.version
+        _vocabulary = TrigramVocabulary(bm25_index.vocabulary)
+    return _vocabulary
+
+def _correct_for_bm25(query_text: str) -> str:
+    """
+    Misspelled terms score zero in BM25, so the sparse side searches their
+    closest indexed spelling. The dense side keeps the teacher's own text.
+    Queries whose terms are all indexed pass through untouched, without
+    building or consulting the trigram vocabulary.
+    """
+    if all(len(term) < 4 or bm25_index.has_term(term) for term in tokenize(query_text)):
+        return query_text
+    corrected, corrections = get_vocabulary().correct(query_text)
+    if not corrections:
+        return query_text
+    print(f"[RAG] Fuzzy-corrected terms for BM25: {corrections}")
+    return corrected
+
+def is_indexed_term(term: str) -> bool:
+    """True if `term` (a tokenize() token) occurs in the NCERT corpus."""
+    return bm25_index.has_term(term)
+
+def _cached_retrieval(cache_key: str):
+    global _retrieval_cache_version
+    bm25_index.refresh()
+    if _retrieval_cache_version != bm25_index.version:
+        retrieval_cache.clear()
+        _retrieval_cache_version = bm25_index.version
+    return retrieval_cache.get(cache_key)
+
+def search_ncert(query_text: str):
+    if not _ensure_retriever():
+        return []
+    
+    cache_key = normalize_query(query_text)
+    cached = _cached_retrieval(cache_key)
+    if cached is not None:
+        print(f"[RAG] Retrieval cache hit: {query_text}")
+        return [text for _, text in cached]
     
     print(f"[RAG] Original query: {query_text}")
     
-    # Try primary search first
+    # BM25 corrects misspellings itself (see _correct_for_bm25); embeddings see the original text
     docs = ensemble_retriever.invoke(query_text)
     
-    # If no results found, try fuzzy matching on key words
-    if not docs or len(docs) == 0:
-        print(f"[RAG] No results found. Attempting fuzzy matching...")
-        # Extract key words (longer words, likely nouns/important terms)
-        words = query_text.lower().split()
-        key_words = [w for w in words if len(w) > 3]
-        
-        if key_words:
-            # Try searching with each keyword individually
-            for keyword in key_words:
-                print(f"[RAG] Trying fuzzy search with keyword: {keyword}")
-                docs = ensemble_retriever.invoke(keyword)
-                if docs:
-                    print(f"[RAG] Found {len(docs)} results with keyword '{keyword}'")
-                    break
-    
     result = [d.page_content for d in docs] if docs else []
+    retrieval_cache.put(cache_key, [(d.id, d.page_content) for d in docs or []])
     print(f"[RAG] Final results: {len(result)} documents found")
     return result
 
-def insert_documents(texts: list, metadatas: list):
-    docs = [Document(page_content=t, metadata=m) for t, m in zip(texts, metadatas)]
-    
-    vector_db.add_documents(docs)
+def embed_query(query_text: str):
+    return embedding_function.embed_query(query_text)
+
+async def asearch_ncert(query_text: str):
+    """Async wrapper: runs the hybrid search on the blocking pool, bounded by RETRIEVAL_MAX_CONCURRENCY."""
+    async with get_semaphore("retrieval", settings.RETRIEVAL_MAX_CONCURRENCY):
+        return await run_blocking(search_ncert, query_text)
+
+# SimHash index of stored chunks, synced lazily from Chroma on the ingest path
+near_duplicates = NearDuplicateIndex(settings.NEAR_DUPLICATE_MAX_DISTANCE)
+_near_duplicates_version = None
+_insert_lock = threading.Lock()
+
+def _sync_near_duplicates():
+    global _near_duplicates_version
+    bm25_index.refresh()
+    if _near_duplicates_version is not None and _near_duplicates_version == bm25_index.version:
+        return
+    near_duplicates.clear()
+    existing_docs = vector_db.get(include=["documents", "metadatas"])
+    metadatas = existing_docs['metadatas'] or [{} for _ in existing_docs['ids']]
+    near_duplicates.add_many(
+        (chunk_id, int(meta["simhash"], 16) if (meta or {}).get("simhash") else simhash(text))
+        for chunk_id, text, meta in zip(existing_docs['ids'], existing_docs['documents'], metadatas)
+    )
+    _near_duplicates_version = bm25_index.version
+
+def insert_documents(texts: list, metadatas: list) -> dict:
+    """
+    Insert chunks under content-hash IDs. Exact repeats (same normalized text) and
+    near-duplicates (SimHash within NEAR_DUPLICATE_MAX_DISTANCE bits) are skipped,
+    so re-ingesting a book or an overlapping edition does not grow the corpus.
+    """
+    global _near_duplicates_version
+    report = {"added": 0, "skipped_duplicates": 0, "skipped_near_duplicates": 0}
+    if not texts:
+        return report
     
-    initialize_retriever()
+    with _insert_lock:
+        check_near = settings.NEAR_DUPLICATE_MAX_DISTANCE >= 0
+        if check_near:
+            _sync_near_duplicates()
+        
+        ids = [content_id(t) for t in texts]
+        seen = set(vector_db.get(ids=list(set(ids)), include=[])['ids'])
+        new_ids, new_texts, new_metadatas = [], [], []
+        try:
+            for chunk_id, text, meta in zip(ids, texts, metadatas):
+                if chunk_id in seen:
+                    report["skipped_duplicates"] += 1
+                    continue
+                seen.add(chunk_id)
+                fingerprint = simhash(text)
+                if check_near:
+                    match = near_duplicates.find(fingerprint)
+                    if match is not None:
+                        report["skipped_near_duplicates"] += 1
+                        print(f"[Ingest] Near-duplicate skipped: {chunk_id} ({meta.get('source')} "
+                              f"p.{meta.get('page')}) matches stored chunk {match}")
+                        continue
+                    near_duplicates.add(chunk_id, fingerprint)
+                new_ids.append(chunk_id)
+                new_texts.append(text)
+                new_metadatas.append({**meta, "simhash": f"{fingerprint:016x}"})
+            
+            if new_ids:
+                docs = [Document(page_content=t, metadata=m) for t, m in zip(new_texts, new_metadatas)]
+                vector_db.add_documents(docs, ids=new_ids)
+                
+                # Only the new chunks are indexed; existing postings are untouched
+                bm25_index.add_documents(new_ids, new_texts, new_metadatas)
+                retrieval_cache.clear()
+                if ensemble_retriever is None:
+                    _build_ensemble()
+            _near_duplicates_version = bm25_index.version
+        except Exception:
+            # Index may hold fingerprints that never made it into Chroma - rebuild next time
+            _near_duplicates_version = None
+            raise
     
-    return len(texts)
+    report["added"] = len(new_ids)
+    if report["skipped_duplicates"] or report["skipped_near_duplicates"]:
+        print(f"[Ingest] Skipped {report['skipped_duplicates']} duplicate and "
+              f"{report['skipped_near_duplicates']} near-duplicate chunks")
+    return report
+
+def delete_documents_by_source(source: str) -> int:
+    """Remove every chunk ingested from a given file (e.g. an outdated textbook edition)."""
+    global _near_duplicates_version
+    removed_ids = bm25_index.remove_source(source)
+    chroma_ids = vector_db.get(where={"source": source})["ids"]
+    if chroma_ids:
+        vector_db.delete(ids=chroma_ids)
+    retrieval_cache.clear()
+    _near_duplicates_version = None
+    return max(len(removed_ids), len(chroma_ids))
+
+def get_query_cache_stats() -> dict:
+    stats = {
+        "embedding_cache": embedding_cache.stats(),
+        "retrieval_cache": retrieval_cache.stats(),
+    }
+    if isinstance(base_embeddings, MicroBatchingEmbeddings):
+        stats["embedding_batches"] = base_embeddings.stats()
+    return stats
 
 def get_teacher_profile(teacher_id: str):
     return {
@@ -0,0 +1,72 @@
+import hashlib
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+from app.sparse_index import tokenize
+
+SIMHASH_BITS = 64
+
+def normalize_text(text: str) -> str:
+    return " ".join(tokenize(text))
+
+def content_id(text: str) -> str:
+    """Stable chunk ID derived from normalized text, so re-ingesting the same chunk is a no-op."""
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()[:32]
+
+def simhash(text: str, shingle_size: int = 3) -> int:
+    tokens = tokenize(text)
+    if len(tokens) < shingle_size:
+        shingles = [" ".join(tokens)]
+    else:
+        shingles = [" ".join(tokens[i:i + shingle_size]) for i in range(len(tokens) - shingle_size + 1)]
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little") for s in shingles],
+        dtype=np.uint64
+    )
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 - len(shingles)
+    return int(np.packbits(votes > 0, bitorder="little").view(np.uint64)[0])
+
+class NearDuplicateIndex:
+    """SimHash index: finds stored chunks within `max_distance` bits of a new chunk."""
+
+    def __init__(self, max_distance: int = 3):
+        self.max_distance = max_distance
+        # Split into max_distance + 1 bands: two fingerprints within max_distance
+        # bits must agree on at least one band (pigeonhole), so bands are exact buckets
+        self._band_count = min(max(max_distance, 0) + 1, SIMHASH_BITS)
+        self._band_width = SIMHASH_BITS // self._band_count
+        self._lock = threading.Lock()
+        self._fingerprints: Dict[str, int] = {}
+        self._buckets: Dict[Tuple[int, int], Set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._fingerprints)
+
+    def _bands(self, fingerprint: int) -> List[Tuple[int, int]]:
+        width = self._band_width
+        mask = (1 << width) - 1
+        return [(band, (fingerprint >> (band * width)) & mask) for band in range(self._band_count)]
+
+    def add(self, chunk_id: str, fingerprint: int):
+        with self._lock:
+            self._fingerprints[chunk_id] = fingerprint
+            for key in self._bands(fingerprint):
+                self._buckets.setdefault(key, set()).add(chunk_id)
+
+    def add_many(self, items: Iterable[Tuple[str, int]]):
+        for chunk_id, fingerprint in items:
+            self.add(chunk_id, fingerprint)
+
+    def find(self, fingerprint: int) -> Optional[str]:
+        with self._lock:
+            for key in self._bands(fingerprint):
+                for chunk_id in self._buckets.get(key, ()):
+                    if bin(fingerprint ^ self._fingerprints[chunk_id]).count("1") <= self.max_distance:
+                        return chunk_id
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._fingerprints.clear()
+            self._buckets.clear()
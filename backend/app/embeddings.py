@@ -0,0 +1,161 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from app.config import settings
+from app.lru_cache import LRUCache
+from app.sparse_index import tokenize
+
+def normalize_query(text: str) -> str:
+    return " ".join(tokenize(text))
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Sentence-transformers style embeddings on onnxruntime (no torch).
+    Defaults to the int8-quantized export of all-MiniLM-L6-v2; output is
+    mean-pooled and L2-normalized like the original model, so vectors stay
+    compatible with an index built by the torch backend.
+    """
+
+    def __init__(self, repo_id: str, model_file: str, max_length: int = 256, threads: int = 0):
+        import onnxruntime as ort
+        from huggingface_hub import hf_hub_download
+        from tokenizers import Tokenizer
+
+        model_path = hf_hub_download(repo_id, model_file)
+        tokenizer_path = hf_hub_download(repo_id, "tokenizer.json")
+
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self._input_names:
+            feeds["token_type_ids"] = np.zeros_like(input_ids)
+
+        hidden = self.session.run(None, feeds)[0]  # (batch, tokens, dim)
+        mask = attention_mask[..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0]
+
+class MicroBatchingEmbeddings(Embeddings):
+    """
+    Coalesces concurrent embed_query calls (from the request thread pool) into
+    one batched forward pass. A single background thread drains the queue,
+    waiting at most `max_wait_ms` for more queries to join a batch.
+    """
+
+    def __init__(self, inner: Embeddings, max_batch: int, max_wait_ms: float):
+        self.inner = inner
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+        self.batches = 0
+        self.queries = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.inner.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        future: Future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            texts = [text for text, _ in batch]
+            try:
+                # all-MiniLM has no query/document prefix, so a batch of queries is a documents call
+                vectors = self.inner.embed_documents(texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.queries += len(batch)
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "queries": self.queries,
+            "avg_batch_size": round(self.queries / self.batches, 2) if self.batches else 0.0,
+        }
+
+class CachedEmbeddings(Embeddings):
+    """Memoizes query embeddings; document embeddings (ingest) pass straight through."""
+
+    def __init__(self, inner: Embeddings, cache: LRUCache):
+        self.inner = inner
+        self.cache = cache
+
+    def embed_documents(self, texts):
+        return self.inner.embed_documents(texts)
+
+    def embed_query(self, text):
+        key = normalize_query(text)
+        vector = self.cache.get(key)
+        if vector is None:
+            vector = self.inner.embed_query(text)
+            self.cache.put(key, vector)
+        return vector
+
+def create_base_embeddings(backend: str) -> Embeddings:
+    backend = backend.lower()
+    if backend == "onnx":
+        return OnnxEmbeddings(
+            repo_id=settings.ONNX_EMBEDDING_REPO,
+            model_file=settings.ONNX_EMBEDDING_FILE,
+            threads=settings.EMBEDDING_THREADS
+        )
+    if backend == "huggingface":
+        # Imported lazily: pulls in torch
+        from langchain_huggingface import HuggingFaceEmbeddings
+        return HuggingFaceEmbeddings(model_name=settings.EMBEDDING_MODEL)
+    raise ValueError(f"Unknown EMBEDDING_BACKEND '{backend}' (expected 'huggingface' or 'onnx')")
+
+def create_embeddings(backend: str = None) -> Embeddings:
+    """Embedding backend selected by EMBEDDING_BACKEND, micro-batched when EMBEDDING_BATCH_SIZE > 1."""
+    embeddings = create_base_embeddings(backend or settings.EMBEDDING_BACKEND)
+    if settings.EMBEDDING_BATCH_SIZE > 1:
+        embeddings = MicroBatchingEmbeddings(
+            embeddings,
+            max_batch=settings.EMBEDDING_BATCH_SIZE,
+            max_wait_ms=settings.EMBEDDING_BATCH_WAIT_MS
+        )
+    return embeddings
@@ -0,0 +1,138 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from tempfile import NamedTemporaryFile
+from typing import Callable, Optional, Tuple
+from app.config import settings
+from app.concurrency import run_blocking, get_semaphore
+from app.db import insert_documents
+from app.pdf_worker import count_pages, parse_and_split
+from app.session_state import get_session_state, pin_namespace, set_namespace_ttl
+
+# Ingestion jobs live in the session-state backend, so any worker can report
+# on a job another worker accepted (with SESSION_STATE_BACKEND=sqlite)
+INGEST_JOB_NAMESPACE = "ingest_job"
+JOB_RETENTION_SECONDS = 24 * 3600
+set_namespace_ttl(INGEST_JOB_NAMESPACE, JOB_RETENTION_SECONDS)
+pin_namespace(INGEST_JOB_NAMESPACE)
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        # spawn, not fork: the API process has live threads (executor, embedding batcher)
+        _process_pool = ProcessPoolExecutor(
+            max_workers=settings.INGEST_PROCESSES or None,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _process_pool
+
+def shutdown_process_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+def get_ingest_job(job_id: str) -> Optional[dict]:
+    return get_session_state().get(INGEST_JOB_NAMESPACE, job_id)
+
+def _update_job(job_id: str, fn: Callable[[dict], dict]) -> dict:
+    """Atomic read-modify-write of one job (a no-op if it has expired)."""
+    return get_session_state().update(
+        INGEST_JOB_NAMESPACE, job_id, lambda job: fn(job) if job is not None else None
+    )
+
+async def _set_job(job_id: str, **changes):
+    await run_blocking(_update_job, job_id, lambda job: {**job, **changes})
+
+def _copy_upload(file_upload) -> str:
+    with NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
+        shutil.copyfileobj(file_upload.file, tmp)
+        return tmp.name
+
+def _insert_batch(job_id: str, texts: list, metadatas: list, pages_parsed: int):
+    report = insert_documents(texts, metadatas) if texts else {
+        "added": 0, "skipped_duplicates": 0, "skipped_near_duplicates": 0
+    }
+    _update_job(job_id, lambda job: {
+        **job,
+        "pages_done": job["pages_done"] + pages_parsed,
+        "chunks_added": job["chunks_added"] + report["added"],
+        "chunks_skipped_duplicate": job["chunks_skipped_duplicate"] + report["skipped_duplicates"],
+        "chunks_skipped_near_duplicate": job["chunks_skipped_near_duplicate"] + report["skipped_near_duplicates"],
+    })
+
+async def _run_ingest(job_id: str, filename: str, pdf_path: str):
+    """
+    Parse page ranges in the process pool and embed/insert chunks in batches
+    as they complete, so the document becomes searchable while it is ingested.
+    Parsing is awaited on the event loop; only the inserts borrow a pool thread.
+    """
+    pool = get_process_pool()
+    loop = asyncio.get_running_loop()
+    pages_total = await loop.run_in_executor(pool, count_pages, pdf_path)
+    await _set_job(job_id, pages_total=pages_total)
+    pages_per_task = settings.INGEST_PAGES_PER_TASK
+    futures = [
+        loop.run_in_executor(pool, parse_and_split, pdf_path, start, min(start + pages_per_task, pages_total))
+        for start in range(0, pages_total, pages_per_task)
+    ]
+
+    texts, metadatas = [], []
+    pages_pending = 0
+    for future in asyncio.as_completed(futures):
+        pages_parsed, chunks = await future
+        pages_pending += pages_parsed
+        for text, page in chunks:
+            texts.append(text)
+            metadatas.append({"source": filename, "page": page})
+            if len(texts) >= settings.INGEST_BATCH_SIZE:
+                await run_blocking(_insert_batch, job_id, texts, metadatas, pages_pending)
+                texts, metadatas, pages_pending = [], [], 0
+        if pages_pending and not texts:
+            await run_blocking(_insert_batch, job_id, [], [], pages_pending)
+            pages_pending = 0
+    await run_blocking(_insert_batch, job_id, texts, metadatas, pages_pending)
+
+async def run_ingest_job(job: dict, pdf_path: str):
+    job_id = job["job_id"]
+    try:
+        async with get_semaphore("ingest", settings.INGEST_MAX_JOBS):
+            await _set_job(job_id, status="running", started_at=datetime.now().isoformat())
+            await _run_ingest(job_id, job["filename"], pdf_path)
+        await _set_job(job_id, status="completed")
+        done = await run_blocking(get_ingest_job, job_id) or {}
+        print(f"[Ingest] Job {job_id} done: {done.get('chunks_added')} chunks from {job['filename']}")
+    except Exception as e:
+        await _set_job(job_id, status="failed", error=str(e))
+        print(f"[Ingest] Job {job_id} failed: {e}")
+    finally:
+        await _set_job(job_id, finished_at=datetime.now().isoformat())
+        if os.path.exists(pdf_path):
+            os.remove(pdf_path)
+
+async def create_ingest_job(file_upload) -> Tuple[dict, str]:
+    """Store the upload and register a queued job. Returns (job, temp pdf path) for run_ingest_job."""
+    pdf_path = await run_blocking(_copy_upload, file_upload)
+    job_id = str(uuid.uuid4())
+    job = {
+        "job_id": job_id,
+        "filename": file_upload.filename,
+        "status": "queued",
+        "pages_total": None,
+        "pages_done": 0,
+        "chunks_added": 0,
+        "chunks_skipped_duplicate": 0,
+        "chunks_skipped_near_duplicate": 0,
+        "error": None,
+        "created_at": datetime.now().isoformat(),
+        "started_at": None,
+        "finished_at": None,
+    }
+    await run_blocking(get_session_state().set, INGEST_JOB_NAMESPACE, job_id, job)
+    return job, pdf_path
@@ -1,26 +1,38 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, Request
-from fastapi.responses import Response
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, Request, BackgroundTasks, Query
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from datetime import timedelta
-from typing import List
+from datetime import datetime, timedelta
+from typing import List, Optional
+import json
 import uuid
 
 from app.config import settings
 from app.schemas import (
     AIResponse, LoginRequest, LoginResponse, SignupRequest, QueryRequest, 
-    ChatHistoryResponse, TeacherProfileResponse
+    ChatHistoryResponse, ChatHistoryPage, SessionPage, TeacherProfileResponse
 )
-from app.ai import run_ai_pipeline, transcribe_audio, ingest_pdf_pipeline, clear_memory, add_to_memory
+from app.ai import (
+    run_ai_pipeline, stream_ai_pipeline, transcribe_audio,
+    clear_memory, replace_memory, sync_memory, get_answer_cache_stats, get_prompt_stats,
+    get_routing_stats
+)
+from app.ingest import create_ingest_job, run_ingest_job, get_ingest_job, shutdown_process_pool
 from app.auth import (
     verify_password, create_access_token, get_current_user, 
     get_current_crp, get_current_teacher, ACCESS_TOKEN_EXPIRE_MINUTES
 )
 from app.database import (
     get_user_by_email, get_teacher_by_id, get_teachers_by_crp,
-    save_chat_message, get_teacher_chat_history, get_crp_chat_history,
-    get_crp_analytics
+    persist_chat_message, get_teacher_chat_history, get_crp_chat_history_with_names,
+    get_teacher_session_summaries, get_session_messages,
+    get_crp_analytics, rebuild_analytics_rollups, get_chat_write_stats,
+    get_store_journal_stats, close_database
 )
 from app.models import ChatMessage
+from app.db import get_query_cache_stats
+from app.concurrency import run_blocking, shutdown_executor
+from app.pagination import decode_cursor, paginate
+from app.session_state import get_session_state
 from app.whatsapp import handle_whatsapp_message, handle_whatsapp_voice
 from twilio.twiml.messaging_response import MessagingResponse
 
@@ -35,6 +47,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("shutdown")
+def shutdown():
+    close_database()  # Flush queued chat rows and checkpoint before the pools go away
+    shutdown_process_pool()
+    shutdown_executor()
+
 @app.get("/")
 def root():
     return {"message": "Shiksha Mitra Backend is Running"}
@@ -44,7 +62,7 @@ def root():
 async def get_crps():
     """Get all CRPs for teacher signup dropdown"""
     from app.database import get_all_crps
-    crps = get_all_crps()
+    crps = await run_blocking(get_all_crps)
     return [{"id": crp.id, "name": crp.name, "email": crp.email} for crp in crps]
 
 @app.post("/api/auth/signup")
@@ -53,7 +71,7 @@ async def signup(request: SignupRequest):
     from app.database import create_user
     
     # Check if email already exists
-    existing_user = get_user_by_email(request.email)
+    existing_user = await run_blocking(get_user_by_email, request.email)
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
@@ -62,7 +80,8 @@ async def signup(request: SignupRequest):
         raise HTTPException(status_code=400, detail="Invalid role. Must be 'crp' or 'teacher'")
     
     # Create user
-    user = create_user(
+    user = await run_blocking(
+        create_user,
         email=request.email,
         password=request.password,
         name=request.name,
@@ -90,9 +109,9 @@ async def signup(request: SignupRequest):
 
 @app.post("/api/auth/login", response_model=LoginResponse)
 async def login(credentials: LoginRequest):
-    user = get_user_by_email(credentials.email)
+    user = await run_blocking(get_user_by_email, credentials.email)
     
-    if not user or not verify_password(credentials.password, user.password_hash):
+    if not user or not await run_blocking(verify_password, credentials.password, user.password_hash):
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
     access_token = create_access_token(
@@ -110,6 +129,13 @@ async def login(credentials: LoginRequest):
     )
 
 # Teacher Endpoints
+async def _sync_session_memory(request: QueryRequest, session_id: str, teacher_id: str):
+    """Server-side memory is authoritative; a client-sent chat_history only seeds a session the server has never seen."""
+    client_history = None
+    if request.chat_history:
+        client_history = [(msg.role, msg.text) for msg in request.chat_history if msg.role in ["user", "assistant"]]
+    await sync_memory(session_id, teacher_id, request.last_message_id, client_history)
+
 @app.post("/api/teacher/query", response_model=AIResponse)
 async def teacher_text_query(
     request: QueryRequest,
@@ -119,20 +145,16 @@ async def teacher_text_query(
     
     # Generate session_id if not provided (new chat)
     session_id = request.session_id or str(uuid.uuid4())
+    if request.session_id:
+        await _sync_session_memory(request, session_id, teacher_id)
     
-    # If chat history is provided, populate the memory with it
-    if request.chat_history:
-        clear_memory(session_id)
-        for msg in request.chat_history:
-            if msg.role in ["user", "assistant"]:
-                add_to_memory(session_id, msg.role, msg.text)
-    
-    response = await run_ai_pipeline(request.query_text, session_id)
+    message_id = str(uuid.uuid4())
+    response = await run_ai_pipeline(request.query_text, session_id, message_id)
     
     # Save to chat history with session_id
     from app.models import ChatMessage
     chat_msg = ChatMessage(
-        id=str(uuid.uuid4()),
+        id=message_id,
         session_id=session_id,
         teacher_id=teacher_id,
         query_text=request.query_text,
@@ -142,18 +164,67 @@ async def teacher_text_query(
         detected_language=response.detected_language,
         source_type="text"
     )
-    save_chat_message(chat_msg)
+    await persist_chat_message(chat_msg)
     
     # Return session_id with response
     response_dict = response.dict()
     response_dict["session_id"] = session_id
+    response_dict["message_id"] = message_id
     return response_dict
 
+@app.post("/api/teacher/query-stream")
+async def teacher_text_query_stream(
+    request: QueryRequest,
+    current_user: dict = Depends(get_current_teacher)
+):
+    """
+    Streaming variant of /api/teacher/query (Server-Sent Events).
+    Emits `token` events with answer text as it is generated, then a single
+    `done` event carrying the full AIResponse (topic, sentiment, language, actions).
+    """
+    teacher_id = current_user["user_id"]
+    session_id = request.session_id or str(uuid.uuid4())
+    if request.session_id:
+        await _sync_session_memory(request, session_id, teacher_id)
+    message_id = str(uuid.uuid4())
+    
+    async def event_stream():
+        async for kind, payload in stream_ai_pipeline(request.query_text, session_id, message_id):
+            if kind == "token":
+                yield f"event: token\ndata: {json.dumps({'text': payload}, ensure_ascii=False)}\n\n"
+                continue
+            
+            response = payload
+            chat_msg = ChatMessage(
+                id=message_id,
+                session_id=session_id,
+                teacher_id=teacher_id,
+                query_text=request.query_text,
+                answer_text=response.answer_text,
+                detected_topic=response.detected_topic,
+                query_sentiment=response.query_sentiment,
+                detected_language=response.detected_language,
+                source_type="text"
+            )
+            await persist_chat_message(chat_msg)
+            
+            response_dict = response.dict()
+            response_dict["session_id"] = session_id
+            response_dict["message_id"] = message_id
+            yield f"event: done\ndata: {json.dumps(response_dict, ensure_ascii=False)}\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/api/teacher/query-voice", response_model=AIResponse)
 async def teacher_voice_query(
     file: UploadFile = File(...),
-    chat_history: str = Form(None),
     session_id: str = Form(None),
+    last_message_id: str = Form(None),
+    chat_history: str = Form(None),  # Deprecated, see QueryRequest.chat_history
     current_user: dict = Depends(get_current_teacher)
 ):
     teacher_id = current_user["user_id"]
@@ -161,19 +232,18 @@ async def teacher_voice_query(
     # Generate session_id if not provided (new chat)
     if not session_id:
         session_id = str(uuid.uuid4())
-    
-    # If chat history is provided, populate the memory with it
-    if chat_history:
-        try:
-            import json
-            history_list = json.loads(chat_history)
-            clear_memory(session_id)
-            from app.schemas import ChatMessage
-            for msg in history_list:
-                if isinstance(msg, dict) and msg.get("role") in ["user", "assistant"]:
-                    add_to_memory(session_id, msg.get("role"), msg.get("text", ""))
-        except:
-            pass
+    else:
+        outcome = await sync_memory(session_id, teacher_id, last_message_id)
+        # The legacy upload is only parsed when the server has nothing for this session
+        if outcome == "empty" and chat_history:
+            try:
+                history_list = json.loads(chat_history)
+                await run_blocking(replace_memory, session_id, [
+                    (msg.get("role"), msg.get("text", "")) for msg in history_list
+                    if isinstance(msg, dict) and msg.get("role") in ["user", "assistant"]
+                ])
+            except:
+                pass
     
     file_bytes = await file.read()
     text = await transcribe_audio(file_bytes, file.filename)
@@ -186,12 +256,13 @@ async def teacher_voice_query(
     if word_count < 3:
         print(f"[Voice Query] Warning: Very short transcription ({word_count} words): {text}")
     
-    response = await run_ai_pipeline(text, session_id)
+    message_id = str(uuid.uuid4())
+    response = await run_ai_pipeline(text, session_id, message_id)
     
     # Save to chat history
     from app.models import ChatMessage as DBChatMessage
     chat_msg = DBChatMessage(
-        id=str(uuid.uuid4()),
+        id=message_id,
         session_id=session_id,
         teacher_id=teacher_id,
         query_text=text,
@@ -201,11 +272,12 @@ async def teacher_voice_query(
         detected_language=response.detected_language,
         source_type="voice"
     )
-    save_chat_message(chat_msg)
+    await persist_chat_message(chat_msg)
     
     # Return session_id and query_text with response
     response_dict = response.dict()
     response_dict["session_id"] = session_id
+    response_dict["message_id"] = message_id
     response_dict["query_text"] = text
     return response_dict
 
@@ -216,50 +288,82 @@ async def clear_conversation_memory(
 ):
     """Clear the conversation buffer memory for a specific chat session."""
     if session_id:
-        clear_memory(session_id)
+        await run_blocking(clear_memory, session_id)
         return {"message": f"Conversation memory cleared for session {session_id}"}
     else:
         return {"error": "session_id is required"}
 
-@app.get("/api/teacher/history", response_model=List[ChatHistoryResponse])
+def _history_item(msg: ChatMessage, teacher_name: str) -> ChatHistoryResponse:
+    return ChatHistoryResponse(
+        id=msg.id,
+        teacher_id=msg.teacher_id,
+        teacher_name=teacher_name,
+        query_text=msg.query_text,
+        answer_text=msg.answer_text,
+        detected_topic=msg.detected_topic,
+        query_sentiment=msg.query_sentiment,
+        detected_language=msg.detected_language,
+        source_type=msg.source_type,
+        timestamp=msg.timestamp
+    )
+
+def _cursor_param(cursor: Optional[str]):
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/api/teacher/history", response_model=ChatHistoryPage)
 async def get_teacher_history(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_teacher)
 ):
+    """Newest first; follow next_cursor for older messages"""
     teacher_id = current_user["user_id"]
-    history = get_teacher_chat_history(teacher_id)
-    teacher = get_teacher_by_id(teacher_id)
+    history = await run_blocking(get_teacher_chat_history, teacher_id, limit + 1, _cursor_param(cursor))
+    teacher = await run_blocking(get_teacher_by_id, teacher_id)
     
-    return [
-        ChatHistoryResponse(
-            id=msg.id,
-            teacher_id=msg.teacher_id,
-            teacher_name=teacher.name if teacher else "Unknown",
-            query_text=msg.query_text,
-            answer_text=msg.answer_text,
-            detected_topic=msg.detected_topic,
-            query_sentiment=msg.query_sentiment,
-            detected_language=msg.detected_language,
-            source_type=msg.source_type,
-            timestamp=msg.timestamp
-        )
-        for msg in history
-    ]
+    page, next_cursor = paginate(history, limit, lambda msg: (msg.timestamp, msg.id))
+    teacher_name = teacher.name if teacher else "Unknown"
+    return ChatHistoryPage(items=[_history_item(msg, teacher_name) for msg in page], next_cursor=next_cursor)
+
+@app.get("/api/teacher/sessions", response_model=SessionPage)
+async def list_teacher_sessions(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_teacher)
+):
+    """Session summaries, most recently active first; messages load via /api/teacher/sessions/{session_id}"""
+    sessions = await run_blocking(
+        get_teacher_session_summaries, current_user["user_id"], limit + 1, _cursor_param(cursor)
+    )
+    page, next_cursor = paginate(
+        sessions, limit,
+        lambda s: (datetime.fromisoformat(s["last_timestamp"]) if isinstance(s["last_timestamp"], str)
+                   else s["last_timestamp"], s["session_id"])
+    )
+    return SessionPage(items=page, next_cursor=next_cursor)
 
-@app.get("/api/teacher/sessions")
-async def get_teacher_sessions(
+@app.get("/api/teacher/sessions/{session_id}", response_model=List[ChatHistoryResponse])
+async def get_teacher_session(
+    session_id: str,
     current_user: dict = Depends(get_current_teacher)
 ):
-    """Get all chat sessions grouped by session_id"""
-    from app.database import get_teacher_sessions
+    """All messages of one session, in conversation order"""
     teacher_id = current_user["user_id"]
-    sessions = get_teacher_sessions(teacher_id)
-    return sessions
+    messages = await run_blocking(get_session_messages, teacher_id, session_id)
+    if not messages:
+        raise HTTPException(status_code=404, detail="Session not found")
+    teacher = await run_blocking(get_teacher_by_id, teacher_id)
+    teacher_name = teacher.name if teacher else "Unknown"
+    return [_history_item(msg, teacher_name) for msg in messages]
 
 @app.get("/api/teacher/profile", response_model=TeacherProfileResponse)
 async def get_teacher_profile(
     current_user: dict = Depends(get_current_teacher)
 ):
-    teacher = get_teacher_by_id(current_user["user_id"])
+    teacher = await run_blocking(get_teacher_by_id, current_user["user_id"])
     if not teacher:
         raise HTTPException(status_code=404, detail="Teacher profile not found")
     
@@ -270,30 +374,25 @@ async def get_teacher_profile(
 async def get_crp_teachers(
     current_user: dict = Depends(get_current_crp)
 ):
-    teachers = get_teachers_by_crp(current_user["user_id"])
+    teachers = await run_blocking(get_teachers_by_crp, current_user["user_id"])
     return [TeacherProfileResponse(**t.dict()) for t in teachers]
 
-@app.get("/api/crp/chats", response_model=List[ChatHistoryResponse])
+@app.get("/api/crp/chats", response_model=ChatHistoryPage)
 async def get_crp_chats(
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_crp)
 ):
-    history = get_crp_chat_history(current_user["user_id"])
+    """Newest first across all of the CRP's teachers; follow next_cursor for older messages"""
+    history = await run_blocking(
+        get_crp_chat_history_with_names, current_user["user_id"], limit + 1, _cursor_param(cursor)
+    )
     
-    return [
-        ChatHistoryResponse(
-            id=msg.id,
-            teacher_id=msg.teacher_id,
-            teacher_name=get_teacher_by_id(msg.teacher_id).name if get_teacher_by_id(msg.teacher_id) else "Unknown",
-            query_text=msg.query_text,
-            answer_text=msg.answer_text,
-            detected_topic=msg.detected_topic,
-            query_sentiment=msg.query_sentiment,
-            detected_language=msg.detected_language,
-            source_type=msg.source_type,
-            timestamp=msg.timestamp
-        )
-        for msg in history
-    ]
+    page, next_cursor = paginate(history, limit, lambda item: (item[0].timestamp, item[0].id))
+    return ChatHistoryPage(
+        items=[_history_item(msg, teacher_name) for msg, teacher_name in page],
+        next_cursor=next_cursor
+    )
 
 @app.get("/api/crp/teacher/{teacher_id}/chats", response_model=List[ChatHistoryResponse])
 async def get_specific_teacher_chats(
@@ -301,42 +400,62 @@ async def get_specific_teacher_chats(
     current_user: dict = Depends(get_current_crp)
 ):
     # Verify teacher belongs to this CRP
-    teacher = get_teacher_by_id(teacher_id)
+    teacher = await run_blocking(get_teacher_by_id, teacher_id)
     if not teacher or teacher.crp_id != current_user["user_id"]:
         raise HTTPException(status_code=403, detail="Access denied to this teacher's data")
     
-    history = get_teacher_chat_history(teacher_id)
+    history = await run_blocking(get_teacher_chat_history, teacher_id)
     
-    return [
-        ChatHistoryResponse(
-            id=msg.id,
-            teacher_id=msg.teacher_id,
-            teacher_name=teacher.name,
-            query_text=msg.query_text,
-            answer_text=msg.answer_text,
-            detected_topic=msg.detected_topic,
-            query_sentiment=msg.query_sentiment,
-            detected_language=msg.detected_language,
-            source_type=msg.source_type,
-            timestamp=msg.timestamp
-        )
-        for msg in history
-    ]
+    return [_history_item(msg, teacher.name) for msg in history]
 
 @app.get("/api/crp/analytics")
 async def get_analytics(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    per_teacher: bool = False,
     current_user: dict = Depends(get_current_crp)
 ):
-    analytics = get_crp_analytics(current_user["user_id"])
+    """Topic/sentiment/language distributions over [start, end) (all time by default)"""
+    analytics = await run_blocking(
+        get_crp_analytics, current_user["user_id"], start=start, end=end, per_teacher=per_teacher
+    )
     return analytics.dict()
 
 # Admin/Utility Endpoints (kept for backward compatibility)
-@app.post("/api/ingest-pdf")
-async def ingest_pdf(file: UploadFile = File(...)):
+@app.post("/api/ingest-pdf", status_code=202)
+async def ingest_pdf(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+    """Queue a PDF for background ingestion; poll /api/ingest-jobs/{job_id} for progress"""
     if not file.filename.endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
-        
-    return await ingest_pdf_pipeline(file)
+    
+    job, pdf_path = await create_ingest_job(file)
+    background_tasks.add_task(run_ingest_job, job, pdf_path)
+    return job
+
+@app.post("/api/admin/rollups/rebuild")
+async def rebuild_rollups(current_user: dict = Depends(get_current_crp)):
+    """Recompute analytics rollups from chat history; reports whether the live counters were consistent"""
+    return await run_blocking(rebuild_analytics_rollups)
+
+@app.get("/api/ingest-jobs/{job_id}")
+async def ingest_job_status(job_id: str):
+    job = await run_blocking(get_ingest_job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Ingest job not found")
+    return job
+
+@app.get("/api/admin/stats")
+async def admin_stats(current_user: dict = Depends(get_current_crp)):
+    """Cache and pipeline counters for tuning"""
+    return {
+        "answer_cache": get_answer_cache_stats(),
+        "prompt": get_prompt_stats(),
+        "routing": get_routing_stats(),
+        "chat_writes": get_chat_write_stats(),
+        "memory_db_journal": get_store_journal_stats(),
+        "session_state": await run_blocking(get_session_state().stats),
+        **get_query_cache_stats()
+    }
 
 # WhatsApp Webhook Endpoint (Twilio Sandbox)
 @app.post("/api/whatsapp/webhook")
@@ -0,0 +1,253 @@
+import threading
+from array import array
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+from app.models import User, Teacher, ChatMessage, UserRole
+from app.chat_log import ChatLog, from_micros, to_micros
+from app.analytics import AnalyticsFrame, DIMENSIONS
+from app.rollups import AnalyticsRollups
+
+class InMemoryStore:
+    """
+    In-process database used when Supabase is not configured.
+
+    Besides the primary maps it keeps secondary indexes so lookups never scan
+    every row: email -> user, CRP -> teachers, and per-teacher, per-CRP and
+    per-session row-number arrays kept sorted by (timestamp, id). Messages
+    themselves live in a columnar ChatLog; a history page is a bisect for the
+    cursor plus a slice of one index: O(log n + k).
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+
+        self.users: Dict[str, User] = {}
+        self.teachers: Dict[str, Teacher] = {}
+        self.chat_log = ChatLog()
+        self.rollups = AnalyticsRollups()
+
+        self._users_by_email: Dict[str, str] = {}
+        self._teachers_by_crp: Dict[str, Set[str]] = {}
+        self._by_teacher: Dict[str, array] = {}
+        self._by_crp: Dict[str, array] = {}
+        self._by_session: Dict[str, array] = {}
+        self._sessions_by_teacher: Dict[str, Set[str]] = {}
+
+        # Optional StoreJournal; mutations are logged to it while the lock is held
+        self.journal = None
+
+    # Users / teachers
+    def put_user(self, user: User):
+        with self._lock:
+            previous = self.users.get(user.id)
+            if previous is not None and self._users_by_email.get(previous.email) == user.id:
+                del self._users_by_email[previous.email]
+            self.users[user.id] = user
+            self._users_by_email[user.email] = user.id
+            if self.journal is not None:
+                self.journal.append("user", user.dict())
+
+    def get_user_by_email(self, email: str) -> Optional[User]:
+        user_id = self._users_by_email.get(email)
+        return self.users.get(user_id) if user_id else None
+
+    def users_with_role(self, role: UserRole) -> List[User]:
+        return [u for u in self.users.values() if u.role == role]
+
+    def put_teacher(self, teacher: Teacher):
+        with self._lock:
+            previous = self.teachers.get(teacher.id)
+            if previous is not None:
+                self._teachers_by_crp.get(previous.crp_id, set()).discard(teacher.id)
+            self.teachers[teacher.id] = teacher
+            self._teachers_by_crp.setdefault(teacher.crp_id, set()).add(teacher.id)
+            if self.journal is not None:
+                self.journal.append("teacher", teacher.dict())
+
+    def teacher_ids_for_crp(self, crp_id: str) -> Set[str]:
+        return set(self._teachers_by_crp.get(crp_id, ()))
+
+    def teachers_for_crp(self, crp_id: str) -> List[Teacher]:
+        return [self.teachers[t] for t in self._teachers_by_crp.get(crp_id, ()) if t in self.teachers]
+
+    # Chat messages
+    def _key(self, row: int) -> Tuple[int, str]:
+        return self.chat_log.timestamps[row], self.chat_log.ids[row]
+
+    def _bisect(self, rows: array, key: Tuple[int, str]) -> int:
+        """Number of leading rows whose (timestamp, id) is below key."""
+        timestamps = self.chat_log.timestamps
+        lo, hi = 0, len(rows)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            ts = timestamps[rows[mid]]
+            # Only timestamp ties need the (decoded) id
+            if ts < key[0] or (ts == key[0] and self.chat_log.ids[rows[mid]] < key[1]):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _insert_sorted(self, rows: array, row: int):
+        """Insert a row number into an index ordered by (timestamp, id)."""
+        key = self._key(row)
+        if not rows or self._key(rows[-1]) <= key:
+            rows.append(row)  # Common case: messages arrive in time order
+            return
+        rows.insert(self._bisect(rows, key), row)
+
+    def add_message(self, message: ChatMessage):
+        with self._lock:
+            if self.journal is not None:
+                self.journal.append("message", message.dict())
+            row = self.chat_log.append(message)
+            self._insert_sorted(self._by_teacher.setdefault(message.teacher_id, array("I")), row)
+            self._insert_sorted(self._by_session.setdefault(message.session_id, array("I")), row)
+            self._sessions_by_teacher.setdefault(message.teacher_id, set()).add(message.session_id)
+            teacher = self.teachers.get(message.teacher_id)
+            if teacher is not None:
+                teacher.total_queries += 1
+                # The message's own time, so replaying the journal after a restart keeps real activity times
+                if teacher.last_active is None or message.timestamp > teacher.last_active:
+                    teacher.last_active = message.timestamp
+                self._insert_sorted(self._by_crp.setdefault(teacher.crp_id, array("I")), row)
+                self.rollups.record(
+                    teacher.crp_id, message.teacher_id,
+                    {name: getattr(message, name) for name in DIMENSIONS}, message.timestamp
+                )
+
+    def _newest(
+        self, rows: array, limit: Optional[int], before: Optional[Tuple[datetime, str]] = None
+    ) -> List[ChatMessage]:
+        with self._lock:
+            end = len(rows) if before is None else self._bisect(rows, (to_micros(before[0]), before[1]))
+            start = 0 if limit is None else max(0, end - limit)
+            selected = rows[start:end] if limit is None or limit > 0 else []
+            return [self.chat_log.materialize(row) for row in reversed(selected)]
+
+    def teacher_messages(
+        self, teacher_id: str, limit: Optional[int] = None, before: Optional[Tuple[datetime, str]] = None
+    ) -> List[ChatMessage]:
+        """Newest first, strictly older than the (timestamp, id) `before` position if given."""
+        return self._newest(self._by_teacher.get(teacher_id, array("I")), limit, before)
+
+    def crp_messages(
+        self, crp_id: str, limit: Optional[int] = None, before: Optional[Tuple[datetime, str]] = None
+    ) -> List[ChatMessage]:
+        """Newest first, strictly older than the (timestamp, id) `before` position if given."""
+        return self._newest(self._by_crp.get(crp_id, array("I")), limit, before)
+
+    def session_messages(self, session_id: str, limit: Optional[int] = None) -> List[ChatMessage]:
+        """Oldest first (conversation order); with `limit`, only the newest `limit`."""
+        rows = self._by_session.get(session_id, ())
+        if limit is not None:
+            rows = rows[-limit:] if limit > 0 else ()
+        return [self.chat_log.materialize(row) for row in rows]
+
+    def teacher_session_ids(self, teacher_id: str) -> Set[str]:
+        return set(self._sessions_by_teacher.get(teacher_id, ()))
+
+    def session_summaries(self, teacher_id: str) -> List[dict]:
+        """One summary per session (first query, time span, size); no message bodies are materialized."""
+        log = self.chat_log
+        with self._lock:
+            summaries = []
+            for session_id in self._sessions_by_teacher.get(teacher_id, ()):
+                rows = self._by_session.get(session_id)
+                if not rows:
+                    continue
+                summaries.append({
+                    "session_id": session_id,
+                    "first_query": log.query_text[rows[0]],
+                    "started_at": from_micros(log.timestamps[rows[0]]),
+                    "last_timestamp": from_micros(log.timestamps[rows[-1]]),
+                    "message_count": len(rows),
+                })
+            return summaries
+
+    def iter_crp_messages(self, crp_id: str) -> Iterator[ChatMessage]:
+        for row in self._by_crp.get(crp_id, ()):
+            yield self.chat_log.materialize(row)
+
+    def analytics_frame(self) -> AnalyticsFrame:
+        with self._lock:
+            columns = self.chat_log.column_snapshot()
+            interners = self.chat_log.interners
+            return AnalyticsFrame(
+                teacher=columns["teacher_id"],
+                timestamps=columns["timestamps"],
+                codes={name: columns[name] for name in DIMENSIONS},
+                teacher_values=list(interners["teacher_id"].values),
+                values={name: list(interners[name].values) for name in DIMENSIONS},
+            )
+
+    def rebuild_rollups(self) -> dict:
+        """Recompute the analytics rollups from the chat log and report whether the live ones matched."""
+        with self._lock:
+            log = self.chat_log
+            crp_of = {teacher_id: teacher.crp_id for teacher_id, teacher in self.teachers.items()}
+            rows = (
+                (crp_of[teacher_id], teacher_id, {name: log.value(name, row) for name in DIMENSIONS},
+                 from_micros(log.timestamps[row]))
+                for row in range(len(log))
+                for teacher_id in (log.value("teacher_id", row),)
+                if teacher_id in crp_of
+            )
+            fresh = AnalyticsRollups.from_history(rows)
+            consistent = fresh.snapshot() == self.rollups.snapshot()
+            self.rollups = fresh
+            return {"consistent": consistent, "messages": len(log)}
+
+    # Persistence (see store_journal.StoreJournal)
+    def apply(self, op: str, data: dict):
+        """Replay one journaled mutation."""
+        if op == "user":
+            self.put_user(User(**data))
+        elif op == "teacher":
+            self.put_teacher(Teacher(**data))
+        elif op == "message":
+            self.add_message(ChatMessage(**data))
+        else:
+            raise ValueError(f"Unknown journal op: {op}")
+
+    def snapshot_state(self, under_lock: Optional[Callable[[], None]] = None) -> dict:
+        """
+        Consistent copy of the store. Users, teachers and the row count are taken
+        under the lock (together with `under_lock`, e.g. a WAL rotation); the
+        append-only chat columns are then copied without blocking writers.
+        """
+        with self._lock:
+            users = [user.dict() for user in self.users.values()]
+            teachers = [teacher.dict() for teacher in self.teachers.values()]
+            rows = len(self.chat_log)
+            if under_lock is not None:
+                under_lock()
+        return {"users": users, "teachers": teachers, "chat_log": self.chat_log.export(rows)}
+
+    def load_state(self, state: dict):
+        """Replace the contents with a snapshot and rebuild every index in one pass."""
+        with self._lock:
+            journal, self.journal = self.journal, None
+            self.users, self.teachers = {}, {}
+            for index in (self._users_by_email, self._teachers_by_crp, self._by_teacher,
+                          self._by_crp, self._by_session, self._sessions_by_teacher):
+                index.clear()
+            for data in state["users"]:
+                self.put_user(User(**data))
+            for data in state["teachers"]:
+                self.put_teacher(Teacher(**data))
+            self.chat_log = log = ChatLog.restore(state["chat_log"])
+            for row in range(len(log)):
+                teacher_id = log.value("teacher_id", row)
+                session_id = log.value("session_id", row)
+                self._insert_sorted(self._by_teacher.setdefault(teacher_id, array("I")), row)
+                self._insert_sorted(self._by_session.setdefault(session_id, array("I")), row)
+                self._sessions_by_teacher.setdefault(teacher_id, set()).add(session_id)
+                teacher = self.teachers.get(teacher_id)
+                if teacher is not None:
+                    self._insert_sorted(self._by_crp.setdefault(teacher.crp_id, array("I")), row)
+            self.rebuild_rollups()
+            self.journal = journal
+
+    def message_count(self) -> int:
+        return len(self.chat_log)
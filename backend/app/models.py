@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 from typing import Optional, List
 from datetime import datetime
 from enum import Enum
@@ -14,7 +14,7 @@ class User(BaseModel):
     role: UserRole
     password_hash: str
     crp_id: Optional[str] = None  # For teachers, this links them to their CRP
-    created_at: datetime = datetime.now()
+    created_at: datetime = Field(default_factory=datetime.now)
 
 class Teacher(BaseModel):
     id: str
@@ -38,7 +38,7 @@ class ChatMessage(BaseModel):
     query_sentiment: str
     detected_language: str
     source_type: str  # "text" or "voice"
-    timestamp: datetime = datetime.now()
+    timestamp: datetime = Field(default_factory=datetime.now)
 
 class CRPAnalytics(BaseModel):
     crp_id: str
@@ -48,3 +48,7 @@ class CRPAnalytics(BaseModel):
     top_topics: List[dict]
     sentiment_distribution: dict
     language_distribution: dict
+    total_queries: int = 0  # Queries in [start, end) - the range the distributions cover
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    teacher_breakdown: Optional[List[dict]] = None
@@ -0,0 +1,33 @@
+import base64
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+Cursor = Tuple[datetime, str]
+
+def encode_cursor(timestamp: datetime, key: str) -> str:
+    """Opaque keyset cursor for a (timestamp, id) position."""
+    raw = f"{timestamp.isoformat()}|{key}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Cursor]:
+    """Inverse of encode_cursor; raises ValueError for a malformed cursor."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        timestamp, key = raw.split("|", 1)
+        return datetime.fromisoformat(timestamp), key
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def paginate(items: List[T], limit: int, position: Callable[[T], Cursor]) -> Tuple[List[T], Optional[str]]:
+    """
+    Split a newest-first fetch of limit + 1 rows into the page and the cursor
+    for the next one (None when this is the last page).
+    """
+    page = items[:limit]
+    if len(items) <= limit or not page:
+        return page, None
+    return page, encode_cursor(*position(page[-1]))
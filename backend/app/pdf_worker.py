@@ -0,0 +1,28 @@
+"""
+PDF parsing/splitting that runs inside the ingestion process pool.
+Kept free of app imports so spawned workers stay light (no embeddings, no Chroma).
+"""
+from typing import List, Tuple
+from pypdf import PdfReader
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+def count_pages(pdf_path: str) -> int:
+    return len(PdfReader(pdf_path).pages)
+
+def parse_and_split(pdf_path: str, start_page: int, end_page: int) -> Tuple[int, List[Tuple[str, int]]]:
+    """Extract and chunk pages [start_page, end_page). Returns (pages parsed, [(chunk text, page)])."""
+    reader = PdfReader(pdf_path)
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        separators=["\n\n", "\n", ".", " "]
+    )
+    chunks = []
+    for page in range(start_page, end_page):
+        text = reader.pages[page].extract_text() or ""
+        for chunk in text_splitter.split_text(text):
+            chunks.append((chunk, page))
+    return end_page - start_page, chunks
@@ -0,0 +1,200 @@
+import math
+import re
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+from app.sparse_index import tokenize
+
+# Per-message framing the chat template adds (role header, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough Llama 3 token count without loading a tokenizer: ~4 characters per
+    token for ASCII text, ~2 for Devanagari and other scripts. Groq's reported
+    usage is recorded next to it (see PromptStats) to keep this honest.
+    """
+    if not text:
+        return 0
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return math.ceil(ascii_chars / 4 + (len(text) - ascii_chars) / 2)
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut `text` at a word boundary so it fits in about `max_tokens`."""
+    if max_tokens <= 0:
+        return ""
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    cut = text[:int(len(text) * max_tokens / tokens)]
+    space = cut.rfind(" ")
+    if space > len(cut) // 2:
+        cut = cut[:space]
+    return cut.rstrip() + "…"
+
+# Retrieved context
+def _shingles(text: str, size: int = 3) -> Set[str]:
+    words = tokenize(text)
+    if len(words) < size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def _overlap_length(left: str, right: str, min_chars: int = 40, max_chars: int = 250) -> int:
+    """
+    Length of the longest suffix of `left` that is a prefix of `right`. The
+    PDF splitter overlaps neighbours by up to CHUNK_OVERLAP (200) characters.
+    """
+    for length in range(min(len(left), len(right), max_chars + 1) - 1, min_chars - 1, -1):
+        if left.endswith(right[:length]):
+            return length
+    return 0
+
+def dedupe_chunks(chunks: List[str], max_containment: float = 0.8) -> List[str]:
+    """
+    Drop chunks that are mostly contained in a higher-ranked one, and strip
+    the text a chunk shares with its neighbour from the PDF splitter's
+    overlap. Rank order is kept.
+    """
+    kept: List[str] = []
+    kept_shingles: List[Set[str]] = []
+    for chunk in chunks:
+        chunk = " ".join(chunk.split())
+        shingles = _shingles(chunk)
+        if not chunk or any(
+            len(shingles & other) >= max_containment * min(len(shingles), len(other))
+            for other in kept_shingles
+        ):
+            continue
+        for other in kept:
+            overlap = _overlap_length(other, chunk)
+            if overlap:
+                chunk = chunk[overlap:].lstrip()
+            overlap = _overlap_length(chunk, other)
+            if overlap:
+                chunk = chunk[:-overlap].rstrip()
+        if chunk:
+            kept.append(chunk)
+            kept_shingles.append(shingles)
+    return kept
+
+def fit_context(chunks: List[str], max_tokens: int, min_tail_tokens: int = 64) -> Tuple[str, int]:
+    """
+    Deduped chunks in rank order until `max_tokens` is spent; the first chunk
+    that does not fit is clipped if enough budget is left to be useful.
+    Returns (context, number of chunks left out).
+    """
+    parts: List[str] = []
+    used = 0
+    deduped = dedupe_chunks(chunks)
+    for chunk in deduped:
+        tokens = estimate_tokens(chunk)
+        if used + tokens <= max_tokens:
+            parts.append(chunk)
+            used += tokens
+            continue
+        if max_tokens - used >= min_tail_tokens:
+            parts.append(truncate_to_tokens(chunk, max_tokens - used))
+        break
+    return "\n\n".join(parts), len(chunks) - len(parts)
+
+# Conversation history
+def _first_sentence(text: str, max_words: int) -> str:
+    text = " ".join(text.replace("*", "").split())
+    sentence = re.split(r"(?<=[.!?।])\s", text, maxsplit=1)[0]
+    words = sentence.split()
+    return " ".join(words[:max_words]) + ("…" if len(words) > max_words else "")
+
+def summarize_turns(messages: List[dict]) -> List[str]:
+    """One compact line per exchange: the question and the gist of the answer."""
+    lines = []
+    for msg in messages:
+        if msg["role"] == "user":
+            lines.append(f"- Teacher asked: {_first_sentence(msg['content'], 25)}")
+        elif lines:
+            lines[-1] += f" → {_first_sentence(msg['content'], 20)}"
+        else:
+            lines.append(f"- Assistant: {_first_sentence(msg['content'], 20)}")
+    return lines
+
+def roll_summary(summary: str, dropped: List[dict], max_tokens: int) -> str:
+    """Fold turns that fell out of memory into the rolling summary, oldest lines going first."""
+    lines = (summary.splitlines() if summary else []) + summarize_turns(dropped)
+    while lines and estimate_tokens("\n".join(lines)) > max_tokens:
+        lines.pop(0)
+    return "\n".join(lines)
+
+def fit_history(history: List[dict], max_tokens: int, max_message_tokens: int) -> Tuple[List[dict], List[dict]]:
+    """
+    The newest messages that fit in `max_tokens` (each clipped to
+    `max_message_tokens`), plus the older ones that did not fit. Messages are
+    taken in user/assistant pairs so the model never sees half an exchange.
+    """
+    kept: List[dict] = []
+    used = 0
+    index = len(history)
+    while index > 0:
+        start = index - 2 if index >= 2 and history[index - 2]["role"] == "user" else index - 1
+        pair = [
+            {"role": msg["role"], "content": truncate_to_tokens(msg["content"], max_message_tokens)}
+            for msg in history[start:index]
+        ]
+        tokens = sum(estimate_tokens(msg["content"]) + MESSAGE_OVERHEAD_TOKENS for msg in pair)
+        if used + tokens > max_tokens:
+            break
+        kept[:0] = pair
+        used += tokens
+        index = start
+    return kept, history[:index]
+
+def count_message_tokens(messages: List[dict]) -> int:
+    return sum(estimate_tokens(msg["content"]) + MESSAGE_OVERHEAD_TOKENS for msg in messages)
+
+class PromptStats:
+    """Running totals of prompt sizes per section, and estimate vs. Groq-reported tokens."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.section_totals: Dict[str, int] = {}
+        self.max_total = 0
+        self.chunks_dropped = 0
+        self.turns_summarized = 0
+        self.reported_requests = 0
+        self.reported_tokens = 0
+        self.estimated_for_reported = 0
+
+    def record(self, sections: Dict[str, int], turns_summarized: int):
+        with self._lock:
+            self.requests += 1
+            for name, tokens in sections.items():
+                self.section_totals[name] = self.section_totals.get(name, 0) + tokens
+            self.max_total = max(self.max_total, sections.get("total", 0))
+            self.turns_summarized += turns_summarized
+
+    def record_context(self, chunks_dropped: int):
+        with self._lock:
+            self.chunks_dropped += chunks_dropped
+
+    def record_reported(self, estimated: int, reported: Optional[int]):
+        if not reported:
+            return
+        with self._lock:
+            self.reported_requests += 1
+            self.reported_tokens += reported
+            self.estimated_for_reported += estimated
+
+    def stats(self) -> dict:
+        with self._lock:
+            averages = {
+                name: round(total / self.requests, 1) for name, total in self.section_totals.items()
+            } if self.requests else {}
+            return {
+                "requests": self.requests,
+                "avg_tokens": averages,
+                "max_total_tokens": self.max_total,
+                "chunks_dropped": self.chunks_dropped,
+                "turns_summarized": self.turns_summarized,
+                "avg_reported_prompt_tokens": round(self.reported_tokens / self.reported_requests, 1)
+                    if self.reported_requests else None,
+                "estimate_ratio": round(self.estimated_for_reported / self.reported_tokens, 3)
+                    if self.reported_tokens else None,
+            }
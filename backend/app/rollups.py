@@ -0,0 +1,106 @@
+import threading
+from collections import Counter
+from datetime import date, datetime
+from typing import Dict, Iterable, Optional, Set, Tuple
+from app.analytics import DIMENSIONS
+
+class _Counts:
+    """Query count plus one Counter per analytics dimension."""
+
+    __slots__ = ("queries",) + DIMENSIONS
+
+    def __init__(self):
+        self.queries = 0
+        for name in DIMENSIONS:
+            setattr(self, name, Counter())
+
+    def add(self, values: Dict[str, str]):
+        self.queries += 1
+        for name in DIMENSIONS:
+            getattr(self, name)[values[name]] += 1
+
+    def as_dict(self) -> dict:
+        return {"queries": self.queries, **{name: dict(getattr(self, name)) for name in DIMENSIONS}}
+
+class AnalyticsRollups:
+    """
+    Counters maintained on every saved chat message so the CRP dashboard is a
+    constant-time read: all-time counts per CRP and per teacher, and per-day
+    counts (including the set of active teachers) per CRP.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._crp: Dict[str, _Counts] = {}
+        self._teacher: Dict[str, _Counts] = {}
+        self._crp_teachers: Dict[str, Set[str]] = {}
+        self._days: Dict[Tuple[str, date], _Counts] = {}
+        self._active: Dict[Tuple[str, date], Set[str]] = {}
+
+    def record(self, crp_id: str, teacher_id: str, values: Dict[str, str], timestamp: datetime):
+        day = timestamp.date()
+        with self._lock:
+            self._crp.setdefault(crp_id, _Counts()).add(values)
+            self._teacher.setdefault(teacher_id, _Counts()).add(values)
+            self._crp_teachers.setdefault(crp_id, set()).add(teacher_id)
+            self._days.setdefault((crp_id, day), _Counts()).add(values)
+            self._active.setdefault((crp_id, day), set()).add(teacher_id)
+
+    def clear(self):
+        with self._lock:
+            self._crp.clear()
+            self._teacher.clear()
+            self._crp_teachers.clear()
+            self._days.clear()
+            self._active.clear()
+
+    def read(self, crp_id: str, day: Optional[date] = None, per_teacher: bool = False, top_n: int = 5) -> dict:
+        """Same shape as analytics.compute_crp_analytics (all-time distributions, `day` counters)."""
+        day = day or datetime.now().date()
+        with self._lock:
+            totals = self._crp.get(crp_id) or _Counts()
+            today = self._days.get((crp_id, day)) or _Counts()
+            result = {
+                "total_queries": totals.queries,
+                "active_teachers_today": len(self._active.get((crp_id, day), ())),
+                "total_queries_today": today.queries,
+            }
+            for name in DIMENSIONS:
+                result[name] = dict(getattr(totals, name).most_common())
+            if per_teacher:
+                rows = []
+                for teacher_id in self._crp_teachers.get(crp_id, ()):
+                    counts = self._teacher[teacher_id]
+                    rows.append({
+                        "teacher_id": teacher_id,
+                        "total_queries": counts.queries,
+                        **{name: dict(getattr(counts, name)) for name in DIMENSIONS},
+                    })
+                result["teacher_breakdown"] = sorted(rows, key=lambda r: -r["total_queries"])
+        result["top_topics"] = [
+            {"topic": topic, "count": count}
+            for topic, count in list(result["detected_topic"].items())[:top_n]
+        ]
+        return result
+
+    def day(self, crp_id: str, day: date) -> dict:
+        with self._lock:
+            counts = self._days.get((crp_id, day)) or _Counts()
+            return {**counts.as_dict(), "active_teachers": len(self._active.get((crp_id, day), ()))}
+
+    def snapshot(self) -> dict:
+        """Plain-dict copy of every counter, for consistency checks."""
+        with self._lock:
+            return {
+                "crp": {k: v.as_dict() for k, v in self._crp.items()},
+                "teacher": {k: v.as_dict() for k, v in self._teacher.items()},
+                "days": {f"{crp}|{day.isoformat()}": v.as_dict() for (crp, day), v in self._days.items()},
+                "active": {f"{crp}|{day.isoformat()}": sorted(v) for (crp, day), v in self._active.items()},
+            }
+
+    @classmethod
+    def from_history(cls, rows: Iterable[Tuple[str, str, Dict[str, str], datetime]]) -> "AnalyticsRollups":
+        rollups = cls()
+        for crp_id, teacher_id, values, timestamp in rows:
+            rollups.record(crp_id, teacher_id, values, timestamp)
+        return rollups
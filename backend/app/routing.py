@@ -0,0 +1,100 @@
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+from app.sparse_index import tokenize
+
+SMALL = "small"
+LARGE = "large"
+
+# Acknowledgements and greetings (English, Hindi, Hinglish) that need no NCERT lookup
+SMALLTALK_WORDS = {
+    "thanks", "thank", "you", "thx", "ty", "ok", "okay", "k", "hi", "hello", "hey", "bye", "good",
+    "morning", "evening", "night", "great", "nice", "cool", "got", "it", "sir", "madam", "ji",
+    "namaste", "namaskar", "dhanyavad", "dhanyawad", "shukriya", "accha", "acha", "achha", "theek",
+    "thik", "hai", "haan", "bahut", "badhiya", "bye-bye",
+    "धन्यवाद", "शुक्रिया", "नमस्ते", "नमस्कार", "ठीक", "है", "अच्छा", "हाँ", "हां", "जी", "बहुत", "बढ़िया",
+}
+
+# Function words that carry no topic (English, Hinglish, Hindi)
+STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "to", "of", "in", "on", "for", "with", "and", "or",
+    "do", "does", "did", "can", "could", "will", "would", "should", "please", "me", "my", "i", "we", "us",
+    "what", "which", "about", "give", "tell", "show", "some", "one", "any", "so", "as", "at", "by", "from",
+    "kya", "kaise", "kyun", "kyon", "hai", "hain", "ho", "ka", "ki", "ke", "ko", "se", "me", "mein", "par",
+    "do", "de", "dijiye", "na", "nahi", "bhi", "to", "toh", "thoda", "zara", "ek", "koi",
+    "क्या", "कैसे", "क्यों", "है", "हैं", "हो", "का", "की", "के", "को", "से", "में", "पर", "दो", "दीजिए",
+    "ना", "नहीं", "भी", "तो", "थोड़ा", "ज़रा", "एक", "कोई",
+}
+
+# Words that point back at the previous answer instead of naming a topic
+REFERENTIAL_WORDS = {
+    "it", "this", "that", "these", "those", "they", "them", "its", "more", "another", "other", "example",
+    "examples", "again", "explain", "elaborate", "detail", "details", "simpler", "simply", "shorter",
+    "why", "how", "same", "above", "previous", "last",
+    "aur", "iska", "iske", "isko", "ise", "yeh", "ye", "woh", "wo", "uska", "uske", "usko", "use",
+    "dobara", "phir", "fir", "samjhao", "samjhaiye", "batao", "bataiye", "udaharan", "aage",
+    "और", "इसका", "इसके", "इसको", "इसे", "यह", "ये", "वह", "वो", "उसका", "उसके", "उसे", "उदाहरण",
+    "फिर", "दोबारा", "समझाओ", "समझाइए", "बताओ", "बताइए", "आगे",
+}
+
+def choose_route(
+    query_text: str,
+    has_history: bool,
+    short_query_words: int,
+    smalltalk_max_words: int,
+    is_indexed_term: Optional[Callable[[str], bool]] = None,
+) -> Tuple[str, str]:
+    """
+    Pick the model tier for a query before retrieval runs.
+    Returns (route, reason); reason "smalltalk" also means retrieval can be skipped.
+
+    A short query in an ongoing session only goes to the small model when it
+    names no topic: nothing but stopwords and back-references ("aur example
+    do", "explain it again"), or back-references plus words the NCERT corpus
+    does not contain ("iska matlab kya hai"). New curriculum questions, however
+    short, stay on the large model.
+    """
+    words = tokenize(query_text)
+    if not words or (len(words) <= smalltalk_max_words and all(word in SMALLTALK_WORDS for word in words)):
+        return SMALL, "smalltalk"
+    if has_history and len(words) <= short_query_words:
+        content = [
+            word for word in words
+            if word not in STOPWORDS and word not in REFERENTIAL_WORDS and word not in SMALLTALK_WORDS
+        ]
+        if not content:
+            return SMALL, "short_followup"
+        referential = any(word in REFERENTIAL_WORDS for word in words)
+        if referential and is_indexed_term is not None and not any(is_indexed_term(word) for word in content):
+            return SMALL, "referential_followup"
+    return LARGE, "substantive"
+
+class RouteStats:
+    """Decisions per reason and end-to-end latency per route, for tuning the thresholds."""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self.window = window
+        self.reasons: Dict[str, int] = {}
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._counts: Dict[str, int] = {}
+
+    def record(self, route: str, reason: str, latency_ms: float):
+        with self._lock:
+            self.reasons[reason] = self.reasons.get(reason, 0) + 1
+            self._counts[route] = self._counts.get(route, 0) + 1
+            self._latencies.setdefault(route, deque(maxlen=self.window)).append(latency_ms)
+
+    def stats(self) -> dict:
+        with self._lock:
+            routes = {}
+            for route, samples in self._latencies.items():
+                ordered = sorted(samples)
+                routes[route] = {
+                    "requests": self._counts[route],
+                    "avg_ms": round(sum(ordered) / len(ordered), 1),
+                    "p50_ms": round(ordered[len(ordered) // 2], 1),
+                    "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 1),
+                    "max_ms": round(ordered[-1], 1),
+                }
+            return {"reasons": dict(self.reasons), "routes": routes, "window": self.window}
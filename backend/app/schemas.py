@@ -12,6 +12,8 @@ class AIResponse(BaseModel):
     detected_language: str = "Unknown"
     query_text: Optional[str] = None  # For voice queries, return transcribed text
     session_id: Optional[str] = None  # New: return session_id to frontend
+    message_id: Optional[str] = None  # Send back as last_message_id on the next query
+    incomplete: bool = False  # Streaming only: the LLM stream broke off; answer_text is what was delivered
 
 class LoginRequest(BaseModel):
     email: EmailStr
@@ -43,8 +45,9 @@ class ChatMessage(BaseModel):
 
 class QueryRequest(BaseModel):
     query_text: str
-    chat_history: Optional[List[ChatMessage]] = None
     session_id: Optional[str] = None  # New: track conversation session
+    last_message_id: Optional[str] = None  # message_id of the last answer the client has seen
+    chat_history: Optional[List[ChatMessage]] = None  # Deprecated: only used if the server has no history for the session
     
 class ChatHistoryResponse(BaseModel):
     id: str
@@ -58,6 +61,21 @@ class ChatHistoryResponse(BaseModel):
     source_type: str
     timestamp: datetime
 
+class ChatHistoryPage(BaseModel):
+    items: List[ChatHistoryResponse]
+    next_cursor: Optional[str] = None  # Pass back as ?cursor= for older messages
+
+class SessionSummaryResponse(BaseModel):
+    session_id: str
+    first_query: str
+    started_at: datetime
+    last_timestamp: datetime
+    message_count: int
+
+class SessionPage(BaseModel):
+    items: List[SessionSummaryResponse]
+    next_cursor: Optional[str] = None
+
 class TeacherProfileResponse(BaseModel):
     id: str
     name: str
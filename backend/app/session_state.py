@@ -0,0 +1,387 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from app.config import settings
+
+# fn(current value or None) -> new value, or None to delete the key
+Updater = Callable[[Optional[Any]], Optional[Any]]
+
+_GONE = object()
+
+class SessionStateBackend(ABC):
+    """
+    Small keyed store for per-session state (conversation memory, WhatsApp
+    login state). Values are JSON-serializable. `update` is an atomic
+    read-modify-write of one key, so concurrent requests for the same session
+    never lose each other's changes - across threads for the in-process
+    backend, across worker processes for the shared ones.
+    """
+
+    @abstractmethod
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    def update(self, namespace: str, key: str, fn: Updater) -> Optional[Any]:
+        """Apply `fn` to the current value and store the result (None deletes). Returns the new value."""
+
+    def set(self, namespace: str, key: str, value: Any):
+        self.update(namespace, key, lambda _: value)
+
+    def delete(self, namespace: str, key: str):
+        self.update(namespace, key, lambda _: None)
+
+    def pop(self, namespace: str, key: str) -> Optional[Any]:
+        """Remove a key and return its value."""
+        removed = []
+        self.update(namespace, key, lambda current: removed.append(current))  # append() -> None deletes
+        return removed[0]
+
+    def stats(self) -> dict:
+        return {"backend": type(self).__name__}
+
+# Idle TTL per namespace (seconds); namespaces not listed use the backend default
+_namespace_ttl: Dict[str, float] = {}
+
+def set_namespace_ttl(namespace: str, seconds: float):
+    """Give a namespace its own idle TTL (e.g. WhatsApp logins outlive chat memory)."""
+    _namespace_ttl[namespace] = seconds
+
+# Namespaces whose entries only ever expire by TTL, never by the size caps
+_pinned_namespaces: Set[str] = set()
+
+def pin_namespace(namespace: str):
+    """
+    Exempt a namespace from LRU eviction, so a burst of web chats cannot log
+    WhatsApp users out. Keep it to small values with a TTL.
+    """
+    _pinned_namespaces.add(namespace)
+
+class InProcessSessionState(SessionStateBackend):
+    """
+    Default: an LRU dict in this process (single worker only).
+
+    Bounded by entry count and by bytes of serialized state; entries idle for
+    longer than their namespace's TTL expire. Entries pushed out by the caps
+    (not expired ones) can spill to a SQLite file and are promoted back on
+    their next access. Spill reads and writes happen outside the main lock,
+    so hits never wait on disk. Pinned namespaces (see pin_namespace) are kept apart:
+    they do not count against the caps and are only ever expired.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl_seconds: float = 6 * 3600,
+        spill: Optional["SQLiteSessionState"] = None,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.spill = spill
+        self._lock = threading.Lock()
+        # (namespace, key) -> (JSON payload, expires_at); least recently used first
+        self._data: "OrderedDict[Tuple[str, str], Tuple[str, float]]" = OrderedDict()
+        self._bytes = 0
+        # Same layout for pinned namespaces, outside the caps
+        self._pinned: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        self._pinned_bytes = 0
+        self._next_sweep = 0.0
+        # Evicted payloads on their way to the spill file (None: taken back or deleted since)
+        self._spilling: Dict[Tuple[str, str], Optional[str]] = {}
+        # Serializes spill I/O, so a key never moves between memory and the file unseen
+        self._spill_lock = threading.Lock()
+
+        self.evicted = 0
+        self.expired = 0
+        self.spilled = 0
+        self.restored = 0
+
+    def _ttl(self, namespace: str) -> float:
+        return _namespace_ttl.get(namespace, self.ttl_seconds)
+
+    def _contains(self, key: Tuple[str, str]) -> bool:
+        return key in self._data or key in self._pinned
+
+    def _remove(self, key: Tuple[str, str]):
+        if key in self._pinned:
+            payload, _ = self._pinned.pop(key)
+            self._pinned_bytes -= len(payload)
+            return
+        payload, _ = self._data.pop(key)
+        self._bytes -= len(payload)
+
+    def _put(self, key: Tuple[str, str], payload: str, now: float):
+        if self._contains(key):
+            self._remove(key)
+        item = (payload, now + self._ttl(key[0]))
+        if key[0] in _pinned_namespaces:
+            self._pinned[key] = item
+            self._pinned_bytes += len(payload)
+        else:
+            self._data[key] = item
+            self._bytes += len(payload)
+
+    def _lookup(self, key: Tuple[str, str], now: float) -> Tuple[bool, Optional[str]]:
+        """
+        (known, payload) from memory only (caller holds the lock). `known` is
+        False when the spill file has to be asked.
+        """
+        item = self._data.get(key) or self._pinned.get(key)
+        if item is not None:
+            if item[1] > now:
+                return True, item[0]
+            self._remove(key)
+            self.expired += 1
+        if key in self._spilling:
+            # Evicted but not written out yet: take it back (or see the delete).
+            # The tombstone tells the spill writer its copy is stale.
+            payload = self._spilling[key]
+            self._spilling[key] = None
+            return True, payload
+        return self.spill is None, None
+
+    def _enforce_limits(self, now: float) -> List[Tuple[Tuple[str, str], str]]:
+        """Apply the caps (caller holds the lock). Returns entries to write to the spill after releasing it."""
+        evicted = []
+        while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+            key, (payload, expires_at) = next(iter(self._data.items()))
+            self._remove(key)
+            if expires_at <= now:
+                self.expired += 1
+                continue
+            self.evicted += 1
+            if self.spill is not None:
+                self._spilling[key] = payload
+                evicted.append((key, payload))
+
+        if now >= self._next_sweep:
+            # TTLs differ per namespace, so expired entries are not all at the LRU end
+            for entries in (self._data, self._pinned):
+                for key in [k for k, (_, expires_at) in entries.items() if expires_at <= now]:
+                    self._remove(key)
+                    self.expired += 1
+            self._next_sweep = now + 60
+        return evicted
+
+    def _spill_out(self, evicted: List[Tuple[Tuple[str, str], str]]):
+        """Write evicted entries to the spill file without holding the main lock."""
+        if not evicted:
+            return
+        with self._spill_lock:
+            for key, payload in evicted:
+                with self._lock:
+                    current = self._spilling.get(key, _GONE)
+                    if current is not payload:
+                        # Taken back (tombstone) or evicted again; the newest eviction writes it
+                        if current is None:
+                            del self._spilling[key]
+                        continue
+                self.spill.set(*key, json.loads(payload))
+                with self._lock:
+                    current = self._spilling.pop(key, _GONE)
+                    if current is payload:
+                        self.spilled += 1
+                        continue
+                    if current is not None:
+                        if current is not _GONE:
+                            self._spilling[key] = current  # Evicted again; its own write follows
+                        continue
+                # Taken back into memory (or deleted) while being written: memory wins
+                self.spill.delete(*key)
+
+    def _access(self, namespace: str, key: str, fn: Updater, write: bool) -> Optional[Any]:
+        now = time.monotonic()
+        with self._lock:
+            known, payload = self._lookup((namespace, key), now)
+            if known:
+                value, evicted = self._apply((namespace, key), payload, fn, write, now)
+        if not known:
+            # Unknown key: ask the spill file outside the main lock. The spill lock
+            # keeps the key from moving between memory and the file meanwhile.
+            with self._spill_lock:
+                restored = self.spill.pop(namespace, key)
+                with self._lock:
+                    known, payload = self._lookup((namespace, key), now)
+                    if not known and restored is not None:
+                        payload = json.dumps(restored, ensure_ascii=False)
+                        self.restored += 1
+                    value, evicted = self._apply((namespace, key), payload, fn, write, now)
+        self._spill_out(evicted)
+        return value
+
+    def _apply(self, key: Tuple[str, str], payload: Optional[str], fn: Updater, write: bool, now: float):
+        """Run a get (`write` False) or an update on a looked-up payload (caller holds the lock)."""
+        current = json.loads(payload) if payload is not None else None
+        if not write:
+            if payload is not None:
+                self._put(key, payload, now)  # Reading counts as activity
+            return current, self._enforce_limits(now)
+        value = fn(current)
+        if value is None:
+            if self._contains(key):
+                self._remove(key)
+        else:
+            self._put(key, json.dumps(value, ensure_ascii=False), now)
+        return value, self._enforce_limits(now)
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        # Callers get a fresh copy, so they cannot mutate state outside update()
+        return self._access(namespace, key, None, write=False)
+
+    def update(self, namespace: str, key: str, fn: Updater) -> Optional[Any]:
+        return self._access(namespace, key, fn, write=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            namespaces: Dict[str, int] = {}
+            for namespace, _ in [*self._data, *self._pinned]:
+                namespaces[namespace] = namespaces.get(namespace, 0) + 1
+            stats = {
+                "backend": "memory",
+                "keys": len(self._data),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "namespaces": namespaces,
+                "pinned_keys": len(self._pinned),
+                "pinned_bytes": self._pinned_bytes,
+                "evicted": self.evicted,
+                "expired": self.expired,
+                "spilled": self.spilled,
+                "restored": self.restored,
+            }
+        stats["spill"] = self.spill.stats() if self.spill is not None else None
+        return stats
+
+class SQLiteSessionState(SessionStateBackend):
+    """
+    Shared backend for several workers on one host: a SQLite database in WAL
+    mode. Reads never block; each update is one short BEGIN IMMEDIATE
+    transaction, which serializes writers across processes. Rows idle past
+    their namespace's TTL are ignored and purged periodically.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float = 6 * 3600):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._next_purge = 0.0
+        self.purged = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._local = threading.local()
+        conn = self._conn()
+        # Several workers may start at once; switching to WAL takes an exclusive
+        # lock that does not wait on the busy timeout, so retry briefly
+        for attempt in range(50):
+            try:
+                if conn.execute("PRAGMA journal_mode").fetchone()[0].lower() != "wal":
+                    conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS session_state ("
+                    " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, updated_at REAL NOT NULL,"
+                    " PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+                )
+                break
+            except sqlite3.OperationalError:
+                if attempt == 49:
+                    raise
+                time.sleep(0.1)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _fresh_after(self, namespace: str) -> float:
+        return time.time() - _namespace_ttl.get(namespace, self.ttl_seconds)
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        row = self._conn().execute(
+            "SELECT value FROM session_state WHERE namespace = ? AND key = ? AND updated_at >= ?",
+            (namespace, key, self._fresh_after(namespace))
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, namespace: str, key: str, fn: Updater) -> Optional[Any]:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value FROM session_state WHERE namespace = ? AND key = ? AND updated_at >= ?",
+                (namespace, key, self._fresh_after(namespace))
+            ).fetchone()
+            value = fn(json.loads(row[0]) if row else None)
+            if value is None:
+                conn.execute("DELETE FROM session_state WHERE namespace = ? AND key = ?", (namespace, key))
+            else:
+                conn.execute(
+                    "INSERT INTO session_state (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                    (namespace, key, json.dumps(value, ensure_ascii=False), time.time())
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if time.monotonic() >= self._next_purge:
+            self._next_purge = time.monotonic() + 60
+            self.purge()
+        return value
+
+    def purge(self):
+        """Delete rows idle past their namespace's TTL."""
+        conn = self._conn()
+        now = time.time()
+        removed = 0
+        for namespace, ttl in _namespace_ttl.items():
+            removed += conn.execute(
+                "DELETE FROM session_state WHERE namespace = ? AND updated_at < ?", (namespace, now - ttl)
+            ).rowcount
+        placeholders = ",".join("?" * len(_namespace_ttl))
+        removed += conn.execute(
+            f"DELETE FROM session_state WHERE namespace NOT IN ({placeholders}) AND updated_at < ?",
+            (*_namespace_ttl, now - self.ttl_seconds)
+        ).rowcount
+        self.purged += removed
+
+    def stats(self) -> dict:
+        keys, size = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM session_state"
+        ).fetchone()
+        return {"backend": "sqlite", "path": self.path, "keys": keys, "bytes": size, "purged": self.purged}
+
+def create_session_state(backend: str = None) -> SessionStateBackend:
+    backend = (backend or settings.SESSION_STATE_BACKEND).lower()
+    if backend == "sqlite":
+        return SQLiteSessionState(settings.SESSION_STATE_PATH, ttl_seconds=settings.SESSION_STATE_TTL_SECONDS)
+    if backend != "memory":
+        print(f"[SessionState] Unknown backend '{backend}', using in-process state")
+    spill = None
+    if settings.SESSION_STATE_SPILL_PATH:
+        spill = SQLiteSessionState(settings.SESSION_STATE_SPILL_PATH, ttl_seconds=settings.SESSION_STATE_TTL_SECONDS)
+    return InProcessSessionState(
+        max_entries=settings.SESSION_STATE_MAX_ENTRIES,
+        max_bytes=settings.SESSION_STATE_MAX_BYTES,
+        ttl_seconds=settings.SESSION_STATE_TTL_SECONDS,
+        spill=spill
+    )
+
+_session_state: Optional[SessionStateBackend] = None
+_session_state_lock = threading.Lock()
+
+def get_session_state() -> SessionStateBackend:
+    global _session_state
+    if _session_state is None:
+        with _session_state_lock:
+            if _session_state is None:
+                _session_state = create_session_state()
+    return _session_state
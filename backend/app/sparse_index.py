@@ -0,0 +1,594 @@
+import fcntl
+import heapq
+import json
+import math
+import mmap
+import os
+import string
+import struct
+import threading
+import uuid
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from difflib import SequenceMatcher
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+_STRIP_CHARS = string.punctuation + "।॥“”‘’"
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase whitespace tokenizer that trims punctuation (keeps Devanagari matras intact)."""
+    tokens = []
+    for raw in text.lower().split():
+        token = raw.strip(_STRIP_CHARS)
+        if token:
+            tokens.append(token)
+    return tokens
+
+# Segment file layout (little endian):
+#   header:  magic, version, n_docs, n_terms, total_length
+#   table:   (offset, length) for each section below
+#   sections (8-byte aligned):
+SEGMENT_MAGIC = b"SMBM25\x00\x01"
+SEGMENT_VERSION = 1
+_HEADER = struct.Struct("<8sIIIQ")
+_SECTIONS = [
+    "term_offsets", "term_blob",        # sorted vocabulary (string table)
+    "post_offsets", "post_slots", "post_tfs",  # postings per term
+    "doc_lengths",
+    "id_offsets", "id_blob",
+    "text_offsets", "text_blob",
+    "meta_offsets", "meta_blob",        # JSON metadata
+    "source_offsets", "source_blob",    # metadata["source"], for delete-by-source
+]
+_TABLE = struct.Struct("<" + "QQ" * len(_SECTIONS))
+
+def _string_table(values: List[str]) -> Tuple[np.ndarray, bytes]:
+    encoded = [v.encode("utf-8") for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    if encoded:
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+    return offsets, b"".join(encoded)
+
+def write_segment(path: str, ids: List[str], texts: List[str], metadatas: List[dict]):
+    """Write an immutable index segment for the given chunks (atomically via rename)."""
+    postings: Dict[str, List[Tuple[int, int]]] = {}
+    lengths = np.zeros(len(texts), dtype=np.uint32)
+    for slot, text in enumerate(texts):
+        counts = Counter(tokenize(text))
+        lengths[slot] = sum(counts.values())
+        for term, tf in counts.items():
+            postings.setdefault(term, []).append((slot, tf))
+
+    terms = sorted(postings)
+    post_offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+    post_offsets[1:] = np.cumsum([len(postings[t]) for t in terms])
+    post_slots = np.fromiter((slot for t in terms for slot, _ in postings[t]), dtype=np.uint32)
+    post_tfs = np.fromiter((tf for t in terms for _, tf in postings[t]), dtype=np.uint32)
+
+    metadatas = [m or {} for m in metadatas]
+    term_offsets, term_blob = _string_table(terms)
+    id_offsets, id_blob = _string_table(ids)
+    text_offsets, text_blob = _string_table(texts)
+    meta_offsets, meta_blob = _string_table([json.dumps(m, ensure_ascii=False) for m in metadatas])
+    source_offsets, source_blob = _string_table([str(m.get("source", "")) for m in metadatas])
+
+    sections = {
+        "term_offsets": term_offsets.tobytes(), "term_blob": term_blob,
+        "post_offsets": post_offsets.tobytes(), "post_slots": post_slots.tobytes(), "post_tfs": post_tfs.tobytes(),
+        "doc_lengths": lengths.tobytes(),
+        "id_offsets": id_offsets.tobytes(), "id_blob": id_blob,
+        "text_offsets": text_offsets.tobytes(), "text_blob": text_blob,
+        "meta_offsets": meta_offsets.tobytes(), "meta_blob": meta_blob,
+        "source_offsets": source_offsets.tobytes(), "source_blob": source_blob,
+    }
+
+    table = []
+    position = _HEADER.size + _TABLE.size
+    payload = bytearray()
+    for name in _SECTIONS:
+        data = sections[name]
+        padding = -position % 8
+        payload += b"\x00" * padding
+        position += padding
+        table.extend([position, len(data)])
+        payload += data
+        position += len(data)
+
+    tmp_path = f"{path}.tmp-{uuid.uuid4().hex[:8]}"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, len(texts), len(terms), int(lengths.sum())))
+        f.write(_TABLE.pack(*table))
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class _StringTable:
+    """Read-only sequence view over (offsets, utf-8 blob) stored in a mapped segment."""
+
+    def __init__(self, offsets: np.ndarray, blob: memoryview):
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return bytes(self._blob[int(self._offsets[i]):int(self._offsets[i + 1])]).decode("utf-8")
+
+class IndexSegment:
+    """Memory-mapped, immutable BM25 segment. Pages are shared between worker processes."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._mmap)
+        magic, version, self.n_docs, self.n_terms, self.total_length = _HEADER.unpack_from(buf, 0)
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+            raise ValueError(f"Not a BM25 segment: {path}")
+        table = _TABLE.unpack_from(buf, _HEADER.size)
+        raw = {name: buf[table[2 * i]:table[2 * i] + table[2 * i + 1]] for i, name in enumerate(_SECTIONS)}
+
+        def array(name, dtype):
+            return np.frombuffer(raw[name], dtype=dtype)
+
+        self.terms = _StringTable(array("term_offsets", np.uint64), raw["term_blob"])
+        self._post_offsets = array("post_offsets", np.uint64)
+        self._post_slots = array("post_slots", np.uint32)
+        self._post_tfs = array("post_tfs", np.uint32)
+        self.doc_lengths = array("doc_lengths", np.uint32)
+        self.ids = _StringTable(array("id_offsets", np.uint64), raw["id_blob"])
+        self._texts = _StringTable(array("text_offsets", np.uint64), raw["text_blob"])
+        self._metas = _StringTable(array("meta_offsets", np.uint64), raw["meta_blob"])
+        self.sources = _StringTable(array("source_offsets", np.uint64), raw["source_blob"])
+
+    def postings(self, term: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        i = bisect_left(self.terms, term)
+        if i == len(self.terms) or self.terms[i] != term:
+            return None
+        start, end = int(self._post_offsets[i]), int(self._post_offsets[i + 1])
+        return self._post_slots[start:end], self._post_tfs[start:end]
+
+    def text(self, slot: int) -> str:
+        return self._texts[slot]
+
+    def document(self, slot: int) -> Document:
+        return Document(page_content=self._texts[slot], metadata=json.loads(self._metas[slot]), id=self.ids[slot])
+
+    def close(self):
+        # Views into the map may still be referenced by in-flight searches; let GC release it
+        self._mmap = None
+
+class BM25Index:
+    """
+    Persistent Okapi BM25 index made of memory-mapped segments.
+
+    Each ingest writes one new segment containing only the new chunks, and a
+    JSON manifest lists the live segments plus tombstoned (deleted) slots.
+    Workers open the segments with mmap instead of re-tokenizing the corpus,
+    and reload when another process changes the manifest. Segments are merged
+    size-tiered: once `merge_factor` segments of about the same live size
+    exist they become one segment of the next tier, so a merge rewrites only
+    segments of similar size and the segment count stays logarithmic.
+
+    IDF uses the non-negative Lucene form log(1 + (N - df + 0.5) / (df + 0.5)),
+    so adding documents needs no global recomputation.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, directory: str, k1: float = 1.5, b: float = 0.75, merge_factor: int = 4):
+        self.directory = directory
+        self.k1 = k1
+        self.b = b
+        self.merge_factor = max(2, merge_factor)
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._segments: List[IndexSegment] = []
+        self._deleted: Dict[str, Set[int]] = {}  # segment name -> tombstoned slots
+        self._masks: Dict[str, np.ndarray] = {}
+        self._df_adjust: Counter = Counter()  # term -> postings hidden by tombstones
+        self._n_docs = 0
+        self._total_length = 0
+        self._id_locations: Optional[Dict[str, Tuple[str, int]]] = None
+        self._manifest_mtime = None
+        self._reload()
+
+    @property
+    def _manifest_path(self) -> str:
+        return os.path.join(self.directory, self.MANIFEST)
+
+    @contextmanager
+    def _write_lock(self):
+        """Serialize manifest updates across worker processes."""
+        with self._lock, open(os.path.join(self.directory, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._reload()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_manifest(self) -> dict:
+        try:
+            with open(self._manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"segments": [], "deleted": {}}
+
+    def _write_manifest(self, segments: List[str], deleted: Dict[str, Set[int]]):
+        manifest = {
+            "segments": segments,
+            "deleted": {name: sorted(slots) for name, slots in deleted.items() if slots},
+        }
+        tmp_path = f"{self._manifest_path}.tmp-{uuid.uuid4().hex[:8]}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._manifest_path)
+        self._reload()
+
+    def _manifest_version(self):
+        try:
+            stat = os.stat(self._manifest_path)
+        except FileNotFoundError:
+            return None
+        # The manifest is replaced atomically, so a new inode means a new version
+        return stat.st_mtime_ns, stat.st_ino
+
+    def _manifest_changed(self) -> bool:
+        return self._manifest_version() != self._manifest_mtime
+
+    def _reload(self):
+        with self._lock:
+            if not self._manifest_changed():
+                return
+            opened = {seg.name: seg for seg in self._segments}
+            for attempt in range(5):
+                version = self._manifest_version()
+                manifest = self._read_manifest()
+                fresh = []
+                try:
+                    segments = []
+                    for name in manifest["segments"]:
+                        segment = opened.get(name)
+                        if segment is None:
+                            segment = IndexSegment(os.path.join(self.directory, name))
+                            fresh.append(segment)
+                        segments.append(segment)
+                    break
+                except FileNotFoundError:
+                    # A writer merged the segment away after we read the manifest; the
+                    # manifest that replaced it is already in place, so read it again
+                    for segment in fresh:
+                        segment.close()
+                    if attempt == 4:
+                        raise
+            self._manifest_mtime = version
+            live = {segment.name for segment in segments}
+            for name, stale in opened.items():
+                if name not in live:
+                    stale.close()
+
+            self._segments = segments
+            self._deleted = {name: set(slots) for name, slots in manifest.get("deleted", {}).items()}
+            self._masks = {}
+            self._df_adjust = Counter()
+            self._n_docs = 0
+            self._total_length = 0
+            for segment in segments:
+                deleted = self._deleted.get(segment.name, set())
+                self._n_docs += segment.n_docs - len(deleted)
+                self._total_length += segment.total_length
+                if deleted:
+                    mask = np.zeros(segment.n_docs, dtype=bool)
+                    mask[list(deleted)] = True
+                    self._masks[segment.name] = mask
+                    for slot in deleted:
+                        self._total_length -= int(segment.doc_lengths[slot])
+                        self._df_adjust.update(set(tokenize(segment.text(slot))))
+            self._id_locations = None
+
+    @property
+    def version(self):
+        """Changes whenever the set of indexed chunks changes."""
+        return self._manifest_mtime
+
+    def refresh(self):
+        """Pick up segments written by other worker processes."""
+        if self._manifest_changed():
+            self._reload()
+
+    def __len__(self) -> int:
+        self.refresh()
+        return self._n_docs
+
+    def _live_df(self, term: str, segments: List[IndexSegment], df_adjust: Counter) -> int:
+        postings = (segment.postings(term) for segment in segments)
+        return sum(len(p[0]) for p in postings if p is not None) - df_adjust.get(term, 0)
+
+    @property
+    def vocabulary(self) -> Iterable[str]:
+        """Terms of live documents only; terms left behind by tombstoned chunks are skipped."""
+        segments, df_adjust = list(self._segments), self._df_adjust
+        seen = set()
+        for segment in segments:
+            for i in range(len(segment.terms)):
+                term = segment.terms[i]
+                if term in seen:
+                    continue
+                seen.add(term)
+                if term in df_adjust and self._live_df(term, segments, df_adjust) <= 0:
+                    continue
+                yield term
+
+    def has_term(self, term: str) -> bool:
+        """Whether `term` occurs in a live document (one bisect per segment)."""
+        self.refresh()
+        return self._live_df(term, list(self._segments), self._df_adjust) > 0
+
+    def _locations(self) -> Dict[str, Tuple[str, int]]:
+        """Lazily built id -> (segment, slot) map; only needed on the write path."""
+        if self._id_locations is None:
+            locations = {}
+            for segment in self._segments:
+                deleted = self._deleted.get(segment.name, set())
+                for slot in range(segment.n_docs):
+                    if slot not in deleted:
+                        locations[segment.ids[slot]] = (segment.name, slot)
+            self._id_locations = locations
+        return self._id_locations
+
+    def contains(self, doc_id: str) -> bool:
+        with self._lock:
+            return doc_id in self._locations()
+
+    def add_documents(self, ids: List[str], texts: List[str], metadatas: List[dict]):
+        if not ids:
+            return
+        with self._write_lock():
+            deleted = {name: set(slots) for name, slots in self._deleted.items()}
+            locations = self._locations()
+            for doc_id in ids:
+                if doc_id in locations:
+                    name, slot = locations[doc_id]
+                    deleted.setdefault(name, set()).add(slot)
+
+            name = f"seg-{uuid.uuid4().hex[:12]}.bin"
+            write_segment(os.path.join(self.directory, name), ids, texts, metadatas)
+            segment_names = [seg.name for seg in self._segments] + [name]
+            self._write_manifest(segment_names, deleted)
+            self._merge_tiers()
+
+    def _remove_where(self, predicate) -> List[str]:
+        with self._write_lock():
+            deleted = {name: set(slots) for name, slots in self._deleted.items()}
+            removed = []
+            for segment in self._segments:
+                seg_deleted = deleted.setdefault(segment.name, set())
+                for slot in range(segment.n_docs):
+                    if slot not in seg_deleted and predicate(segment, slot):
+                        seg_deleted.add(slot)
+                        removed.append(segment.ids[slot])
+            if removed:
+                self._write_manifest([seg.name for seg in self._segments], deleted)
+            return removed
+
+    def remove_ids(self, ids: Iterable[str]) -> int:
+        targets = set(ids)
+        return len(self._remove_where(lambda segment, slot: segment.ids[slot] in targets))
+
+    def remove_source(self, source: str) -> List[str]:
+        """Tombstone every chunk ingested from `source`. Returns the removed ids."""
+        return self._remove_where(lambda segment, slot: segment.sources[slot] == source)
+
+    def _tier(self, segment: IndexSegment) -> int:
+        live = segment.n_docs - len(self._deleted.get(segment.name, ()))
+        return int(math.log(max(live, 1), self.merge_factor))
+
+    def _merge_tiers(self):
+        """
+        Merge every tier holding `merge_factor` or more segments, smallest tier
+        first, until none does (caller holds the write lock). Tiers go by live
+        documents, so heavily tombstoned segments sink and get rewritten early.
+        """
+        while True:
+            tiers: Dict[int, List[IndexSegment]] = {}
+            for segment in self._segments:
+                tiers.setdefault(self._tier(segment), []).append(segment)
+            full = [tier for tier, members in tiers.items() if len(members) >= self.merge_factor]
+            if not full:
+                return
+            tier = min(full)
+            self._merge(tiers[tier])
+            print(f"[BM25] Merged {len(tiers[tier])} tier-{tier} segments ({len(self._segments)} segments left)")
+
+    def _merge(self, merging: List[IndexSegment]):
+        """Replace `merging` with one segment holding their live documents (caller holds the write lock)."""
+        ids, texts, metadatas = [], [], []
+        for segment in merging:
+            deleted = self._deleted.get(segment.name, set())
+            for slot in range(segment.n_docs):
+                if slot in deleted:
+                    continue
+                doc = segment.document(slot)
+                ids.append(doc.id)
+                texts.append(doc.page_content)
+                metadatas.append(doc.metadata)
+        old_names = {segment.name for segment in merging}
+        names = []
+        for segment in self._segments:
+            if segment.name not in old_names:
+                names.append(segment.name)
+            elif segment is merging[0] and ids:
+                names.append(f"seg-{uuid.uuid4().hex[:12]}.bin")
+                write_segment(os.path.join(self.directory, names[-1]), ids, texts, metadatas)
+        deleted = {name: slots for name, slots in self._deleted.items() if name not in old_names}
+        self._write_manifest(names, deleted)
+        self._remove_segment_files(old_names)
+
+    def _remove_segment_files(self, names: Iterable[str]):
+        # Workers that still map the old files keep them alive until they reload,
+        # and a worker that reads the old manifest afterwards retries in _reload
+        for name in names:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def _replace_all(self, ids: List[str], texts: List[str], metadatas: List[dict]):
+        """Swap in a single segment holding exactly these chunks (caller holds the write lock)."""
+        old_names = [seg.name for seg in self._segments]
+        name = f"seg-{uuid.uuid4().hex[:12]}.bin"
+        write_segment(os.path.join(self.directory, name), ids, texts, metadatas)
+        self._write_manifest([name], {})
+        self._remove_segment_files(old_names)
+
+    def rebuild(self, ids: List[str], texts: List[str], metadatas: List[dict]):
+        """Replace the whole index with a single segment built from the given chunks."""
+        with self._write_lock():
+            self._replace_all(ids, texts, metadatas)
+
+    def sync(self, expected_count: int, load_all) -> bool:
+        """
+        Rebuild from `load_all()` -> (ids, texts, metadatas) if the index does not
+        hold `expected_count` chunks. Only one worker rebuilds; the rest reload it.
+        """
+        self.refresh()
+        if len(self) == expected_count:
+            return False
+        with self._write_lock():
+            if len(self) == expected_count:
+                return False
+            self._replace_all(*load_all())
+        return True
+
+    def search(self, query: str, k: int = 3) -> List[Tuple[float, Document]]:
+        self.refresh()
+        term_counts = Counter(tokenize(query))
+        with self._lock:
+            segments = list(self._segments)
+            n_docs = self._n_docs
+            if not n_docs or not term_counts:
+                return []
+            avg_length = self._total_length / n_docs
+
+            # Document frequency across all segments, excluding tombstones
+            hits = {}
+            for term in term_counts:
+                per_segment = [(seg, seg.postings(term)) for seg in segments]
+                per_segment = [(seg, p) for seg, p in per_segment if p is not None]
+                df = sum(len(p[0]) for _, p in per_segment) - self._df_adjust.get(term, 0)
+                if df > 0:
+                    hits[term] = (df, per_segment)
+
+            candidates = []
+            for segment in segments:
+                scores = None
+                for term, (df, per_segment) in hits.items():
+                    postings = next((p for seg, p in per_segment if seg is segment), None)
+                    if postings is None:
+                        continue
+                    slots, tfs = postings
+                    idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                    tf = tfs.astype(np.float32)
+                    norm = tf + self.k1 * (1 - self.b + self.b * segment.doc_lengths[slots] / avg_length)
+                    if scores is None:
+                        scores = np.zeros(segment.n_docs, dtype=np.float32)
+                    scores[slots] += idf * term_counts[term] * tf * (self.k1 + 1) / norm
+                if scores is None:
+                    continue
+                mask = self._masks.get(segment.name)
+                if mask is not None:
+                    scores[mask] = 0.0
+                top = np.flatnonzero(scores)
+                if len(top) > k:
+                    top = top[np.argpartition(scores[top], -k)[-k:]]
+                candidates.extend((float(scores[slot]), segment, int(slot)) for slot in top)
+
+            best = heapq.nlargest(k, candidates, key=lambda c: c[0])
+            return [(score, segment.document(slot)) for score, segment, slot in best]
+
+def _trigrams(term: str) -> Set[str]:
+    padded = f"  {term} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class TrigramVocabulary:
+    """
+    Character-trigram index over the corpus vocabulary, used to map misspelled
+    query terms to indexed terms in a single lookup instead of one retrieval per keyword.
+    """
+
+    def __init__(self, terms: Iterable[str], min_similarity: float = 0.75, max_candidates: int = 20):
+        self.min_similarity = min_similarity
+        self.max_candidates = max_candidates
+        self._terms: List[str] = []
+        self._known: Set[str] = set()
+        self._postings: Dict[str, List[int]] = {}
+        for term in terms:
+            if len(term) < 3 or term in self._known:
+                continue
+            term_id = len(self._terms)
+            self._terms.append(term)
+            self._known.add(term)
+            for gram in _trigrams(term):
+                self._postings.setdefault(gram, []).append(term_id)
+
+    def __contains__(self, term: str) -> bool:
+        return term in self._known
+
+    def closest(self, term: str) -> Optional[str]:
+        grams = _trigrams(term)
+        overlap: Counter = Counter()
+        for gram in grams:
+            overlap.update(self._postings.get(gram, ()))
+        best, best_score = None, self.min_similarity
+        for term_id, shared in overlap.most_common(self.max_candidates):
+            candidate = self._terms[term_id]
+            # Cheap Dice bound before the exact ratio
+            if 2 * shared / (len(grams) + len(_trigrams(candidate))) < best_score - 0.25:
+                continue
+            score = SequenceMatcher(None, term, candidate).ratio()
+            if score > best_score:
+                best, best_score = candidate, score
+        return best
+
+    def correct(self, text: str, min_length: int = 4) -> Tuple[str, Dict[str, str]]:
+        """Replace out-of-vocabulary terms with their closest indexed spelling; known terms are kept as they are."""
+        corrections = {}
+        corrected = []
+        for token in tokenize(text):
+            if len(token) >= min_length and token not in self._known:
+                match = self.closest(token)
+                if match:
+                    corrections[token] = match
+                    token = match
+            corrected.append(token)
+        return " ".join(corrected), corrections
+
+class BM25IndexRetriever(BaseRetriever):
+    """
+    LangChain retriever over a live BM25Index (no rebuild when the index changes).
+    `rewrite`, if set, maps the query to the text BM25 actually searches, e.g.
+    spelling correction that the dense retriever next to it should not see.
+    """
+
+    index: Any
+    k: int = 3
+    rewrite: Optional[Callable[[str], str]] = None
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: Optional[CallbackManagerForRetrieverRun] = None
+    ) -> List[Document]:
+        if self.rewrite is not None:
+            query = self.rewrite(query)
+        return [doc for _, doc in self.index.search(query, self.k)]
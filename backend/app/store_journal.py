@@ -0,0 +1,232 @@
+import fcntl
+import glob
+import json
+import os
+import pickle
+import threading
+import time
+import zlib
+from datetime import datetime
+from typing import Optional
+
+_SNAPSHOT = "snapshot.pickle"
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if hasattr(value, "value"):  # Enums (UserRole)
+        return value.value
+    raise TypeError(f"Not JSON serializable: {type(value)}")
+
+class StoreJournal:
+    """
+    Durability for the in-memory store: an append-only write-ahead log plus
+    periodic snapshots.
+
+    Every mutation is appended to the current WAL segment as one checksummed
+    JSON line; a background thread flushes and fsyncs the segment every
+    `fsync_ms` (group commit), so writers only pay for a buffered write. After
+    `snapshot_every` records the store is snapshotted (raw column bytes, see
+    ChatLog.export) and a new segment is started, so recovery is one bulk
+    snapshot load plus at most `snapshot_every` replayed records.
+
+    Layout: snapshot.pickle (state + the first WAL segment it does not cover)
+    and wal-<seq>.log segments. A torn last line from a crash fails its
+    checksum and is truncated away on recovery.
+    """
+
+    def __init__(self, directory: str, fsync_ms: float = 50, snapshot_every: int = 10000):
+        self.directory = directory
+        self.fsync_interval = fsync_ms / 1000
+        self.snapshot_every = snapshot_every
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._store = None
+        self._owner = None
+        self._file = None
+        self._seq = 0
+        self._dirty = False
+        self._since_snapshot = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.appended = 0
+        self.fsyncs = 0
+        self.snapshots = 0
+        self.last_snapshot_ms = 0.0
+        self.recovered = {}
+
+    # Paths
+    def _wal_path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"wal-{seq:06d}.log")
+
+    def _wal_segments(self) -> list:
+        segments = []
+        for path in glob.glob(os.path.join(self.directory, "wal-*.log")):
+            try:
+                segments.append((int(os.path.basename(path)[4:-4]), path))
+            except ValueError:
+                continue
+        return sorted(segments)
+
+    def _fsync_dir(self):
+        if hasattr(os, "O_DIRECTORY"):
+            fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    # Recovery
+    def _replay_segment(self, path: str, store) -> int:
+        replayed = 0
+        with open(path, "rb+") as f:
+            offset = 0
+            for line in f:
+                try:
+                    checksum, payload = line.rstrip(b"\n").split(b" ", 1)
+                    if not line.endswith(b"\n") or int(checksum, 16) != zlib.crc32(payload):
+                        raise ValueError("checksum mismatch")
+                    record = json.loads(payload)
+                except ValueError:
+                    print(f"[Journal] Truncating torn record in {os.path.basename(path)} at byte {offset}")
+                    f.truncate(offset)
+                    break
+                store.apply(record["op"], record["data"])
+                offset += len(line)
+                replayed += 1
+        return replayed
+
+    def open(self, store):
+        """Recover `store` from disk, then journal its mutations from here on."""
+        # The in-memory database belongs to a single process; a second worker
+        # replaying and appending to the same log would corrupt it
+        self._owner = open(os.path.join(self.directory, "LOCK"), "a")
+        try:
+            fcntl.flock(self._owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._owner.close()
+            raise RuntimeError(f"{self.directory} is owned by another process")
+
+        started = time.perf_counter()
+        snapshot_rows = 0
+        first_seq = 1
+        snapshot_path = os.path.join(self.directory, _SNAPSHOT)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, "rb") as f:
+                snapshot = pickle.load(f)
+            store.load_state(snapshot["state"])
+            first_seq = snapshot["wal_seq"]
+            snapshot_rows = snapshot["state"]["chat_log"]["rows"]
+
+        replayed = 0
+        segments = [(seq, path) for seq, path in self._wal_segments() if seq >= first_seq]
+        for seq, path in segments:
+            replayed += self._replay_segment(path, store)
+
+        self._store = store
+        self._seq = segments[-1][0] if segments else first_seq
+        self._since_snapshot = replayed
+        self._file = open(self._wal_path(self._seq), "ab", buffering=1 << 20)
+        store.journal = self
+
+        self.recovered = {
+            "snapshot_messages": snapshot_rows,
+            "replayed_records": replayed,
+            "seconds": round(time.perf_counter() - started, 3),
+        }
+        print(f"[Journal] Recovered {snapshot_rows} messages from snapshot and replayed "
+              f"{replayed} WAL records in {self.recovered['seconds']}s")
+
+        self._thread = threading.Thread(target=self._run, name="store-journal", daemon=True)
+        self._thread.start()
+
+    # Writing
+    def append(self, op: str, data: dict):
+        """Called by the store while it holds its own lock, so records are in mutation order."""
+        payload = json.dumps({"op": op, "data": data}, default=_json_default, separators=(",", ":")).encode("utf-8")
+        with self._lock:
+            self._file.write(b"%08x %s\n" % (zlib.crc32(payload), payload))
+            self._dirty = True
+            self._since_snapshot += 1
+            self.appended += 1
+
+    def _sync(self):
+        with self._lock:
+            if not self._dirty or self._file is None:
+                return
+            self._file.flush()
+            fd = self._file.fileno()
+            self._dirty = False
+        os.fsync(fd)
+        self.fsyncs += 1
+
+    def _rotate(self):
+        """Start a new WAL segment (called with the store lock held, via snapshot_state)."""
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._seq += 1
+            self._file = open(self._wal_path(self._seq), "ab", buffering=1 << 20)
+            self._dirty = False
+            self._since_snapshot = 0
+
+    def snapshot(self):
+        """Write a compact snapshot and drop the WAL segments it covers."""
+        started = time.perf_counter()
+        state = self._store.snapshot_state(under_lock=self._rotate)
+        wal_seq = self._seq
+
+        path = os.path.join(self.directory, _SNAPSHOT)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"wal_seq": wal_seq, "state": state}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._fsync_dir()
+
+        for seq, segment in self._wal_segments():
+            if seq < wal_seq:
+                os.remove(segment)
+
+        self.snapshots += 1
+        self.last_snapshot_ms = (time.perf_counter() - started) * 1000
+        print(f"[Journal] Snapshot of {state['chat_log']['rows']} messages written in {self.last_snapshot_ms:.0f} ms")
+
+    def _run(self):
+        while not self._stop.wait(self.fsync_interval):
+            try:
+                self._sync()
+                if self._since_snapshot >= self.snapshot_every:
+                    self.snapshot()
+            except Exception as e:
+                print(f"[Journal] Background sync failed: {e}")
+
+    def close(self, snapshot: bool = True):
+        """Final fsync, plus a snapshot so the next start replays nothing."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._file is None:
+            return
+        if snapshot and self._since_snapshot:
+            self.snapshot()
+        self._sync()
+        with self._lock:
+            self._file.close()
+            self._file = None
+        self._owner.close()  # Releases the directory lock
+
+    def stats(self) -> dict:
+        return {
+            "wal_segment": self._seq,
+            "records_since_snapshot": self._since_snapshot,
+            "appended": self.appended,
+            "fsyncs": self.fsyncs,
+            "snapshots": self.snapshots,
+            "last_snapshot_ms": round(self.last_snapshot_ms, 2),
+            "recovered": self.recovered,
+        }
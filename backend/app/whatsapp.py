@@ -1,15 +1,15 @@
 from twilio.rest import Client
 from twilio.twiml.messaging_response import MessagingResponse
 from app.config import settings
-from app.ai import run_ai_pipeline, add_to_memory, transcribe_audio
-from app.database import get_user_by_email, save_chat_message, get_teacher_by_id
+from app.ai import run_ai_pipeline, transcribe_audio, sync_memory
+from app.database import get_user_by_email, persist_chat_message, get_teacher_by_id
 from app.models import ChatMessage
 from app.auth import verify_password
-from typing import Dict
+from app.concurrency import run_blocking
+from app.session_state import get_session_state, pin_namespace, set_namespace_ttl
 import uuid
 from datetime import datetime
 import httpx
-import io
 
 # Initialize Twilio client
 def get_twilio_client():
@@ -17,7 +17,7 @@ def get_twilio_client():
         return None
     return Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
 
-# Store WhatsApp user sessions
+# Store WhatsApp user sessions in the session-state backend (shared by all workers)
 # Key: phone_number, Value: {
 #   "session_id": str,
 #   "teacher_id": str,
@@ -25,27 +25,46 @@ def get_twilio_client():
 #   "login_state": "none|awaiting_email|awaiting_password",
 #   "temp_email": str
 # }
-whatsapp_sessions: Dict[str, dict] = {}
+WHATSAPP_NAMESPACE = "whatsapp"
+set_namespace_ttl(WHATSAPP_NAMESPACE, settings.WHATSAPP_SESSION_TTL_SECONDS)
+# Logins must not be evicted by web chat memory filling the in-process LRU
+pin_namespace(WHATSAPP_NAMESPACE)
+
+def _new_session() -> dict:
+    return {
+        "session_id": str(uuid.uuid4()),
+        "teacher_id": None,
+        "logged_in": False,
+        "login_state": "none",
+        "temp_email": None
+    }
 
 def get_or_create_session(phone_number: str) -> dict:
-    """Get existing session or create new one for WhatsApp user"""
-    if phone_number not in whatsapp_sessions:
-        whatsapp_sessions[phone_number] = {
-            "session_id": str(uuid.uuid4()),
-            "teacher_id": None,
-            "logged_in": False,
-            "login_state": "none",
-            "temp_email": None
-        }
-    return whatsapp_sessions[phone_number]
+    """Get existing session or create new one for WhatsApp user (a copy - change it via update_session)"""
+    state = get_session_state()
+    session = state.get(WHATSAPP_NAMESPACE, phone_number)
+    if session is None:
+        session = state.update(WHATSAPP_NAMESPACE, phone_number, lambda current: current or _new_session())
+    return session
+
+def update_session(phone_number: str, **changes) -> dict:
+    """Atomically apply field changes to a WhatsApp session"""
+    return get_session_state().update(
+        WHATSAPP_NAMESPACE, phone_number,
+        lambda current: {**(current or _new_session()), **changes}
+    )
 
 def clear_whatsapp_session(phone_number: str):
     """Clear conversation for a phone number but keep login info"""
-    if phone_number in whatsapp_sessions:
-        session = whatsapp_sessions[phone_number]
-        session["session_id"] = str(uuid.uuid4())  # New conversation ID
-        session["login_state"] = "none"
-        session["temp_email"] = None
+    get_session_state().update(
+        WHATSAPP_NAMESPACE, phone_number,
+        lambda current: {
+            **current,
+            "session_id": str(uuid.uuid4()),  # New conversation ID
+            "login_state": "none",
+            "temp_email": None
+        } if current else None
+    )
 
 async def handle_whatsapp_message(from_number: str, message_body: str) -> str:
     """
@@ -53,7 +72,7 @@ async def handle_whatsapp_message(from_number: str, message_body: str) -> str:
     Handles login flow and query processing
     """
     try:
-        session = get_or_create_session(from_number)
+        session = await run_blocking(get_or_create_session, from_number)
         logged_in = session["logged_in"]
         teacher_id = session["teacher_id"]
         
@@ -63,13 +82,12 @@ async def handle_whatsapp_message(from_number: str, message_body: str) -> str:
         if message_body.lower().strip() == "/login":
             if logged_in:
                 return "✅ आप पहले से लॉगिन हैं!\n\nYou're already logged in!"
-            session["login_state"] = "awaiting_email"
+            await run_blocking(update_session, from_number, login_state="awaiting_email")
             return "📧 कृपया अपना ईमेल दर्ज करें:\n\nPlease enter your email:"
         
         # If awaiting email
         if session["login_state"] == "awaiting_email":
-            session["temp_email"] = message_body.strip()
-            session["login_state"] = "awaiting_password"
+            await run_blocking(update_session, from_number, temp_email=message_body.strip(), login_state="awaiting_password")
             return "🔐 कृपया अपना पासवर्ड दर्ज करें:\n\nPlease enter your password:"
         
         # If awaiting password - authenticate
@@ -78,18 +96,21 @@ async def handle_whatsapp_message(from_number: str, message_body: str) -> str:
             password = message_body.strip()
             
             # Verify teacher credentials
-            user = get_user_by_email(email)
-            if not user or not verify_password(password, user.password_hash):
-                session["login_state"] = "none"
-                session["temp_email"] = None
+            user = await run_blocking(get_user_by_email, email)
+            if not user or not await run_blocking(verify_password, password, user.password_hash):
+                await run_blocking(update_session, from_number, login_state="none", temp_email=None)
                 return "❌ गलत ईमेल या पासवर्ड।\n\nInvalid email or password. Type /login to try again."
             
             # Success! Link WhatsApp to teacher
-            session["teacher_id"] = user.id
-            session["logged_in"] = True
-            session["login_state"] = "none"
-            session["temp_email"] = None
-            session["session_id"] = str(uuid.uuid4())  # Reset session for logged-in user
+            await run_blocking(
+                update_session,
+                from_number,
+                teacher_id=user.id,
+                logged_in=True,
+                login_state="none",
+                temp_email=None,
+                session_id=str(uuid.uuid4())  # Reset session for logged-in user
+            )
             
             print(f"[WhatsApp] ✅ Teacher {user.id} logged in via WhatsApp from {from_number}")
             return f"✅ स्वागत है {user.name}!\n\nWelcome {user.name}! You're now connected. Ask me anything in Hindi or English!"
@@ -98,14 +119,12 @@ async def handle_whatsapp_message(from_number: str, message_body: str) -> str:
         if message_body.lower().strip() == "/logout":
             if not logged_in:
                 return "आप लॉगिन नहीं हैं।\n\nYou're not logged in."
-            session["teacher_id"] = None
-            session["logged_in"] = False
-            session["session_id"] = str(uuid.uuid4())
+            await run_blocking(update_session, from_number, teacher_id=None, logged_in=False, session_id=str(uuid.uuid4()))
             return "👋 लॉग आउट हो गए। /login से दोबारा लॉगिन करें।\n\nLogged out. Use /login to log back in."
         
         # HANDLE SPECIAL COMMANDS
         if message_body.lower().strip() in ["/start", "/new", "/reset"]:
-            clear_whatsapp_session(from_number)
+            await run_blocking(clear_whatsapp_session, from_number)
             if not logged_in:
                 return "नमस्ते! /login से शुरुआत करें।\n\nHi! Start with /login"
             return "✨ नया चैट शुरू किया गया।\n\nNew conversation started!"
@@ -135,14 +154,18 @@ async def handle_whatsapp_message(from_number: str, message_body: str) -> str:
         session_id = session["session_id"]
         print(f"[WhatsApp] Processing query from teacher {teacher_id}, session {session_id}")
         
+        # Conversation memory idles out long before the WhatsApp login does
+        await sync_memory(session_id, teacher_id)
+        
         # Get AI response
-        response = await run_ai_pipeline(message_body, session_id)
+        message_id = str(uuid.uuid4())
+        response = await run_ai_pipeline(message_body, session_id, message_id)
         print(f"[WhatsApp] AI Response ready")
         
         # SAVE TO DATABASE
         try:
             chat_msg = ChatMessage(
-                id=str(uuid.uuid4()),
+                id=message_id,
                 session_id=session_id,
                 teacher_id=teacher_id,
                 query_text=message_body,
@@ -152,8 +175,8 @@ async def handle_whatsapp_message(from_number: str, message_body: str) -> str:
                 detected_language=response.detected_language,
                 source_type="whatsapp"
             )
-            save_chat_message(chat_msg)
-            print(f"[WhatsApp] Saved to database for teacher {teacher_id}")
+            await persist_chat_message(chat_msg)
+            print(f"[WhatsApp] Queued chat save for teacher {teacher_id}")
         except Exception as db_err:
             print(f"[WhatsApp] DB save error: {db_err}")
         
@@ -171,7 +194,7 @@ async def handle_whatsapp_voice(from_number: str, media_url: str, media_type: st
     Downloads audio from Twilio URL, transcribes it, and processes as text query
     """
     try:
-        session = get_or_create_session(from_number)
+        session = await run_blocking(get_or_create_session, from_number)
         logged_in = session["logged_in"]
         teacher_id = session["teacher_id"]
         
@@ -210,9 +233,7 @@ async def handle_whatsapp_voice(from_number: str, media_url: str, media_type: st
         
         # Transcribe audio
         try:
-            audio_file = io.BytesIO(audio_bytes)
-            audio_file.name = f"whatsapp_voice.{ext}"
-            transcribed_text = await transcribe_audio(audio_file)
+            transcribed_text = await transcribe_audio(audio_bytes, f"whatsapp_voice.{ext}")
             print(f"[WhatsApp Voice] Transcribed: {transcribed_text}")
         except Exception as trans_err:
             print(f"[WhatsApp Voice] Transcription error: {trans_err}")
@@ -225,13 +246,15 @@ async def handle_whatsapp_voice(from_number: str, media_url: str, media_type: st
         session_id = session["session_id"]
         print(f"[WhatsApp Voice] Processing query from teacher {teacher_id}, session {session_id}")
         
-        response = await run_ai_pipeline(transcribed_text, session_id)
+        await sync_memory(session_id, teacher_id)
+        message_id = str(uuid.uuid4())
+        response = await run_ai_pipeline(transcribed_text, session_id, message_id)
         print(f"[WhatsApp Voice] AI Response ready")
         
         # Save to database
         try:
             chat_msg = ChatMessage(
-                id=str(uuid.uuid4()),
+                id=message_id,
                 session_id=session_id,
                 teacher_id=teacher_id,
                 query_text=transcribed_text,
@@ -241,8 +264,8 @@ async def handle_whatsapp_voice(from_number: str, media_url: str, media_type: st
                 detected_language=response.detected_language,
                 source_type="whatsapp"
             )
-            save_chat_message(chat_msg)
-            print(f"[WhatsApp Voice] Saved to database for teacher {teacher_id}")
+            await persist_chat_message(chat_msg)
+            print(f"[WhatsApp Voice] Queued chat save for teacher {teacher_id}")
         except Exception as db_err:
             print(f"[WhatsApp Voice] DB save error: {db_err}")
         
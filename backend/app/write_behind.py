@@ -0,0 +1,325 @@
+import json
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+class DeadLetterFile:
+    """
+    Rows that could not be written even one at a time, kept as JSON lines so
+    they survive a restart. `take` moves the file aside while the rows are
+    retried; whatever fails again is appended back with its attempt count.
+    Rows that have failed `max_attempts` passes, the original flush included
+    (a poison row, e.g. a foreign-key violation), go to `<path>.quarantine`
+    and are never retried automatically.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        encode: Callable[[Any], dict],
+        decode: Callable[[dict], Any],
+        max_attempts: int = 5,
+    ):
+        self.path = path
+        self.quarantine_path = path + ".quarantine"
+        self.encode = encode
+        self.decode = decode
+        self.max_attempts = max(1, max_attempts)
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # A crash during a retry leaves the taken rows in .retrying
+        retrying = path + ".retrying"
+        if os.path.exists(retrying):
+            with open(retrying, "rb") as src, open(path, "ab") as dst:
+                dst.write(src.read())
+            os.remove(retrying)
+
+    @staticmethod
+    def _write_lines(path: str, lines: List[str]):
+        if not lines:
+            return
+        with open(path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append(self, rows: List[Any], attempts: Optional[List[int]] = None) -> int:
+        """
+        Store rows that failed; `attempts[i]` is how many dead-letter passes
+        row i has failed (1 for rows failing for the first time). Returns how
+        many went to quarantine instead.
+        """
+        attempts = attempts or [1] * len(rows)
+        retry, quarantine = [], []
+        for row, count in zip(rows, attempts):
+            line = json.dumps({"attempts": count, "row": self.encode(row)}, ensure_ascii=False, default=str) + "\n"
+            (quarantine if count >= self.max_attempts else retry).append(line)
+        with self._lock:
+            self._write_lines(self.path, retry)
+            self._write_lines(self.quarantine_path, quarantine)
+        return len(quarantine)
+
+    @staticmethod
+    def _count(path: str) -> int:
+        if not os.path.exists(path):
+            return 0
+        with open(path, "rb") as f:
+            return sum(1 for _ in f)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._count(self.path)
+
+    def quarantined(self) -> int:
+        with self._lock:
+            return self._count(self.quarantine_path)
+
+    def take(self) -> List[Tuple[Any, int]]:
+        """
+        Claim every stored row as (row, attempts so far); call `done` once
+        they have been written or re-appended.
+        """
+        with self._lock:
+            if not os.path.exists(self.path):
+                return []
+            retrying = self.path + ".retrying"
+            os.replace(self.path, retrying)
+            entries = []
+            with open(retrying, encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if set(record) == {"attempts", "row"}:
+                        entries.append((self.decode(record["row"]), record["attempts"]))
+                    else:
+                        entries.append((self.decode(record), 1))  # Written before attempts were counted
+            return entries
+
+    def done(self):
+        with self._lock:
+            try:
+                os.remove(self.path + ".retrying")
+            except FileNotFoundError:
+                pass
+
+class WriteBehindQueue:
+    """
+    Bounded queue drained by a background thread that hands rows to
+    `flush_batch` in groups of up to `batch_size`, or whatever arrived within
+    `flush_ms` of the first row. `submit` never blocks: when the queue is full
+    it returns False and the caller is expected to write the row itself.
+
+    `flush_batch` must be idempotent: a batch that keeps failing is retried
+    row by row, so one bad row cannot sink the rest. Rows that still fail go
+    to `dead_letter` and are retried every `dead_letter_retry_s` while idle.
+    """
+
+    def __init__(
+        self,
+        flush_batch: Callable[[List[Any]], None],
+        batch_size: int = 50,
+        flush_ms: float = 200,
+        max_pending: int = 10000,
+        retries: int = 3,
+        name: str = "write-behind",
+        dead_letter: Optional[DeadLetterFile] = None,
+        dead_letter_retry_s: float = 60,
+    ):
+        self.flush_batch = flush_batch
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_ms / 1000
+        self.retries = retries
+        self.name = name
+        self.dead_letter = dead_letter
+        self.dead_letter_retry_s = dead_letter_retry_s
+        self._next_dead_letter_retry = time.monotonic() + dead_letter_retry_s
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max(1, max_pending))
+        self._lock = threading.Lock()
+        # Every submitted row until its flush finishes (queued or in flight), for pending()
+        self._unwritten: Dict[int, Any] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+        self.submitted = 0
+        self.rejected = 0
+        self.flushed = 0
+        self.failed = 0
+        self.dead_lettered = len(dead_letter) if dead_letter is not None else 0
+        self.quarantined = dead_letter.quarantined() if dead_letter is not None else 0
+        self.batches = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None and not self._stopping.is_set():
+                    self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                    self._thread.start()
+
+    def submit(self, item: Any) -> bool:
+        if self._stopping.is_set():
+            return False
+        self._ensure_started()
+        with self._lock:
+            self._unwritten[id(item)] = item
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                del self._unwritten[id(item)]
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def _next_batch(self) -> List[Any]:
+        try:
+            first = self._queue.get(timeout=0.5)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = 0 if self._stopping.is_set() else deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: List[Any], attempts: int) -> bool:
+        for attempt in range(attempts):
+            try:
+                self.flush_batch(batch)
+                return True
+            except Exception as e:
+                print(f"[WriteBehind] Flush of {len(batch)} rows failed (attempt {attempt + 1}): {e}")
+                if attempt + 1 < attempts and not self._stopping.is_set():
+                    time.sleep(0.5 * 2 ** attempt)
+        return False
+
+    def _write_rows(self, batch: List[Any], give_up_after: int = 3) -> List[Any]:
+        """
+        Row-by-row pass after a batch keeps failing, so one bad row cannot sink
+        the rest. If the first few rows all fail the store is down, not the
+        data, and the remainder is returned without trying each.
+        """
+        failed = []
+        for index, row in enumerate(batch):
+            if len(failed) >= give_up_after and len(failed) == index:
+                return failed + batch[index:]
+            if not self._write([row], 1):
+                failed.append(row)
+        return failed
+
+    def _flush(self, batch: List[Any]) -> List[Any]:
+        """Write a batch; returns the rows that could not be written."""
+        started = time.perf_counter()
+        failed = []
+        if not self._write(batch, self.retries):
+            failed = self._write_rows(batch) if len(batch) > 1 else batch
+        written = len(batch) - len(failed)
+
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._lock:
+            for row in batch:
+                self._unwritten.pop(id(row), None)
+            self.flushed += written
+            self.batches += 1
+            self.last_flush_ms = elapsed
+            self.max_flush_ms = max(self.max_flush_ms, elapsed)
+            self._total_flush_ms += elapsed
+        return failed
+
+    def _park(self, rows: List[Any], attempts: Optional[List[int]] = None):
+        if not rows:
+            return
+        if self.dead_letter is not None:
+            try:
+                quarantined = self.dead_letter.append(rows, attempts)
+                with self._lock:
+                    self.dead_lettered += len(rows) - quarantined
+                    self.quarantined += quarantined
+                if quarantined:
+                    print(f"[WriteBehind] {quarantined} rows failed {self.dead_letter.max_attempts} retries; "
+                          f"moved to {self.dead_letter.quarantine_path}")
+                if len(rows) > quarantined:
+                    print(f"[WriteBehind] {len(rows) - quarantined} rows kept in {self.dead_letter.path} "
+                          f"for a later retry")
+                return
+            except OSError as e:
+                print(f"[WriteBehind] Could not write dead-letter file: {e}")
+        with self._lock:
+            self.failed += len(rows)
+        print(f"[WriteBehind] Dropped {len(rows)} rows after {self.retries} attempts")
+
+    def _retry_dead_letters(self):
+        self._next_dead_letter_retry = time.monotonic() + self.dead_letter_retry_s
+        entries = self.dead_letter.take()
+        if not entries:
+            return
+        print(f"[WriteBehind] Retrying {len(entries)} dead-lettered rows")
+        with self._lock:
+            self.dead_lettered -= len(entries)
+        attempts = {id(row): count for row, count in entries}
+        rows = [row for row, _ in entries]
+        for start in range(0, len(rows), self.batch_size):
+            failed = self._flush(rows[start:start + self.batch_size])
+            self._park(failed, [attempts[id(row)] + 1 for row in failed])
+        self.dead_letter.done()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._park(self._flush(batch))
+            elif self._stopping.is_set():
+                return
+            elif self.dead_letter is not None and time.monotonic() >= self._next_dead_letter_retry:
+                try:
+                    self._retry_dead_letters()
+                except Exception as e:
+                    print(f"[WriteBehind] Dead-letter retry failed: {e}")
+
+    def close(self, timeout: float = 10.0):
+        """Stop accepting rows and flush everything still queued."""
+        self._stopping.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+            if thread.is_alive():
+                print(f"[WriteBehind] Flush thread still busy after {timeout}s; "
+                      f"draining {self._queue.qsize()} rows here")
+        # Rows submitted while the flush thread was exiting, or left behind by a slow one
+        while not self._queue.empty():
+            batch = self._next_batch()
+            if batch:
+                self._park(self._flush(batch))
+
+    def pending(self, predicate: Callable[[Any], bool]) -> List[Any]:
+        """Submitted rows matching `predicate` whose flush has not finished yet."""
+        with self._lock:
+            return [row for row in self._unwritten.values() if predicate(row)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "depth": self._queue.qsize(),
+                "max_pending": self._queue.maxsize,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "flushed": self.flushed,
+                "failed": self.failed,
+                "dead_lettered": self.dead_lettered,
+                "quarantined": self.quarantined,
+                "batches": self.batches,
+                "last_flush_ms": round(self.last_flush_ms, 2),
+                "avg_flush_ms": round(self._total_flush_ms / self.batches, 2) if self.batches else 0.0,
+                "max_flush_ms": round(self.max_flush_ms, 2),
+            }
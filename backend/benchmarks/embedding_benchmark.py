@@ -0,0 +1,99 @@
+"""
+Embedding backend benchmark: load time, query throughput and peak RSS.
+
+Each backend runs in its own subprocess so RSS numbers are not polluted by
+the other backend's libraries.
+
+Usage (from backend/):
+    python benchmarks/embedding_benchmark.py
+    python benchmarks/embedding_benchmark.py --backends onnx --queries 500 --concurrency 32
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+
+SAMPLE_QUERIES = [
+    "How to teach fractions to class 5 students?",
+    "कक्षा 3 में विज्ञान कैसे पढ़ाएं?",
+    "Students are not paying attention in class, what should I do?",
+    "Photosynthesis activity for grade 7",
+    "bachhon ko multiplication kaise samjhaye",
+    "Classroom management tips for a multigrade school",
+]
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_child(backend: str, queries: int, concurrency: int) -> dict:
+    from app.embeddings import create_base_embeddings, MicroBatchingEmbeddings
+    from app.config import settings
+
+    rss_before = peak_rss_mb()
+    started = time.perf_counter()
+    embeddings = create_base_embeddings(backend)
+    embeddings.embed_query("warm up")
+    load_s = time.perf_counter() - started
+
+    texts = [f"{SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)]} #{i}" for i in range(queries)]
+
+    started = time.perf_counter()
+    for text in texts:
+        embeddings.embed_query(text)
+    sequential_s = time.perf_counter() - started
+
+    batched = MicroBatchingEmbeddings(embeddings, settings.EMBEDDING_BATCH_SIZE, settings.EMBEDDING_BATCH_WAIT_MS)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(batched.embed_query, texts))
+    concurrent_s = time.perf_counter() - started
+
+    return {
+        "backend": backend,
+        "load_s": round(load_s, 2),
+        "sequential_qps": round(queries / sequential_s, 1),
+        "concurrent_qps": round(queries / concurrent_s, 1),
+        "avg_batch_size": batched.stats()["avg_batch_size"],
+        "rss_baseline_mb": round(rss_before, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=["huggingface", "onnx"])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(args.child, args.queries, args.concurrency)))
+        return
+
+    rows = []
+    for backend in args.backends:
+        proc = subprocess.run(
+            [sys.executable, __file__, "--child", backend,
+             "--queries", str(args.queries), "--concurrency", str(args.concurrency)],
+            capture_output=True, text=True
+        )
+        if proc.returncode != 0:
+            print(f"[{backend}] failed:\n{proc.stderr.strip()[-2000:]}")
+            continue
+        rows.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    columns = ["backend", "load_s", "sequential_qps", "concurrent_qps", "avg_batch_size", "rss_baseline_mb", "peak_rss_mb"]
+    print(" | ".join(f"{c:>15}" for c in columns))
+    for row in rows:
+        print(" | ".join(f"{str(row[c]):>15}" for c in columns))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+-- Session summaries and keyset pagination for chat history
+-- Run this in Supabase SQL Editor
+
+-- One row per chat session; the API lists these instead of pulling every message
+CREATE OR REPLACE VIEW chat_sessions AS
+SELECT
+    teacher_id,
+    session_id,
+    (array_agg(query_text ORDER BY "timestamp", id))[1] AS first_query,
+    min("timestamp") AS started_at,
+    max("timestamp") AS last_timestamp,
+    count(*) AS message_count
+FROM chat_history
+GROUP BY teacher_id, session_id;
+
+-- Newest-first (timestamp, id) keyset pages for teacher and CRP history
+CREATE INDEX IF NOT EXISTS idx_chat_teacher_timestamp_id ON chat_history(teacher_id, "timestamp" DESC, id DESC);
+
+-- Verify the view
+SELECT * FROM chat_sessions ORDER BY last_timestamp DESC LIMIT 5;
@@ -0,0 +1,34 @@
+-- Bulk chat save for the write-behind queue: many messages, one round trip
+-- Run this in Supabase SQL Editor (after save_chat_message_migration.sql)
+
+-- Same atomic counter update as save_chat_message, aggregated per teacher.
+-- ON CONFLICT makes a retried batch (e.g. after a timeout) harmless.
+CREATE OR REPLACE FUNCTION save_chat_messages(p_messages jsonb)
+RETURNS void
+LANGUAGE sql
+AS $$
+    WITH inserted AS (
+        INSERT INTO chat_history (
+            id, session_id, teacher_id, query_text, answer_text,
+            detected_topic, query_sentiment, detected_language, source_type, "timestamp"
+        )
+        SELECT
+            m.id, m.session_id, m.teacher_id, m.query_text, m.answer_text,
+            m.detected_topic, m.query_sentiment, m.detected_language, m.source_type, m."timestamp"
+        FROM jsonb_populate_recordset(NULL::chat_history, p_messages) AS m
+        ON CONFLICT (id) DO NOTHING
+        RETURNING teacher_id, "timestamp"
+    ),
+    per_teacher AS (
+        SELECT teacher_id, count(*) AS queries, max("timestamp") AS latest FROM inserted GROUP BY teacher_id
+    )
+    UPDATE teachers
+    SET total_queries = COALESCE(teachers.total_queries, 0) + per_teacher.queries,
+        -- Message times, not flush time: write-behind and dead-letter replays run late
+        last_active = GREATEST(teachers.last_active, per_teacher.latest)
+    FROM per_teacher
+    WHERE teachers.id = per_teacher.teacher_id;
+$$;
+
+-- Verify the function exists
+SELECT proname FROM pg_proc WHERE proname = 'save_chat_messages';
@@ -0,0 +1,62 @@
+-- Server-side aggregation for the CRP analytics dashboard
+-- Run this in Supabase SQL Editor
+
+-- Returns grouped counts only, so the API never pulls raw chat rows to count them:
+--   one row per (dimension, value) inside [p_start, p_end)  (NULL bound = open),
+--   split by teacher only when p_per_teacher is set (teacher_id is NULL otherwise)
+--   dimension = 'today' rows with the query count for the day starting at p_today_start
+--   one dimension = 'active_today' row with the number of teachers who asked anything that day
+-- Rows are ordered so the API can page through them with Range headers.
+
+-- The first version took no p_per_teacher; drop it so calls are not ambiguous
+DROP FUNCTION IF EXISTS crp_analytics_counts(text[], timestamp, timestamp, timestamp);
+
+CREATE OR REPLACE FUNCTION crp_analytics_counts(
+    p_teacher_ids text[],
+    p_start timestamp DEFAULT NULL,
+    p_end timestamp DEFAULT NULL,
+    p_today_start timestamp DEFAULT date_trunc('day', now()::timestamp),
+    p_per_teacher boolean DEFAULT false
+)
+RETURNS TABLE (teacher_id text, dimension text, value text, queries bigint)
+LANGUAGE sql STABLE
+AS $$
+    WITH windowed AS (
+        SELECT CASE WHEN p_per_teacher THEN c.teacher_id END AS teacher_key,
+               COALESCE(NULLIF(c.detected_topic, ''), 'Unknown') AS detected_topic,
+               COALESCE(NULLIF(c.query_sentiment, ''), 'Unknown') AS query_sentiment,
+               COALESCE(NULLIF(c.detected_language, ''), 'Unknown') AS detected_language
+        FROM chat_history c
+        WHERE c.teacher_id = ANY(p_teacher_ids)
+          AND (p_start IS NULL OR c."timestamp" >= p_start)
+          AND (p_end IS NULL OR c."timestamp" < p_end)
+    ),
+    today AS (
+        SELECT c.teacher_id
+        FROM chat_history c
+        WHERE c.teacher_id = ANY(p_teacher_ids)
+          AND c."timestamp" >= p_today_start
+          AND c."timestamp" < p_today_start + interval '1 day'
+    )
+    SELECT * FROM (
+        SELECT w.teacher_key, 'detected_topic', w.detected_topic, count(*) FROM windowed w GROUP BY w.teacher_key, w.detected_topic
+        UNION ALL
+        SELECT w.teacher_key, 'query_sentiment', w.query_sentiment, count(*) FROM windowed w GROUP BY w.teacher_key, w.query_sentiment
+        UNION ALL
+        SELECT w.teacher_key, 'detected_language', w.detected_language, count(*) FROM windowed w GROUP BY w.teacher_key, w.detected_language
+        UNION ALL
+        SELECT CASE WHEN p_per_teacher THEN t.teacher_id END, 'today', NULL, count(*)
+        FROM today t
+        GROUP BY 1
+        UNION ALL
+        SELECT NULL, 'active_today', NULL, count(DISTINCT t.teacher_id) FROM today t
+    ) counts (teacher_id, dimension, value, queries)
+    ORDER BY dimension, teacher_id, value;
+$$;
+
+-- Lets both the window filter and the "today" counters use an index range scan
+CREATE INDEX IF NOT EXISTS idx_chat_teacher_timestamp ON chat_history(teacher_id, "timestamp");
+
+-- Verify the function
+SELECT * FROM crp_analytics_counts(ARRAY['T1', 'T2']) LIMIT 10;
+SELECT * FROM crp_analytics_counts(ARRAY['T1', 'T2'], p_per_teacher => true) LIMIT 10;
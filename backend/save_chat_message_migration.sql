@@ -0,0 +1,31 @@
+-- Atomic chat save: insert the message and bump the teacher's counters in one call
+-- Run this in Supabase SQL Editor
+
+-- The increment happens in the same statement as the insert, so concurrent web and
+-- WhatsApp queries from one teacher can no longer overwrite each other's count
+CREATE OR REPLACE FUNCTION save_chat_message(p_message jsonb)
+RETURNS void
+LANGUAGE sql
+AS $$
+    WITH inserted AS (
+        INSERT INTO chat_history (
+            id, session_id, teacher_id, query_text, answer_text,
+            detected_topic, query_sentiment, detected_language, source_type, "timestamp"
+        )
+        SELECT
+            m.id, m.session_id, m.teacher_id, m.query_text, m.answer_text,
+            m.detected_topic, m.query_sentiment, m.detected_language, m.source_type, m."timestamp"
+        FROM jsonb_populate_record(NULL::chat_history, p_message) AS m
+        ON CONFLICT (id) DO NOTHING  -- A retried save neither fails nor counts twice
+        RETURNING teacher_id, "timestamp"
+    )
+    UPDATE teachers
+    SET total_queries = COALESCE(teachers.total_queries, 0) + 1,
+        -- The message's own time: a delayed or replayed write is not new activity
+        last_active = GREATEST(teachers.last_active, inserted."timestamp")
+    FROM inserted
+    WHERE teachers.id = inserted.teacher_id;
+$$;
+
+-- Verify the function exists
+SELECT proname FROM pg_proc WHERE proname = 'save_chat_message';
@@ -22,6 +22,7 @@ export default function TeacherQuery() {
   const [user, setUser] = useState(null);
   const [sidebarOpen, setSidebarOpen] = useState(true);
   const [currentSessionId, setCurrentSessionId] = useState(null);
+  const [lastMessageId, setLastMessageId] = useState(null);
   const [audioLevels, setAudioLevels] = useState([]);
   const [recordingTime, setRecordingTime] = useState(0);
 
@@ -49,7 +50,7 @@ export default function TeacherQuery() {
   const loadChatSessions = async () => {
     try {
       const sessions = await api.getTeacherSessions();
-      setChatSessions(sessions);
+      setChatSessions(sessions.items);
     } catch (error) {
       console.error("Failed to load chat sessions:", error);
     }
@@ -71,13 +72,14 @@ export default function TeacherQuery() {
     try {
       const result = await api.teacherQueryText(
         queryText,
-        currentChat,
-        currentSessionId
+        currentSessionId,
+        lastMessageId
       );
 
       if (result.session_id && !currentSessionId) {
         setCurrentSessionId(result.session_id);
       }
+      setLastMessageId(result.message_id || null);
 
       const aiMessage = {
         role: "assistant",
@@ -190,13 +192,14 @@ export default function TeacherQuery() {
       });
       const result = await api.teacherQueryVoice(
         audioFile,
-        currentChat,
-        currentSessionId
+        currentSessionId,
+        lastMessageId
       );
 
       if (result.session_id && !currentSessionId) {
         setCurrentSessionId(result.session_id);
       }
+      setLastMessageId(result.message_id || null);
 
       const userMessage = {
         role: "user",
@@ -234,11 +237,20 @@ export default function TeacherQuery() {
   const startNewChat = () => {
     setCurrentChat([]);
     setCurrentSessionId(null);
+    setLastMessageId(null);
   };
 
-  const loadChatSession = (session) => {
+  const loadChatSession = async (session) => {
+    let sessionMessages;
+    try {
+      sessionMessages = await api.getTeacherSession(session.session_id);
+    } catch (error) {
+      console.error("Failed to load chat session:", error);
+      return;
+    }
+
     const messages = [];
-    session.messages.forEach((msg) => {
+    sessionMessages.forEach((msg) => {
       messages.push({
         role: "user",
         text: msg.query_text,
@@ -255,6 +267,9 @@ export default function TeacherQuery() {
     });
     setCurrentChat(messages);
     setCurrentSessionId(session.session_id);
+    setLastMessageId(
+      sessionMessages.length ? sessionMessages[sessionMessages.length - 1].id : null
+    );
   };
 
   const handleLogout = () => {
@@ -84,24 +84,27 @@ class ApiService {
   }
 
   // Teacher APIs
-  async teacherQueryText(queryText, chatHistory = [], sessionId = null) {
+  // The server keeps the conversation; only the id of the last answer seen is sent
+  async teacherQueryText(queryText, sessionId = null, lastMessageId = null) {
     return await this.request('/api/teacher/query', {
       method: 'POST',
       body: JSON.stringify({ 
         query_text: queryText,
-        chat_history: chatHistory,
-        session_id: sessionId
+        session_id: sessionId,
+        last_message_id: lastMessageId
       }),
     });
   }
 
-  async teacherQueryVoice(audioFile, chatHistory = [], sessionId = null) {
+  async teacherQueryVoice(audioFile, sessionId = null, lastMessageId = null) {
     const formData = new FormData();
     formData.append('file', audioFile);
-    formData.append('chat_history', JSON.stringify(chatHistory));
     if (sessionId) {
       formData.append('session_id', sessionId);
     }
+    if (lastMessageId) {
+      formData.append('last_message_id', lastMessageId);
+    }
 
     const url = `${API_BASE_URL}/api/teacher/query-voice`;
     const response = await fetch(url, {
@@ -124,8 +127,13 @@ class ApiService {
     return await this.request('/api/teacher/history');
   }
 
-  async getTeacherSessions() {
-    return await this.request('/api/teacher/sessions');
+  async getTeacherSessions(cursor = null) {
+    const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+    return await this.request(`/api/teacher/sessions${query}`);
+  }
+
+  async getTeacherSession(sessionId) {
+    return await this.request(`/api/teacher/sessions/${encodeURIComponent(sessionId)}`);
   }
 
   async clearConversationMemory() {